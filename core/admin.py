@@ -2,7 +2,8 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
 from .models import (User, Account, Transaction, TransactionType,
-                     Currency, CurrencyConversionRate)
+                     Currency, CurrencyConversionRate, LedgerEntry,
+                     BalanceSnapshot, TransferRequest, TransactionRollup)
 
 
 @admin.register(User)
@@ -32,7 +33,25 @@ class AccountAdmin(admin.ModelAdmin):
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
-    pass
+    """
+    Read-only: transfers are made through the API, and saving one again
+    would move the balances again
+    """
+
+    list_display = ('id', 'sender_account', 'receiver_account',
+                    'sent_amount', 'received_amount', 'transaction_date')
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(TransactionType)
@@ -48,3 +67,32 @@ class CurrencyAdmin(admin.ModelAdmin):
 @admin.register(CurrencyConversionRate)
 class CurrencyConversionRateAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('account', 'amount', 'created', 'transaction')
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BalanceSnapshot)
+class BalanceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('account', 'balance', 'taken_at')
+
+
+@admin.register(TransferRequest)
+class TransferRequestAdmin(admin.ModelAdmin):
+    list_display = ('user', 'sent_amount', 'status', 'created', 'processed')
+    list_filter = ('status',)
+
+
+@admin.register(TransactionRollup)
+class TransactionRollupAdmin(admin.ModelAdmin):
+    list_display = ('user', 'currency', 'period', 'period_start', 'sent',
+                    'received', 'commission')
+    list_filter = ('period', 'currency')
@@ -0,0 +1,285 @@
+"""
+Archive of old transactions.
+
+archive_transactions moves whole months of transactions out of the
+database into gzipped JSON lines files, one or more per month, named
+transactions-YYYY-MM[.N].jsonl.gz, in settings.TRANSACTION_ARCHIVE_DIR.
+Every line is a transaction with the ids and usernames of its two users,
+which is all it takes to rebuild the feed entries of both. Next to every
+file, FILE.users.json lists the ids of all users in it, so reads for one
+user skip the files they are not in without decompressing them. History,
+export and TransactionRollup.rebuild read the archived months from here.
+"""
+import gzip
+import json
+import os
+import re
+import threading
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from . import partitions
+from .conf import EXPORT_CHUNK_SIZE
+from .models import Transaction, FeedEntry, TransferRequest
+
+
+FILENAME = re.compile(r'^transactions-(\d{4})-(\d{2})(?:\.\d+)?\.jsonl\.gz$')
+
+FIELDS = ('id', 'transaction_date', 'sender_account_id',
+          'receiver_account_id', 'transaction_type_id', 'sent_amount',
+          'received_amount', 'commission', 'sender_currency',
+          'receiver_currency', 'commission_rate', 'conversion_rate')
+
+
+def get_directory():
+    return settings.TRANSACTION_ARCHIVE_DIR
+
+
+def get_files(directory=None):
+    """
+    Archive files by the month they hold, newest month first
+    """
+    directory = directory or get_directory()
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+
+    months = {}
+    for name in names:
+        match = FILENAME.match(name)
+        if match:
+            month = partitions.month_start(
+                datetime(int(match[1]), int(match[2]), 1))
+            months.setdefault(month, []).append(os.path.join(directory, name))
+    return sorted(months.items(), reverse=True)
+
+
+def get_boundary(directory=None):
+    """
+    Start of the month after the newest archived one: every archived
+    transaction is older than this. None while nothing is archived.
+    """
+    files = get_files(directory)
+    return partitions.add_months(files[0][0], 1) if files else None
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (Decimal, UUID)):
+        return str(value)
+    return value
+
+
+def archive_month(month, directory=None):
+    """
+    Move the transactions of the month starting at ``month`` to a new
+    archive file and return how many there were. Their feed entries go
+    with them; their ledger entries stay and keep the transaction id.
+    """
+    directory = directory or get_directory()
+    os.makedirs(directory, exist_ok=True)
+    transactions = Transaction.objects.filter(
+        transaction_date__gte=month,
+        transaction_date__lt=partitions.add_months(month, 1))
+
+    name = f'transactions-{month:%Y-%m}'
+    path = os.path.join(directory, f'{name}.jsonl.gz')
+    part = 0
+    while os.path.exists(path):
+        part += 1
+        path = os.path.join(directory, f'{name}.{part}.jsonl.gz')
+
+    rows = (
+        transactions.order_by('transaction_date', 'id')
+        .values(*FIELDS, sender_user=F('sender_account__user_id'),
+                sender_username=F('sender_account__user__username'),
+                receiver_user=F('receiver_account__user_id'),
+                receiver_username=F('receiver_account__user__username'))
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    written = 0
+    users = set()
+    with gzip.open(f'{path}.tmp', 'wt') as f:
+        for row in rows:
+            f.write(json.dumps({k: _encode(v) for k, v in row.items()}))
+            f.write('\n')
+            users.update((str(row['sender_user']), str(row['receiver_user'])))
+            written += 1
+    if not written:
+        os.remove(f'{path}.tmp')
+        # Still drop the month's partition
+        return partitions.drop_month(month)
+
+    # In place before the file itself, which readers only see with it
+    with open(f'{index_path(path)}.tmp', 'w') as f:
+        json.dump(sorted(users), f)
+    os.replace(f'{index_path(path)}.tmp', index_path(path))
+
+    with transaction.atomic():
+        TransferRequest.objects.filter(result__in=transactions) \
+            .update(result=None)
+        FeedEntry.objects.filter(transaction__in=transactions).delete()
+        count = partitions.drop_month(month)
+        # Renamed last, so a failed run leaves no file behind; if the
+        # commit itself fails, readers skip the rows the database still has
+        os.replace(f'{path}.tmp', path)
+    return count
+
+
+def index_path(path):
+    return f'{path}.users.json'
+
+
+# Archive files never change, so their indexes are read once per process
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_users(path):
+    """
+    Ids of the users in an archive file, None for files archived before
+    there were indexes
+    """
+    with _indexes_lock:
+        if path not in _indexes:
+            try:
+                with open(index_path(path)) as f:
+                    _indexes[path] = frozenset(json.load(f))
+            except FileNotFoundError:
+                _indexes[path] = None
+        return _indexes[path]
+
+
+def read(path, user=None):
+    """
+    Rows of an archive file, only those of ``user`` if given
+    """
+    # User pks are uuids: lines without it are skipped without parsing
+    pk = None if user is None else str(user.pk)
+    if pk is not None:
+        users = get_users(path)
+        if users is not None and pk not in users:
+            return
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            if pk is None or pk in line:
+                yield json.loads(line)
+
+
+def _feed_entry(row, user):
+    """
+    The entry of ``user`` for an archived transaction, None if they are
+    not part of it
+    """
+    pk = str(user.pk)
+    if row['sender_user'] == pk:
+        if row['receiver_user'] == pk:
+            direction, counterparty = FeedEntry.SELF, user.username
+        else:
+            direction = FeedEntry.SENT
+            counterparty = row['receiver_username']
+    elif row['receiver_user'] == pk:
+        direction, counterparty = FeedEntry.RECEIVED, row['sender_username']
+    else:
+        return None
+
+    return FeedEntry(
+        user=user, transaction_id=row['id'], direction=direction,
+        counterparty_username=counterparty,
+        transaction_date=datetime.fromisoformat(row['transaction_date']),
+        sender_account_id=UUID(row['sender_account_id']),
+        receiver_account_id=UUID(row['receiver_account_id']),
+        sent_amount=Decimal(row['sent_amount']),
+        received_amount=Decimal(row['received_amount']),
+        commission=Decimal(row['commission']),
+        sender_currency=row['sender_currency'],
+        receiver_currency=row['receiver_currency'],
+        commission_rate=row['commission_rate'],
+        conversion_rate=row['conversion_rate'],
+    )
+
+
+def _matches(entry, filters, before):
+    if 'currency' in filters:
+        currency = filters['currency']
+        if not (entry.direction != FeedEntry.RECEIVED and
+                entry.sender_currency == currency or
+                entry.direction != FeedEntry.SENT and
+                entry.receiver_currency == currency):
+            return False
+    if 'counterparty' in filters and \
+            entry.counterparty_username != filters['counterparty']:
+        return False
+    if 'date_from' in filters and \
+            entry.transaction_date < filters['date_from']:
+        return False
+    if 'date_to' in filters and entry.transaction_date >= filters['date_to']:
+        return False
+    return before is None or \
+        (entry.transaction_date, entry.transaction_id) < before
+
+
+def read_transactions(user, filters):
+    """
+    The user's archived transactions matching the history ``filters``,
+    oldest first, with the values Transaction rows have for FIELDS plus
+    the usernames
+    """
+    for month, paths in reversed(get_files()):
+        if 'date_to' in filters and month >= filters['date_to'] or \
+                'date_from' in filters and \
+                partitions.add_months(month, 1) <= filters['date_from']:
+            continue
+        rows = []
+        for path in paths:
+            for row in read(path, user):
+                entry = _feed_entry(row, user)
+                if entry is not None and _matches(entry, filters, None):
+                    rows.append(dict(
+                        row, transaction_date=entry.transaction_date,
+                        sender_account_id=entry.sender_account_id,
+                        receiver_account_id=entry.receiver_account_id,
+                        sent_amount=entry.sent_amount,
+                        received_amount=entry.received_amount,
+                        commission=entry.commission))
+        rows.sort(key=lambda row: (row['transaction_date'], row['id']))
+        yield from rows
+
+
+def read_feed(user, filters, before=None, limit=None):
+    """
+    The user's archived feed entries matching the history ``filters``
+    (validated TransactionFilterSerializer data), newest first. Only
+    entries before the ``before`` (transaction_date, transaction_id)
+    position are returned, and at most ``limit`` of them; months are read
+    newest first until the limit is reached.
+    """
+    upper = filters.get('date_to')
+    if before is not None and (upper is None or before[0] < upper):
+        upper = before[0]
+
+    entries = []
+    for month, paths in get_files():
+        if upper is not None and month > upper:
+            continue
+        if 'date_from' in filters and \
+                partitions.add_months(month, 1) <= filters['date_from']:
+            break
+        if limit is not None and len(entries) >= limit:
+            break
+        for path in paths:
+            for row in read(path, user):
+                entry = _feed_entry(row, user)
+                if entry is not None and _matches(entry, filters, before):
+                    entries.append(entry)
+
+    entries.sort(key=lambda e: (e.transaction_date, e.transaction_id),
+                 reverse=True)
+    return entries[:limit]
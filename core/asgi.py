@@ -0,0 +1,423 @@
+"""
+ASGI application.
+
+The read paths clients poll (current user, account list and detail and
+the transaction history) and the event stream replacing that polling are
+served by coroutines: the connection is held by the event loop and only
+the authentication, queries and serialization of a request run in a
+bounded pool of ORM threads. Each pool thread keeps
+its database connection open between requests (CONN_MAX_AGE), so the pool
+doubles as a connection pool of ASGI_THREAD_POOL_SIZE connections.
+
+Every other request goes through the regular Django WSGI stack, run in
+the same pool.
+"""
+import asyncio
+import io
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest
+from django.db import close_old_connections
+from django.http import Http404
+from django.utils.cache import get_conditional_response
+from rest_framework import exceptions
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+from rest_framework_jwt.settings import api_settings as jwt_settings
+
+from . import etags, events, metrics, routers
+from .conf import STREAM_KEEPALIVE_SECONDS
+from .models import Account, FeedEntry
+from .pagination import AccountCursorPagination
+from .serializers import AccountSerializer, FeedEntrySerializer, UserSerializer
+from .views import AccountViewSet, history
+
+
+executor = ThreadPoolExecutor(
+    getattr(settings, 'ASGI_THREAD_POOL_SIZE', 32),
+    thread_name_prefix='orm',
+)
+
+wsgi_application = WSGIHandler()
+
+
+def _call_in_pool(func, *args):
+    # What request_started and request_finished do for WSGI requests:
+    # drop connections that are broken or older than CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor,
+                                      partial(_call_in_pool, func, *args))
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI carries the raw path bytes decoded as latin-1
+        'PATH_INFO': scope['path'].encode().decode('iso-8859-1'),
+        'QUERY_STRING': scope['query_string'].decode('iso-8859-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('iso-8859-1').upper().replace('-', '_')
+        value = value.decode('iso-8859-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ \
+            else value
+    return environ
+
+
+class ReadView:
+    """
+    Authenticates and checks permissions like an APIView, then runs
+    ``load`` with the DRF request and renders what it returns as JSON.
+    Everything but the rendering happens in the ORM pool.
+    """
+
+    def __init__(self, load, name, etag=None):
+        self.load = load
+        self.name = name
+        self.etag = etag
+
+    def respond(self, request, kwargs):
+        """
+        Status, data and ETag of the response
+        """
+        etag = None
+        if self.etag is not None:
+            etag = self.etag(request, **kwargs)
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                return response.status_code, None, etag
+        return 200, self.load(request, **kwargs), etag
+
+    def run(self, request, kwargs):
+        with metrics.collect() as collected:
+            try:
+                request.get_host()
+                if not IsAuthenticated().has_permission(request, self):
+                    if request.authenticators and \
+                            not request.successful_authenticator:
+                        raise exceptions.NotAuthenticated()
+                    raise exceptions.PermissionDenied()
+
+                if routers.get_replicas() and \
+                        not routers.is_pinned(request.user):
+                    with routers.use_replicas():
+                        return (*self.respond(request, kwargs), collected)
+                return (*self.respond(request, kwargs), collected)
+            except (exceptions.APIException, Http404) as exc:
+                response = exception_handler(exc, {'request': request,
+                                                   'view': self})
+                return response.status_code, response.data, None, collected
+            except DisallowedHost:
+                return 400, {'detail': 'Bad request.'}, None, collected
+
+    @staticmethod
+    def make_request(environ):
+        return Request(WSGIRequest(environ), authenticators=[
+            auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+
+    async def handle(self, request, environ, **kwargs):
+        status, data, etag, collected = await run_sync(self.run, request,
+                                                       kwargs)
+
+        headers = [(b'vary', b'Accept')]
+        if data is not None:
+            headers.append((b'content-type', b'application/json'))
+        if etag is not None and status in (200, 304):
+            headers.append((b'etag', etag.encode()))
+        if status == 401:
+            headers.append((
+                b'www-authenticate',
+                request.authenticators[0].authenticate_header(request)
+                .encode()))
+        if 'HTTP_ORIGIN' in environ and \
+                getattr(settings, 'CORS_ORIGIN_ALLOW_ALL', False):
+            headers.append((b'access-control-allow-origin', b'*'))
+        body = b'' if data is None else JSONRenderer().render(data)
+        return status, headers, body, collected
+
+    async def serve(self, environ, receive, send, **kwargs):
+        start = time.perf_counter()
+        status, headers, body, collected = await self.handle(
+            self.make_request(environ), environ, **kwargs)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+        metrics.observe(self.name, 'GET', time.perf_counter() - start,
+                        collected)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_event(send, event, data):
+    await send({
+        'type': 'http.response.body',
+        'body': b'event: %s\ndata: %s\n\n' % (event.encode(),
+                                              JSONRenderer().render(data)),
+        'more_body': True,
+    })
+
+
+class EventStream(ReadView):
+    """
+    A text/event-stream of the user's new transactions, rendered like the
+    history (``transaction`` events), and of their accounts (a ``balances``
+    event on connect and after every batch of transactions). ``resync``
+    means events were lost and the history should be reloaded.
+
+    The stream only holds a hub queue while idle; its queries run in the
+    ORM pool, on the primary as the replicas may not have the new
+    transactions yet. Browsers' EventSource can't send headers, so the
+    JWT may also come in a ``token`` query param.
+    """
+
+    def __init__(self, name):
+        super().__init__(lambda request: None, name)
+
+    @staticmethod
+    def make_request(environ):
+        token = parse_qs(environ['QUERY_STRING']).get('token')
+        if token and 'HTTP_AUTHORIZATION' not in environ:
+            prefix = jwt_settings.JWT_AUTH_HEADER_PREFIX
+            environ = dict(environ, HTTP_AUTHORIZATION=f'{prefix} {token[0]}')
+        return ReadView.make_request(environ)
+
+    async def serve(self, environ, receive, send):
+        request = self.make_request(environ)
+        status, headers, body, _ = await self.handle(request, environ)
+        if status != 200:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        # Subscribe before the first read, so no commit falls in between
+        queue = events.hub.subscribe(request.user.pk)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [
+                            (b'content-type', b'text/event-stream'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no'),
+                            *(h for h in headers
+                              if h[0] == b'access-control-allow-origin'),
+                        ]})
+            await send_event(send, 'balances',
+                             await run_sync(load_balances, request))
+
+            while True:
+                received = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    {received, disconnected},
+                    timeout=STREAM_KEEPALIVE_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    received.cancel()
+                    return
+                if received not in done:
+                    received.cancel()
+                    await send({'type': 'http.response.body',
+                                'body': b': keepalive\n\n',
+                                'more_body': True})
+                    continue
+
+                # Everything queued meanwhile goes out with one read
+                items = [received.result()]
+                while not queue.empty():
+                    items.append(queue.get_nowait())
+                if events.RESYNC in items:
+                    await send_event(send, 'resync', {})
+                entries, balances = await run_sync(
+                    load_update, request,
+                    [i for i in items if i is not events.RESYNC])
+                for entry in entries:
+                    await send_event(send, 'transaction', entry)
+                await send_event(send, 'balances', balances)
+        finally:
+            events.hub.unsubscribe(request.user.pk, queue)
+            disconnected.cancel()
+
+
+def load_current_user(request):
+    return UserSerializer(request.user).data
+
+
+def load_accounts(request):
+    paginator = AccountCursorPagination()
+    page = paginator.paginate_queryset(AccountViewSet.queryset, request)
+    data = AccountSerializer(page, many=True).data
+    return paginator.get_paginated_response(data).data
+
+
+def load_account(request, pk):
+    return AccountSerializer(
+        get_object_or_404(AccountViewSet.queryset, pk=pk)).data
+
+
+def load_balances(request):
+    return AccountSerializer(request.user.get_accounts(), many=True).data
+
+
+def load_update(request, transaction_ids):
+    entries = FeedEntry.objects.filter(
+        user=request.user, transaction_id__in=transaction_ids
+    ).order_by('transaction_date', 'transaction_id')
+    return (FeedEntrySerializer(entries, many=True,
+                                context={'request': request}).data,
+            load_balances(request))
+
+
+def accounts_etag(request):
+    return etags.account_page_etag(request, Account.objects.all(),
+                                   AccountCursorPagination())
+
+
+def account_etag(request, pk):
+    return etags.account_etag(request, Account.objects.all(), pk)
+
+
+def load_transactions(request):
+    paginator, page = history(request)
+    data = FeedEntrySerializer(page, many=True,
+                               context={'request': request}).data
+    return paginator.get_paginated_response(data).data
+
+
+ROUTES = [
+    (re.compile(r'^/core/current_user/$'),
+     ReadView(load_current_user, 'core.views.current_user',
+              etag=etags.current_user_etag)),
+    (re.compile(r'^/api/accounts/$'),
+     ReadView(load_accounts, 'account-list', etag=accounts_etag)),
+    (re.compile(r'^/api/accounts/(?P<pk>[^/.]+)/$'),
+     ReadView(load_account, 'account-detail', etag=account_etag)),
+    (re.compile(r'^/api/transactions/$'),
+     ReadView(load_transactions, 'transaction-list')),
+    (re.compile(r'^/api/events/$'), EventStream('events')),
+]
+
+
+def resolve(environ):
+    # Browsers asking for HTML get the browsable API from the WSGI stack
+    if environ['REQUEST_METHOD'] != 'GET' or \
+            'text/html' in environ.get('HTTP_ACCEPT', '') or \
+            'format' in environ['QUERY_STRING']:
+        return None, {}
+    for pattern, view in ROUTES:
+        match = pattern.match(environ['PATH_INFO'])
+        if match:
+            return view, match.groupdict()
+    return None, {}
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def call_wsgi(environ, send):
+    """
+    Run the request through the Django WSGI stack in the ORM pool and
+    stream its response back, with the queue bounding how far the worker
+    thread may run ahead of the client
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+
+    def put(message):
+        asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.lower().encode('iso-8859-1'),
+                         v.encode('iso-8859-1')) for k, v in headers],
+        })
+
+    def run():
+        body = wsgi_application(environ, start_response)
+        try:
+            for chunk in body:
+                if chunk:
+                    put({'type': 'http.response.body', 'body': chunk,
+                         'more_body': True})
+        finally:
+            body.close()
+            put({'type': 'http.response.body', 'body': b''})
+
+    # The WSGI handler fires request_started/finished itself
+    worker = loop.run_in_executor(executor, run)
+    while True:
+        message = await queue.get()
+        await send(message)
+        if message['type'] == 'http.response.body' and \
+                not message.get('more_body'):
+            break
+    await worker
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    environ = build_environ(scope, await read_body(receive))
+    view, kwargs = resolve(environ)
+    if view is None:
+        return await call_wsgi(environ, send)
+
+    await view.serve(environ, receive, send, **kwargs)
@@ -0,0 +1,130 @@
+"""
+JWT authentication with the token's user cached per process.
+
+Entries belong to a generation kept in the 'versions' cache, which
+settings.CACHES shares between all processes. Every change of a user row
+replaces it (see core.signals and UserQuerySet.update), and each process
+drops its entries at most USER_CACHE_CHECK_SECONDS after that.
+"""
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+from .conf import (USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS,
+                   USER_CACHE_CHECK_SECONDS)
+from .models import User
+
+
+jwt_get_username_from_payload = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER
+
+CACHE = 'versions'
+GENERATION_KEY = 'core:user-cache-generation'
+
+
+def get_generation():
+    cache = caches[CACHE]
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, uuid4().hex, None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    # Random like core.reference's version, for the same reasons
+    caches[CACHE].set(GENERATION_KEY, uuid4().hex, None)
+    user_cache.checked = None
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user rows by username, with a time to live.
+
+    Only field values are kept and every hit builds a fresh User instance,
+    so requests never share (and mutate) the same object. All entries are
+    dropped once the shared generation changes, which is compared at most
+    every ``check`` seconds.
+    """
+
+    def __init__(self, size, ttl, check):
+        self.size = size
+        self.ttl = ttl
+        self.check = check
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.field_names = [f.attname for f in User._meta.concrete_fields]
+        self.generation = None
+        # When the generation was last compared
+        self.checked = None
+
+    def sync(self):
+        now = time.monotonic()
+        checked = self.checked
+        if checked is not None and now - checked < self.check:
+            return
+
+        generation = get_generation()
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            self.checked = now
+
+    def get(self, username):
+        self.sync()
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self.entries[username]
+                return None
+            self.entries.move_to_end(username)
+        return User.from_db(DEFAULT_DB_ALIAS, self.field_names, values)
+
+    def set(self, user):
+        self.sync()
+        values = [getattr(user, name) for name in self.field_names]
+        with self.lock:
+            self.entries[user.username] = (time.monotonic() + self.ttl, values)
+            self.entries.move_to_end(user.username)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS,
+                       USER_CACHE_CHECK_SECONDS)
+
+
+class CachedJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    JSONWebTokenAuthentication that resolves the token's user through
+    user_cache instead of loading the user row on every request
+    """
+
+    def authenticate_credentials(self, payload):
+        username = jwt_get_username_from_payload(payload)
+        if not username:
+            raise exceptions.AuthenticationFailed('Invalid payload.')
+
+        user = user_cache.get(username)
+        if user is None:
+            user = super().authenticate_credentials(payload)
+            user_cache.set(user)
+        return user
@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 FUNDS_TRANSFER_TO_SELF = 'SELF'
 FUNDS_TRANSFER_TO_OTHER = 'OTHER'
 
@@ -14,3 +16,68 @@ INITIAL_BALANCE = {
 }
 
 MIN_BALANCE = 0
+
+CENTS = Decimal('0.01')
+
+# Currency pairs without a direct rate are converted through this currency
+REFERENCE_CURRENCY = 'USD'
+
+# Processes look for changed transaction types and rates this often, see
+# core.reference
+REFERENCE_CHECK_SECONDS = 1
+
+MAX_QUOTES = 10000
+
+MAX_BATCH_TRANSFERS = 1000
+
+EXPORT_CHUNK_SIZE = 2000
+
+# archive_transactions keeps the current month and this many before it in
+# the database, and creates partitions this many months ahead
+ARCHIVE_AFTER_MONTHS = 12
+PARTITIONS_AHEAD_MONTHS = 3
+
+# Ledger entries younger than this are left to the next snapshot run, so
+# transfers still in flight when a run starts are never skipped
+SNAPSHOT_LAG_SECONDS = 300
+
+IDEMPOTENCY_KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+
+TRANSFER_QUEUE_BATCH_SIZE = 500
+
+# Users resolved from JWTs are cached per process for this long; saves,
+# deactivations and updates invalidate the entry right away in the saving
+# process and within USER_CACHE_CHECK_SECONDS in all others
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL_SECONDS = 30
+USER_CACHE_CHECK_SECONDS = 1
+
+ONBOARDING_CHUNK_SIZE = 1000
+# POST /api/users/bulk/ hashes passwords in the request, ~0.1s each; more
+# users at once are for the onboard_users command
+ONBOARDING_REQUEST_MAX_ROWS = 100
+
+# Event streams send a comment this often so proxies keep them open, and
+# buffer this many events for a slow client before asking it to reload
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_QUEUE_SIZE = 100
+
+# Token buckets of core.throttling: (burst, refill per second)
+THROTTLE_RATES = {
+    'transfer-user': (20, 5),
+    'transfer-account': (10, 2),
+    'signup': (5, 0.1),
+}
+# LocalBucketStore forgets full buckets beyond this many
+THROTTLE_LOCAL_BUCKETS = 100000
+
+# Transfers a process lets hold or wait for account locks at once, in all
+# and per account, before answering 503 and 429 respectively
+LOCK_QUEUE_LIMIT = 64
+ACCOUNT_LOCK_QUEUE_LIMIT = 8
+
+# settings.TRANSFER_CONCURRENCY = 'optimistic': compare-and-swap attempts
+# after the first, backing off a random time up to this doubled per attempt
+OPTIMISTIC_RETRIES = 5
+OPTIMISTIC_BACKOFF_SECONDS = 0.002
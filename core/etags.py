@@ -0,0 +1,85 @@
+"""
+Strong ETags for responses built from account balances.
+
+Every balance change bumps the version of the account row, or of the
+stripe taking a deposit to a striped account. A response is identified by
+the versions of the accounts in it, so whether a client's copy is still
+current is answered by one query on the versions, with no serialization.
+"""
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.db.models import Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils.cache import get_conditional_response
+
+
+def get_versions(accounts):
+    """
+    What AccountSerializer renders of ``accounts`` may change with: their
+    versions and their user's username
+    """
+    return accounts.annotate(
+        stripe_version=Coalesce(Sum('stripes__version'), Value(0))
+    ).order_by('uuid').values('uuid', 'version', 'stripe_version',
+                              'user__username')
+
+
+def make_etag(request, *parts):
+    # The representation also depends on the negotiated format and on
+    # query params such as the page cursor
+    digest = hashlib.sha256()
+    for part in (request.META.get('HTTP_ACCEPT', ''),
+                 request.META.get('QUERY_STRING', ''), *parts):
+        digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return f'"{digest.hexdigest()}"'
+
+
+def current_user_etag(request):
+    user = request.user
+    return make_etag(request, user.pk, user.username,
+                     *get_versions(user.account.all()))
+
+
+def account_etag(request, accounts, pk):
+    try:
+        return make_etag(request, *get_versions(accounts.filter(pk=pk)))
+    except ValidationError:
+        # Not a uuid, the view answers 404
+        return None
+
+
+def account_page_etag(request, accounts, paginator):
+    # The page the list renders, read with versions only
+    page = paginator.paginate_queryset(get_versions(accounts), request)
+    return make_etag(request, paginator.has_next, paginator.has_previous,
+                     *page)
+
+
+class ConditionalGetMixin:
+    """
+    Answers list and retrieve with 304 Not Modified while the client's
+    If-None-Match matches get_etag(), and sends the ETag with every 200
+    """
+
+    def get_etag(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def conditional(self, view, request, *args, **kwargs):
+        etag = self.get_etag(request, *args, **kwargs)
+        if etag is None:
+            return view(request, *args, **kwargs)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = view(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,152 @@
+"""
+Live updates of users' transactions and balances.
+
+Transaction.save and transfer_batch publish, once their database
+transaction has committed, which users got which new transactions. On
+PostgreSQL that is a NOTIFY on CHANNEL, which reaches every process;
+elsewhere it only reaches the hub of the publishing process, which is
+enough for a single ASGI process serving both the writes and the streams.
+
+An ASGI process has one Hub: a single LISTEN connection, read by the
+event loop, fanned out to a queue per open stream of the notified user.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+
+from django.db import connections
+
+from .conf import STREAM_QUEUE_SIZE
+from .routers import PRIMARY
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'core_events'
+
+RECONNECT_SECONDS = 1
+
+# Put on a stream's queue in place of events it may have missed
+RESYNC = None
+
+
+def publish(events):
+    """
+    Announce new transactions to their users: ``events`` are
+    (user pk, transaction id) pairs
+    """
+    payloads = [json.dumps({'user': str(user_pk), 'transaction': pk})
+                for user_pk, pk in events]
+    connection = connections[PRIMARY]
+    if connection.vendor != 'postgresql':
+        hub.deliver_threadsafe(payloads)
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) payload',
+            [CHANNEL, payloads])
+
+
+class Hub:
+    def __init__(self):
+        self.streams = defaultdict(set)
+        self.loop = None
+        self.listener = None
+        self.listener_fd = None
+
+    def subscribe(self, user_pk):
+        """
+        A queue receiving the ids of the user's new transactions, or
+        RESYNC. Must be called from the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.stop()
+            self.loop = loop
+            if connections[PRIMARY].vendor == 'postgresql':
+                self.listen()
+
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.streams[str(user_pk)].add(queue)
+        return queue
+
+    def unsubscribe(self, user_pk, queue):
+        streams = self.streams.get(str(user_pk))
+        if streams is not None:
+            streams.discard(queue)
+            if not streams:
+                del self.streams[str(user_pk)]
+
+    def deliver(self, payload):
+        message = json.loads(payload)
+        for queue in self.streams.get(message['user'], ()):
+            self.put(queue, message['transaction'])
+
+    def deliver_threadsafe(self, payloads):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        for payload in payloads:
+            loop.call_soon_threadsafe(self.deliver, payload)
+
+    def put(self, queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # The client is too slow to keep up: have it reload instead
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(RESYNC)
+
+    def listen(self):
+        wrapper = connections[PRIMARY]
+        try:
+            listener = wrapper.get_new_connection(
+                wrapper.get_connection_params())
+            listener.autocommit = True
+            listener.cursor().execute(f'LISTEN {CHANNEL}')
+        except Exception:
+            logger.exception('Could not listen on %s, retrying', CHANNEL)
+            self.loop.call_later(RECONNECT_SECONDS, self.reconnect)
+            return
+        self.listener = listener
+        self.listener_fd = listener.fileno()
+        self.loop.add_reader(self.listener_fd, self.poll)
+
+    def reconnect(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.listen()
+        # Notifications sent while not listening are lost
+        for streams in self.streams.values():
+            for queue in streams:
+                self.put(queue, RESYNC)
+
+    def poll(self):
+        try:
+            self.listener.poll()
+        except Exception:
+            logger.exception('Lost the %s listener, reconnecting', CHANNEL)
+            self.close_listener()
+            self.loop.call_later(RECONNECT_SECONDS, self.reconnect)
+            return
+        while self.listener.notifies:
+            self.deliver(self.listener.notifies.pop(0).payload)
+
+    def close_listener(self):
+        if self.listener is None:
+            return
+        if not self.loop.is_closed():
+            self.loop.remove_reader(self.listener_fd)
+        self.listener.close()
+        self.listener = self.listener_fd = None
+
+    def stop(self):
+        if self.loop is not None:
+            self.close_listener()
+        self.loop = None
+        self.streams.clear()
+
+
+hub = Hub()
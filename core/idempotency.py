@@ -0,0 +1,68 @@
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, IntegrityError
+from rest_framework import status
+from rest_framework.response import Response
+
+from .conf import IDEMPOTENCY_KEY_HEADER
+from .models import IdempotencyKey
+
+
+def fingerprint(data):
+    body = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class IdempotentCreateMixin:
+    """
+    Honour an ``Idempotency-Key`` header on create.
+
+    The key is stored together with the response in the same database
+    transaction as the created object. A retry is answered from that row
+    with a single indexed read. A duplicate arriving while the first request
+    is still running blocks on the key's unique index until the first one
+    commits (and then replays its response) or rolls back (and then runs
+    itself).
+    """
+
+    def create(self, request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_KEY_HEADER)
+        if not key:
+            return super().create(request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return Response({'detail': 'Idempotency-Key is too long'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        digest = fingerprint(request.data)
+        record = IdempotencyKey.objects.filter(
+            user=request.user, key=key).first()
+        if record is not None:
+            return self.replay(record, digest)
+
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user=request.user, key=key, fingerprint=digest)
+                response = super().create(request, *args, **kwargs)
+                record.status_code = response.status_code
+                record.response = json.dumps(response.data,
+                                             cls=DjangoJSONEncoder)
+                record.save(update_fields=('status_code', 'response'))
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(
+                user=request.user, key=key).first()
+            if record is None:
+                raise
+            return self.replay(record, digest)
+        return response
+
+    def replay(self, record, digest):
+        if record.fingerprint != digest:
+            return Response(
+                {'detail': 'Idempotency-Key was used for another request'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        return Response(json.loads(record.response),
+                        status=record.status_code,
+                        headers={'Idempotent-Replayed': 'true'})
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+from django.utils import timezone
+
+from core import archive, partitions
+from core.conf import ARCHIVE_AFTER_MONTHS, PARTITIONS_AHEAD_MONTHS
+from core.models import Transaction
+
+
+class Command(BaseCommand):
+    help = ('Move transactions of months older than --months to the '
+            'archive and create the upcoming monthly partitions')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=ARCHIVE_AFTER_MONTHS,
+            help='Months kept in the database besides the current one',
+        )
+        parser.add_argument(
+            '--ahead', type=int, default=PARTITIONS_AHEAD_MONTHS,
+            help='Months past the current one to create partitions for',
+        )
+        parser.add_argument('--directory',
+                            help='Defaults to TRANSACTION_ARCHIVE_DIR')
+
+    def handle(self, *args, **options):
+        current = partitions.month_start(timezone.now())
+        cutoff = partitions.add_months(current, -options['months'])
+
+        oldest = Transaction.objects.aggregate(
+            oldest=Min('transaction_date'))['oldest']
+        month = partitions.month_start(oldest or cutoff)
+        while month < cutoff:
+            count = archive.archive_month(month, options['directory'])
+            if count:
+                self.stdout.write(
+                    f'Archived {count} transactions of {month:%Y-%m}')
+            month = partitions.add_months(month, 1)
+
+        created = partitions.ensure_partitions(
+            current, partitions.add_months(current, options['ahead'] + 1))
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived transactions before {cutoff:%Y-%m-%d}, '
+            f'created {len(created)} partitions'))
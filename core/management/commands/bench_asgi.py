@@ -0,0 +1,188 @@
+import asyncio
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from rest_framework_jwt.settings import api_settings
+
+from core import asgi
+from core.models import User
+from core.onboarding import create_accounts
+
+from .bench_transfers import percentile
+
+
+def make_scope(path, query, token):
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'localhost'),
+                    (b'accept', b'application/json'),
+                    (b'authorization', f'JWT {token}'.encode())],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 0),
+    }
+
+
+async def receive():
+    return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+
+class Run:
+    """
+    ``clients`` concurrent clients each make ``requests`` requests one
+    after the other and keep the connection for ``hold`` seconds after
+    every response, like a long-polling client waiting for its next poll
+    """
+
+    def __init__(self, scope, clients, requests, hold):
+        self.scope = scope
+        self.clients = clients
+        self.requests = requests
+        self.hold = hold
+        self.latencies = []
+        self.statuses = Counter()
+        self.peak_threads = threading.active_count()
+
+    async def sample_threads(self):
+        while True:
+            self.peak_threads = max(self.peak_threads,
+                                    threading.active_count())
+            await asyncio.sleep(0.01)
+
+    async def main(self):
+        sampler = asyncio.ensure_future(self.sample_threads())
+        start = time.perf_counter()
+        await asyncio.gather(*(self.client() for _ in range(self.clients)))
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+        return elapsed
+
+    def report(self, elapsed):
+        total = self.clients * self.requests
+        return {
+            'seconds': round(elapsed, 3),
+            'requests': total,
+            'statuses': dict(self.statuses),
+            'throughput': round(total / elapsed, 1),
+            'latency_ms': {
+                name: round(percentile(self.latencies, p) * 1000, 2)
+                for name, p in (('p50', 50), ('p95', 95), ('p99', 99))
+            },
+            'peak_threads': self.peak_threads,
+        }
+
+    def run(self):
+        return self.report(asyncio.run(self.main()))
+
+
+class ASGIRun(Run):
+    async def client(self):
+        for _ in range(self.requests):
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            start = time.perf_counter()
+            await asgi.application(self.scope, receive, send)
+            self.latencies.append(time.perf_counter() - start)
+            self.statuses[sent[0]['status']] += 1
+            await asyncio.sleep(self.hold)
+
+
+class WSGIRun(Run):
+    """
+    A threaded WSGI server: a connection occupies one of ``threads``
+    threads while its request is handled and while it is held open
+    """
+
+    def __init__(self, *args, threads):
+        super().__init__(*args)
+        self.pool = ThreadPoolExecutor(threads)
+        self.application = get_wsgi_application()
+
+    def handle(self, issued):
+        status = []
+        body = self.application(
+            asgi.build_environ(self.scope, b''),
+            lambda s, headers, exc_info=None: status.append(s))
+        b''.join(body)
+        body.close()
+        self.latencies.append(time.perf_counter() - issued)
+        self.statuses[int(status[0].split(' ', 1)[0])] += 1
+        time.sleep(self.hold)
+
+    async def client(self):
+        loop = asyncio.get_running_loop()
+        for _ in range(self.requests):
+            await loop.run_in_executor(self.pool, self.handle,
+                                       time.perf_counter())
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            self.pool.shutdown()
+
+
+class Command(BaseCommand):
+    help = ('Compare the ASGI read paths with the WSGI stack under many '
+            'concurrent long-polling clients and print the figures as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/core/current_user/')
+        parser.add_argument('--query', default='')
+        parser.add_argument('--clients', type=int, default=500)
+        parser.add_argument('--requests', type=int, default=4,
+                            help='Requests per client')
+        parser.add_argument('--hold', type=float, default=0.5,
+                            help='Seconds a client keeps its connection '
+                                 'after each response')
+        parser.add_argument('--wsgi-threads', type=int, default=64,
+                            help='Threads of the WSGI server')
+        parser.add_argument('--output', help='Also write the JSON here')
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username=f'bench-asgi-{int(time.time())}',
+                                   password=make_password(None))
+        create_accounts([user])
+        token = api_settings.JWT_ENCODE_HANDLER(
+            api_settings.JWT_PAYLOAD_HANDLER(user))
+        scope = make_scope(options['path'], options['query'], token)
+        run_args = (scope, options['clients'], options['requests'],
+                    options['hold'])
+
+        # Pool threads open their own connections
+        connection.close()
+        report = {
+            'database': connection.vendor,
+            'path': options['path'],
+            'clients': options['clients'],
+            'requests_per_client': options['requests'],
+            'hold_seconds': options['hold'],
+            'wsgi': dict(WSGIRun(*run_args,
+                                 threads=options['wsgi_threads']).run(),
+                         threads=options['wsgi_threads']),
+            'asgi': dict(ASGIRun(*run_args).run(),
+                         threads=asgi.executor._max_workers),
+        }
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,82 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core.models import User, Account, Currency, LedgerEntry
+
+
+class Command(BaseCommand):
+    help = ('Measure concurrent deposit throughput into one account for '
+            'different stripe counts, printed as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stripes', default='0,2,4,8,16',
+            help='Comma separated stripe counts to compare',
+        )
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--deposits', type=int, default=2000,
+                            help='Deposits per stripe count')
+        parser.add_argument(
+            '--hold-ms', type=float, default=2.0,
+            help='Time each deposit keeps its transaction open, standing in '
+                 'for the rest of the transfer',
+        )
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username='bench-deposits')
+        currency = Currency.objects.first()
+
+        runs = []
+        for stripe_count in map(int, options['stripes'].split(',')):
+            # A fresh account per run, so every run starts from an empty
+            # balance without writing one off the ledger
+            account = Account.objects.create(
+                user=user, currency=currency, balance=0)
+            Account.set_stripes(account.uuid, stripe_count)
+            runs.append(self.run(account.uuid, stripe_count, options))
+
+            # Fold the stripes back into the account's balance
+            Account.set_stripes(account.uuid, 0)
+
+        self.stdout.write(json.dumps({
+            'threads': options['threads'],
+            'deposits': options['deposits'],
+            'hold_ms': options['hold_ms'],
+            'runs': runs,
+        }, indent=2))
+
+    def run(self, uuid, stripe_count, options):
+        amount = Decimal('0.01')
+        hold = options['hold_ms'] / 1000
+        per_thread = options['deposits'] // options['threads']
+
+        def deposit():
+            try:
+                for _ in range(per_thread):
+                    with transaction.atomic():
+                        Account.deposit(uuid, amount,
+                                        stripe_count=stripe_count)
+                        LedgerEntry.objects.create(account_id=uuid,
+                                                   amount=amount)
+                        time.sleep(hold)
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as pool:
+            for future in [pool.submit(deposit)
+                           for _ in range(options['threads'])]:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        deposits = per_thread * options['threads']
+        return {
+            'stripes': stripe_count,
+            'seconds': round(elapsed, 3),
+            'deposits_per_second': round(deposits / elapsed, 1),
+        }
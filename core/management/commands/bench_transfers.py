@@ -0,0 +1,231 @@
+import json
+import random
+import time
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from decimal import Decimal
+from itertools import accumulate
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, OperationalError
+from django.test import RequestFactory, override_settings
+
+from core.models import User, Account, Currency, TransferConflict
+from core.serializers import TransactionSerializer
+
+
+DEADLOCK = '40P01'
+SERIALIZATION_FAILURE = '40001'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def choose_receivers(accounts, contention, count, rng, zipf_s):
+    if contention == 'uniform':
+        return [rng.choice(accounts) for _ in range(count)]
+    if contention == 'hot':
+        return [accounts[0]] * count
+
+    # Zipfian: the account ranked k is picked with weight 1 / k^s
+    weights = list(accumulate(1 / k ** zipf_s
+                              for k in range(1, len(accounts) + 1)))
+    return [accounts[bisect(weights, rng.random() * weights[-1])]
+            for _ in range(count)]
+
+
+def run_transfers(plan, max_retries):
+    """
+    Send every (sender user, sender account, receiver account, amount) of
+    the plan through TransactionSerializer and Transaction.save, the way
+    POST /api/transactions/ does. Runs in a worker thread or process.
+    """
+    stats = {'latencies': [], 'succeeded': 0, 'failed': 0,
+             'deadlocks': 0, 'conflicts': 0, 'rejected': 0, 'retries': 0,
+             'queries': 0}
+
+    def count_query(execute, sql, params, many, context):
+        stats['queries'] += 1
+        return execute(sql, params, many, context)
+
+    factory = RequestFactory()
+    try:
+        with connection.execute_wrapper(count_query):
+            for user_pk, sender, receiver, amount in plan:
+                request = factory.post('/api/transactions/')
+                request.user = User(uuid=user_pk)
+                data = {'sender_account': sender,
+                        'receiver_account': receiver,
+                        'sent_amount': amount}
+
+                start = time.perf_counter()
+                for attempt in range(max_retries + 1):
+                    serializer = TransactionSerializer(
+                        data=data, context={'request': request})
+                    try:
+                        if serializer.is_valid():
+                            serializer.save()
+                            stats['succeeded'] += 1
+                        else:
+                            stats['failed'] += 1
+                        break
+                    except ValidationError:
+                        # The model refused it, e.g. Account.withdraw found
+                        # the balance spent by a concurrent transfer since
+                        # the serializer checked it. Retrying won't help.
+                        stats['rejected'] += 1
+                        stats['failed'] += 1
+                        break
+                    except (OperationalError, TransferConflict) as e:
+                        code = getattr(e.__cause__, 'pgcode', None)
+                        if isinstance(e, TransferConflict):
+                            # Optimistic retries ran out inside save
+                            stats['conflicts'] += 1
+                        elif code == DEADLOCK:
+                            stats['deadlocks'] += 1
+                        elif code != SERIALIZATION_FAILURE and \
+                                'locked' not in str(e):
+                            raise
+                        if attempt == max_retries:
+                            stats['failed'] += 1
+                        else:
+                            stats['retries'] += 1
+                stats['latencies'].append(time.perf_counter() - start)
+    finally:
+        connection.close()
+    return stats
+
+
+class Command(BaseCommand):
+    help = ('Load test transfers through the real serializer and save path '
+            'and print throughput, latency and contention figures as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--transfers', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--pool', choices=('thread', 'process'),
+                            default='thread')
+        parser.add_argument(
+            '--contention', choices=('uniform', 'zipf', 'hot'), nargs='+',
+            default=['uniform'],
+            help='How receivers are picked: uniformly, Zipf distributed or '
+                 'always the same hot account. Several levels are run one '
+                 'after the other.',
+        )
+        parser.add_argument(
+            '--mode', choices=('pessimistic', 'optimistic'), nargs='+',
+            help='settings.TRANSFER_CONCURRENCY to run with, the configured '
+                 'one by default. Several modes are run at every contention '
+                 'level.',
+        )
+        parser.add_argument('--zipf-s', type=float, default=1.1)
+        parser.add_argument('--max-retries', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default=None,
+                            help='Username prefix of the provisioned users')
+        parser.add_argument('--output', help='Also write the JSON here')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('At least two users are needed')
+        # The report divides by the number of transfers and needs latencies
+        if options['transfers'] < 1:
+            raise CommandError('At least one transfer is needed')
+        if options['workers'] < 1:
+            raise CommandError('At least one worker is needed')
+
+        prefix = options['prefix'] or f'bench-{int(time.time())}'
+        modes = options['mode'] or [settings.TRANSFER_CONCURRENCY]
+        reports = []
+        for contention in options['contention']:
+            for mode in modes:
+                # Fresh accounts per run, so every run starts from the same
+                # balances and the same plan
+                run = f'{prefix}-{contention}-{mode}' \
+                    if len(options['contention']) * len(modes) > 1 \
+                    else prefix
+                with override_settings(TRANSFER_CONCURRENCY=mode):
+                    reports.append(self.run(options, run, contention, mode))
+
+        output = json.dumps(reports[0] if len(reports) == 1 else reports,
+                            indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+
+    def run(self, options, prefix, contention, mode):
+        rng = random.Random(options['seed'])
+        accounts = self.provision(prefix, options['users'])
+
+        receivers = choose_receivers(
+            accounts, contention, options['transfers'], rng,
+            options['zipf_s'])
+        plan = []
+        for receiver in receivers:
+            sender = rng.choice(accounts)
+            while sender is receiver:
+                sender = rng.choice(accounts)
+            amount = Decimal(rng.randint(10, 100)) / 100
+            plan.append((sender.user_id, str(sender.uuid),
+                         str(receiver.uuid), str(amount)))
+
+        workers = options['workers']
+        chunks = [plan[i::workers] for i in range(workers)]
+        pool_class = (ProcessPoolExecutor if options['pool'] == 'process'
+                      else ThreadPoolExecutor)
+
+        # Forked workers must not share the parent's connection
+        connections.close_all()
+        start = time.perf_counter()
+        with pool_class(workers) as pool:
+            results = list(pool.map(run_transfers, chunks,
+                                    [options['max_retries']] * workers))
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency for r in results for latency in r['latencies']]
+        succeeded = sum(r['succeeded'] for r in results)
+        return {
+            'database': connection.vendor,
+            'mode': mode,
+            'users': options['users'],
+            'transfers': options['transfers'],
+            'workers': workers,
+            'pool': options['pool'],
+            'contention': contention,
+            'seed': options['seed'],
+            'seconds': round(elapsed, 3),
+            'succeeded': succeeded,
+            'failed': sum(r['failed'] for r in results),
+            'throughput': round(succeeded / elapsed, 1),
+            'latency_ms': {
+                name: round(percentile(latencies, p) * 1000, 2)
+                for name, p in (('p50', 50), ('p95', 95), ('p99', 99))
+            },
+            'deadlocks': sum(r['deadlocks'] for r in results),
+            'conflicts': sum(r['conflicts'] for r in results),
+            'rejected': sum(r['rejected'] for r in results),
+            'retries': sum(r['retries'] for r in results),
+            'queries_per_transfer': round(
+                sum(r['queries'] for r in results) / len(plan), 2),
+        }
+
+    def provision(self, prefix, count):
+        password = make_password(None)
+        users = User.objects.bulk_create(
+            User(username=f'{prefix}-{i}', password=password)
+            for i in range(count)
+        )
+        currency = Currency.objects.get(currency='USD')
+        return Account.bulk_open(
+            Account(user=user, currency=currency, balance=Decimal('1000.00'))
+            for user in users
+        )
@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.conf import IDEMPOTENCY_KEY_TTL_HOURS
+from core.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys older than their time to live'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=IDEMPOTENCY_KEY_TTL_HOURS,
+            help='Time to live of a key in hours',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help='Number of keys deleted per statement',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        expired = IdempotencyKey.objects.filter(created__lt=cutoff)
+
+        # Delete in chunks to keep each statement and its locks short
+        total = 0
+        while True:
+            ids = list(expired.values_list('pk', flat=True)
+                       [:options['chunk_size']])
+            if not ids:
+                break
+            total += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {total} idempotency keys created before '
+            f'{cutoff.isoformat()}'))
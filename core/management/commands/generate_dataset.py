@@ -0,0 +1,233 @@
+import csv
+import io
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from uuid import UUID
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+
+from core import partitions
+from core.conf import CURRENCY
+from core.models import (User, Account, Transaction, LedgerEntry,
+                         FeedEntry, TransactionRollup, CENTS)
+
+
+MAX_BALANCE = Decimal('9999.99')
+
+# Share of accounts per currency that senders pay from
+CURRENCY_WEIGHTS = {'USD': 0.7, 'EUR': 0.2, 'CNY': 0.1}
+
+# Share of transfers between two accounts of the same user
+SELF_TRANSFERS = 0.05
+
+
+class Command(BaseCommand):
+    help = ('Generate a deterministic synthetic dataset of users, accounts '
+            'and transfers for performance testing')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--transactions', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--days', type=int, default=365,
+                            help='Spread transfers over this many days')
+        parser.add_argument(
+            '--end', default='2020-01-01T00:00:00+00:00',
+            help='Date of the last transfer; fixed so runs are comparable',
+        )
+        parser.add_argument('--prefix', default='user',
+                            help='Username prefix')
+        parser.add_argument('--password', default='password',
+                            help='Password of every generated user')
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument(
+            '--no-copy', action='store_true',
+            help='Use bulk_create even on PostgreSQL instead of COPY',
+        )
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('At least two users are needed')
+
+        self.rng = random.Random(options['seed'])
+        self.use_copy = connection.vendor == 'postgresql' and \
+            not options['no_copy']
+        self.chunk_size = options['chunk_size']
+        end = datetime.fromisoformat(options['end']).astimezone(timezone.utc)
+        start = end - timedelta(days=options['days'])
+
+        started = time.perf_counter()
+        # Monthly partitions for the whole range instead of the default one
+        partitions.ensure_partitions(start, end + timedelta(microseconds=1))
+        users, accounts = self.generate_accounts(options, start)
+        count = self.generate_transactions(
+            users, accounts, options['transactions'], start, end)
+
+        with transaction.atomic():
+            Account.objects.bulk_update(
+                [a for user_accounts in accounts for a in user_accounts],
+                ['balance'], batch_size=self.chunk_size)
+            # Transfers were inserted directly, bypassing Transaction.save
+            TransactionRollup.rebuild()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(json.dumps({
+            'seed': options['seed'],
+            'users': len(users),
+            'accounts': len(users) * len(CURRENCY),
+            'transactions': count,
+            'method': 'copy' if self.use_copy else 'bulk_create',
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(count / elapsed, 1),
+        }, indent=2))
+
+    def uuid(self):
+        return UUID(int=self.rng.getrandbits(128), version=4)
+
+    def amount(self, median, limit):
+        # Log-normal amounts: many small payments, a long tail of large ones
+        value = Decimal(self.rng.lognormvariate(math.log(median), 1.0))
+        return min(max(value.quantize(CENTS), CENTS), limit)
+
+    def generate_accounts(self, options, start):
+        password = make_password(options['password'])
+        users = []
+        accounts = []
+        opening = []
+        for i in range(options['users']):
+            user = User(uuid=self.uuid(), username=f'{options["prefix"]}{i}',
+                        password=password, date_joined=start)
+            users.append(user)
+
+            user_accounts = []
+            for cur in CURRENCY:
+                balance = self.amount(
+                    200 if cur == 'USD' else 50, MAX_BALANCE / 2)
+                account = Account(uuid=self.uuid(), user=user,
+                                  currency_id=cur, balance=balance)
+                user_accounts.append(account)
+                opening.append(LedgerEntry(account=account, amount=balance,
+                                           created=start))
+            accounts.append(user_accounts)
+
+        with transaction.atomic():
+            self.insert(User, users)
+            self.insert(Account, [a for ua in accounts for a in ua])
+            self.insert(LedgerEntry, opening)
+        return users, accounts
+
+    def generate_transactions(self, users, accounts, count, start, end):
+        last_id = Transaction.objects.aggregate(Max('id'))['id__max']
+        next_id = (last_id or 0) + 1
+
+        currencies = list(CURRENCY_WEIGHTS)
+        weights = list(CURRENCY_WEIGHTS.values())
+        span = (end - start) / max(1, math.ceil(count / self.chunk_size))
+
+        # Transfers the sender can't afford, or that would overflow the
+        # receiver's balance, are dropped, so a few less than count are made
+        attempted = written = 0
+        chunk_start = start
+        while attempted < count:
+            size = min(self.chunk_size, count - attempted)
+            dates = sorted(chunk_start + span * self.rng.random()
+                           for _ in range(size))
+            chunk_start += span
+
+            transfers, entries, feed = [], [], []
+            for date in dates:
+                sender_index = self.rng.randrange(len(users))
+                cur = self.rng.choices(currencies, weights)[0]
+                sender = accounts[sender_index][currencies.index(cur)]
+
+                if self.rng.random() < SELF_TRANSFERS:
+                    receiver = self.rng.choice(
+                        [a for a in accounts[sender_index] if a is not sender])
+                else:
+                    receiver_index = self.rng.randrange(len(users) - 1)
+                    if receiver_index >= sender_index:
+                        receiver_index += 1
+                    # Most payments stay in the sender's currency
+                    if self.rng.random() < 0.8:
+                        receiver = accounts[receiver_index][
+                            currencies.index(cur)]
+                    else:
+                        receiver = self.rng.choice(accounts[receiver_index])
+
+                if sender.balance < 1:
+                    continue
+                t = Transaction(
+                    id=next_id, sender_account=sender,
+                    receiver_account=receiver, transaction_date=date,
+                    sent_amount=self.amount(20, sender.balance))
+                t.calculate()
+                if receiver.balance + t.received_amount > MAX_BALANCE:
+                    continue
+
+                sender.balance -= t.sent_amount
+                receiver.balance += t.received_amount
+                transfers.append(t)
+                for entry in t.get_ledger_entries():
+                    entry.created = date
+                    entries.append(entry)
+                feed.extend(FeedEntry.for_transaction(t))
+                next_id += 1
+
+            with transaction.atomic():
+                self.insert(Transaction, transfers)
+                self.insert(LedgerEntry, entries)
+                self.insert(FeedEntry, feed)
+            attempted += size
+            written += len(transfers)
+            self.stderr.write(f'{attempted}/{count} transfers generated')
+
+        # Ids were set explicitly with COPY and bulk_create alike, and the
+        # partitioned table's (id, transaction_date) key wouldn't catch
+        # the sequence handing them out again
+        if connection.vendor == 'postgresql':
+            self.reset_sequences(Transaction)
+        return written
+
+    def insert(self, model, objs):
+        if not self.use_copy:
+            # Django 2.2 doesn't cap batch_size at what the backend accepts
+            fields = model._meta.concrete_fields
+            batch_size = min(self.chunk_size,
+                             connection.ops.bulk_batch_size(fields, objs))
+            model.objects.bulk_create(objs, batch_size=max(1, batch_size))
+            return
+
+        fields = [f for f in model._meta.concrete_fields
+                  if f.attname != 'id' or objs and objs[0].pk is not None]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for obj in objs:
+            row = []
+            for f in fields:
+                value = f.get_db_prep_save(getattr(obj, f.attname),
+                                           connection)
+                row.append('\\N' if value is None else value)
+            writer.writerow(row)
+        buffer.seek(0)
+
+        columns = ', '.join(connection.ops.quote_name(f.column)
+                            for f in fields)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {model._meta.db_table} ({columns}) '
+                f"FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+    def reset_sequences(self, *models):
+        with connection.cursor() as cursor:
+            for model in models:
+                table = model._meta.db_table
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f'(SELECT MAX(id) FROM {table}))')
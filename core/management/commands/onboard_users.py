@@ -0,0 +1,44 @@
+import csv
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.conf import ONBOARDING_CHUNK_SIZE
+from core.onboarding import onboard, READERS
+
+
+class Command(BaseCommand):
+    help = ('Create users and their accounts from a CSV or JSON lines file '
+            'with username and password columns')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--format', choices=sorted(READERS),
+            help='File format, guessed from the extension by default',
+        )
+        parser.add_argument('--chunk-size', type=int,
+                            default=ONBOARDING_CHUNK_SIZE)
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='Password hashing processes, one per CPU by default, 0 to '
+                 'hash in this process',
+        )
+
+    def handle(self, *args, **options):
+        format = options['format'] or \
+            os.path.splitext(options['path'])[1].lstrip('.')
+        if format not in READERS:
+            raise CommandError(f'Unknown format {format}, use --format')
+
+        try:
+            with open(options['path'], newline='', encoding='utf-8') as lines:
+                onboarding = onboard(lines, format,
+                                     chunk_size=options['chunk_size'],
+                                     processes=options['processes'])
+        except (UnicodeDecodeError, csv.Error) as e:
+            # Chunks before the broken line are already committed
+            raise CommandError(f'Could not read {options["path"]}: {e}')
+
+        self.stdout.write(json.dumps(onboarding.report(), indent=2))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.conf import TRANSFER_QUEUE_BATCH_SIZE
+from core.models import TransferRequest
+
+
+class Command(BaseCommand):
+    help = 'Apply queued asynchronous transfers in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=TRANSFER_QUEUE_BATCH_SIZE,
+            help='Number of queued transfers applied per database transaction',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=1.0,
+            help='Seconds to wait when the queue is empty',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Drain the queue and exit instead of polling forever',
+        )
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        while True:
+            processed = TransferRequest.process_batch(options['batch_size'])
+            for request in processed:
+                if request.status == TransferRequest.DONE:
+                    done += 1
+                else:
+                    failed += 1
+
+            if not processed:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {done + failed} transfers: '
+            f'{done} done, {failed} failed'))
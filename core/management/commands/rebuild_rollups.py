@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.models import TransactionRollup
+
+
+class Command(BaseCommand):
+    help = ('Recompute the per-user reporting rollups from all transactions, '
+            'archived ones included')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of rollups inserted per statement',
+        )
+
+    def handle(self, *args, **options):
+        rollups = TransactionRollup.rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(rollups)} rollups'))
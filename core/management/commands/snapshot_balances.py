@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.conf import SNAPSHOT_LAG_SECONDS
+from core.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Snapshot the balance of every account with new ledger entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lag', type=int, default=SNAPSHOT_LAG_SECONDS,
+            help='Only include ledger entries older than this many seconds',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['lag'])
+        snapshots = BalanceSnapshot.take(cutoff)
+        self.stdout.write(self.style.SUCCESS(
+            f'Took {len(snapshots)} snapshots as of {cutoff.isoformat()}'))
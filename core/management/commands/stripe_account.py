@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Spread deposits to an account over N stripes (0 turns it off)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account', help='Account uuid')
+        parser.add_argument('stripes', type=int, help='Number of stripes')
+
+    def handle(self, *args, **options):
+        if options['stripes'] < 0:
+            raise CommandError('Number of stripes can not be negative')
+        try:
+            Account.set_stripes(options['account'], options['stripes'])
+        except Account.DoesNotExist:
+            raise CommandError(f'Account {options["account"]} does not exist')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Account {options["account"]} now has '
+            f'{options["stripes"]} stripes'))
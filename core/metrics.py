@@ -0,0 +1,201 @@
+"""
+Low-overhead in-process request metrics, exposed in Prometheus text format.
+
+MetricsMiddleware records for every endpoint the total latency, the number
+of queries and the time spent in the database (through an execute_wrapper on
+every connection) and the time spent turning objects into primitive data in
+DRF serializers (through TimedSerializerMixin). Each figure goes into a
+fixed-bucket histogram per endpoint and method.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger('core.slow_requests')
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+METRICS = (
+    ('request_duration_seconds', 'Total request latency', SECONDS_BUCKETS),
+    ('db_duration_seconds', 'Time spent in database queries per request',
+     SECONDS_BUCKETS),
+    ('db_queries', 'Database queries per request', COUNT_BUCKETS),
+    ('serialization_duration_seconds',
+     'Time spent in DRF serializers per request', SECONDS_BUCKETS),
+)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            yield format(bound, 'g'), cumulative
+        yield '+Inf', count
+        yield 'sum', total
+        yield 'count', count
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, buckets, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        histogram.observe(value)
+
+    def render(self, prefix='payments_'):
+        lines = []
+        for name, description, _ in METRICS:
+            metric = prefix + name
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} histogram')
+            for (hist_name, labels), histogram in sorted(
+                    self.histograms.items()):
+                if hist_name != name:
+                    continue
+                label = ','.join(f'{k}="{v}"' for k, v in labels)
+                for le, value in histogram.samples():
+                    if le in ('sum', 'count'):
+                        lines.append(f'{metric}_{le}{{{label}}} {value}')
+                    else:
+                        lines.append(
+                            f'{metric}_bucket{{{label},le="{le}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class RequestMetrics:
+    def __init__(self, record_sql):
+        self.queries = 0
+        self.db_time = 0
+        self.serialization_time = 0
+        self.serializing = False
+        self.statements = [] if record_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.db_time += elapsed
+            if self.statements is not None:
+                self.statements.append((elapsed, sql))
+
+
+class TimedSerializerMixin:
+    """
+    Adds the time spent in the outermost to_representation call of a
+    serializer to the current request's metrics
+    """
+
+    def to_representation(self, instance):
+        metrics = _current.get()
+        if metrics is None or metrics.serializing:
+            return super().to_representation(instance)
+
+        metrics.serializing = True
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serialization_time += time.perf_counter() - start
+            metrics.serializing = False
+
+
+def endpoint(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unresolved'
+
+
+@contextmanager
+def collect(record_sql=False):
+    """
+    Record the queries and serialization time of the current thread into
+    the RequestMetrics it yields
+    """
+    metrics = RequestMetrics(record_sql)
+    token = _current.set(metrics)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics))
+            yield metrics
+    finally:
+        _current.reset(token)
+
+
+def observe(endpoint_name, method, elapsed, metrics):
+    labels = (('endpoint', endpoint_name), ('method', method))
+    for (name, _, buckets), value in zip(METRICS, (
+            elapsed, metrics.db_time, metrics.queries,
+            metrics.serialization_time)):
+        registry.observe(name, buckets, labels, value)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request_seconds = getattr(
+            settings, 'SLOW_REQUEST_SECONDS', None)
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with collect(self.slow_request_seconds is not None) as metrics:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        observe(endpoint(request), request.method, elapsed, metrics)
+
+        if self.slow_request_seconds is not None and \
+                elapsed >= self.slow_request_seconds:
+            self.log_slow_request(request, response, elapsed, metrics)
+        return response
+
+    def log_slow_request(self, request, response, elapsed, metrics):
+        statements = '\n'.join(
+            f'  {duration * 1000:.1f} ms  {sql}'
+            for duration, sql in metrics.statements)
+        logger.warning(
+            'Slow request %s %s -> %s: %.1f ms, %d queries in %.1f ms, '
+            'serialization %.1f ms\n%s',
+            request.method, request.get_full_path(), response.status_code,
+            elapsed * 1000, metrics.queries, metrics.db_time * 1000,
+            metrics.serialization_time * 1000, statements)
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['sender_account', 'transaction_date', 'id'], name='core_tx_sender_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['receiver_account', 'transaction_date', 'id'], name='core_tx_receiver_date_idx'),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def backfill_ledger(apps, schema_editor):
+    """
+    One entry per side of every existing transaction, plus an opening entry
+    holding whatever part of the current balance the transactions don't
+    explain (initial balances)
+    """
+    Account = apps.get_model('core', 'Account')
+    Transaction = apps.get_model('core', 'Transaction')
+    LedgerEntry = apps.get_model('core', 'LedgerEntry')
+
+    opened = Transaction.objects.aggregate(
+        first=models.Min('transaction_date'))['first']
+    movements = {}
+    entries = []
+    transfers = Transaction.objects.order_by('transaction_date', 'id')
+    for t in transfers.iterator(chunk_size=2000):
+        entries.append(LedgerEntry(
+            account_id=t.sender_account_id, transaction_id=t.id,
+            amount=-t.sent_amount, created=t.transaction_date))
+        entries.append(LedgerEntry(
+            account_id=t.receiver_account_id, transaction_id=t.id,
+            amount=t.received_amount, created=t.transaction_date))
+        movements[t.sender_account_id] = \
+            movements.get(t.sender_account_id, 0) - t.sent_amount
+        movements[t.receiver_account_id] = \
+            movements.get(t.receiver_account_id, 0) + t.received_amount
+
+        if len(entries) >= 2000:
+            LedgerEntry.objects.bulk_create(entries)
+            entries = []
+    LedgerEntry.objects.bulk_create(entries)
+
+    LedgerEntry.objects.bulk_create((
+        LedgerEntry(account_id=a.uuid, created=opened or django.utils.timezone.now(),
+                    amount=a.balance - movements.get(a.uuid, 0))
+        for a in Account.objects.iterator(chunk_size=2000)
+    ), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_transaction_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ledger_entries', to='core.Account')),
+                ('transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='ledger_entries', to='core.Transaction')),
+            ],
+            options={
+                'verbose_name_plural': 'Ledger entries',
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('taken_at', models.DateTimeField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='core.Account')),
+            ],
+            options={
+                'get_latest_by': 'taken_at',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['account', 'created'], name='core_ledger_account_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='balancesnapshot',
+            index=models.Index(fields=['account', 'taken_at'], name='core_snapshot_account_idx'),
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
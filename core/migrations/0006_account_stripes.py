@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_transfer_requests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='stripe_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='AccountStripe',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=6)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stripes', to='core.Account')),
+            ],
+            options={
+                'unique_together': {('account', 'index')},
+            },
+        ),
+    ]
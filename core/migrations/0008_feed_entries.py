@@ -0,0 +1,93 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_feed(apps, schema_editor):
+    """
+    One feed entry per row of the User.transactions table
+    """
+    User = apps.get_model('core', 'User')
+    FeedEntry = apps.get_model('core', 'FeedEntry')
+
+    links = User.transactions.through.objects.select_related(
+        'transaction__sender_account__user',
+        'transaction__receiver_account__user',
+    ).order_by('id')
+    entries = []
+    for link in links.iterator(chunk_size=2000):
+        t = link.transaction
+        sender = t.sender_account.user
+        receiver = t.receiver_account.user
+        if sender.pk == receiver.pk:
+            direction, counterparty = 'self', sender.username
+        elif link.user_id == sender.pk:
+            direction, counterparty = 'sent', receiver.username
+        else:
+            direction, counterparty = 'received', sender.username
+
+        entries.append(FeedEntry(
+            user_id=link.user_id, transaction_id=t.id, direction=direction,
+            counterparty_username=counterparty,
+            transaction_date=t.transaction_date,
+            sender_account_id=t.sender_account_id,
+            receiver_account_id=t.receiver_account_id,
+            sent_amount=t.sent_amount, received_amount=t.received_amount,
+            commission=t.commission, sender_currency=t.sender_currency,
+            receiver_currency=t.receiver_currency,
+            commission_rate=t.commission_rate,
+            conversion_rate=t.conversion_rate))
+
+        if len(entries) >= 2000:
+            FeedEntry.objects.bulk_create(entries)
+            entries = []
+    FeedEntry.objects.bulk_create(entries)
+
+
+def restore_user_transactions(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    FeedEntry = apps.get_model('core', 'FeedEntry')
+    through = User.transactions.through
+
+    through.objects.bulk_create((
+        through(user_id=user_id, transaction_id=transaction_id)
+        for user_id, transaction_id in FeedEntry.objects.order_by('id')
+        .values_list('user_id', 'transaction_id').iterator(chunk_size=2000)
+    ), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_transaction_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[('sent', 'Sent'), ('received', 'Received'), ('self', 'Between own accounts')], max_length=8)),
+                ('counterparty_username', models.CharField(max_length=100)),
+                ('transaction_date', models.DateTimeField()),
+                ('sent_amount', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('received_amount', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('commission', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('sender_currency', models.CharField(max_length=3)),
+                ('receiver_currency', models.CharField(max_length=3)),
+                ('commission_rate', models.FloatField()),
+                ('conversion_rate', models.FloatField()),
+                ('receiver_account', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.Account')),
+                ('sender_account', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.Account')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='core.Transaction')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='feed', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='feedentry',
+            index=models.Index(fields=['user', '-transaction_date', '-id'], name='core_feed_user_date_idx'),
+        ),
+        migrations.RunPython(backfill_feed, restore_user_transactions),
+    ]
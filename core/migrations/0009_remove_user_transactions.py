@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:49
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_feed_entries'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='transactions',
+        ),
+    ]
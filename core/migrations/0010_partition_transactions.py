@@ -0,0 +1,137 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:57
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+TABLE = 'core_transaction'
+
+# Partitions created up front past the current month; archive_transactions
+# keeps creating them ahead from then on
+AHEAD_MONTHS = 3
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def supports_partitioning(schema_editor):
+    connection = schema_editor.connection
+    # Primary keys on partitioned tables need PostgreSQL 11
+    return connection.vendor == 'postgresql' and \
+        connection.pg_version >= 110000
+
+
+def create_constraints(cursor):
+    """
+    What Django created on the plain table: indexes and foreign keys
+    """
+    for name, columns in (
+            ('core_tx_sender_date_idx',
+             'sender_account_id, transaction_date, id'),
+            ('core_tx_receiver_date_idx',
+             'receiver_account_id, transaction_date, id'),
+            (f'{TABLE}_sender_account_id_idx', 'sender_account_id'),
+            (f'{TABLE}_receiver_account_id_idx', 'receiver_account_id'),
+            (f'{TABLE}_transaction_type_id_idx', 'transaction_type_id')):
+        cursor.execute(f'CREATE INDEX {name} ON {TABLE} ({columns})')
+    for column, target in (
+            ('sender_account_id', 'core_account (uuid)'),
+            ('receiver_account_id', 'core_account (uuid)'),
+            ('transaction_type_id', 'core_transactiontype (transaction_type)')):
+        cursor.execute(
+            f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_{column}_fk '
+            f'FOREIGN KEY ({column}) REFERENCES {target} '
+            f'DEFERRABLE INITIALLY DEFERRED')
+
+
+def rebuild_table(cursor, options='', primary_key='id', add_partitions=None):
+    """
+    Replace the transaction table with a copy created with ``options``,
+    keeping its rows, id sequence, indexes and foreign keys
+    """
+    cursor.execute(f'CREATE TABLE {TABLE}_new (LIKE {TABLE} '
+                   f'INCLUDING DEFAULTS) {options}')
+    if add_partitions is not None:
+        add_partitions(f'{TABLE}_new')
+    cursor.execute(f'INSERT INTO {TABLE}_new SELECT * FROM {TABLE}')
+    cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}_new.id')
+    cursor.execute(f'DROP TABLE {TABLE} CASCADE')
+    cursor.execute(f'ALTER TABLE {TABLE}_new RENAME TO {TABLE}')
+    cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey '
+                   f'PRIMARY KEY ({primary_key})')
+    create_constraints(cursor)
+
+
+def partition_transactions(apps, schema_editor):
+    """
+    Turn core_transaction into a table partitioned by month of
+    transaction_date, with a default partition for rows outside every
+    month. The primary key of a partitioned table must include the
+    partition key, so it becomes (id, transaction_date).
+    """
+    if not supports_partitioning(schema_editor):
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'SELECT min(transaction_date) FROM {TABLE}')
+        now = datetime.now(timezone.utc)
+        oldest = cursor.fetchone()[0] or now
+        first = datetime(oldest.year, oldest.month, 1, tzinfo=timezone.utc)
+        end = add_months(now.replace(day=1, hour=0, minute=0, second=0,
+                                     microsecond=0), AHEAD_MONTHS + 1)
+
+        def add_partitions(table):
+            cursor.execute(
+                f'CREATE TABLE {TABLE}_default PARTITION OF {table} DEFAULT')
+            month = first
+            while month < end:
+                following = add_months(month, 1)
+                cursor.execute(
+                    f'CREATE TABLE {TABLE}_p{month:%Y%m} PARTITION OF {table} '
+                    f'FOR VALUES FROM (%s) TO (%s)', [month, following])
+                month = following
+
+        rebuild_table(cursor, 'PARTITION BY RANGE (transaction_date)',
+                      'id, transaction_date', add_partitions)
+
+
+def unpartition_transactions(apps, schema_editor):
+    if not supports_partitioning(schema_editor):
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class '
+                       'WHERE relname = %s AND pg_table_is_visible(oid)',
+                       [TABLE])
+        if cursor.fetchone()[0] == 'p':
+            rebuild_table(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_remove_user_transactions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='feedentry',
+            name='transaction',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='core.Transaction'),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='transaction',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='ledger_entries', to='core.Transaction'),
+        ),
+        migrations.AlterField(
+            model_name='transferrequest',
+            name='result',
+            field=models.OneToOneField(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='request', to='core.Transaction'),
+        ),
+        migrations.RunPython(partition_transactions, unpartition_transactions),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_partition_transactions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='accountstripe',
+            name='version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,30 +1,74 @@
-from uuid import uuid4
+import random
+import time
+from functools import partial
+from itertools import count
+from uuid import UUID, uuid4
 from decimal import Decimal
 from datetime import datetime
 
 from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import F, Sum, Max, Count, OuterRef, Subquery, Value
+from django.db.models.functions import (Coalesce, Least, TruncDay,
+                                        TruncMonth)
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import UserManager as DjangoUserManager
 from django.conf import settings
 
+from . import events, reference
+from .routers import pin_to_primary
 from .conf import (FUNDS_TRANSFER_TO_SELF, FUNDS_TRANSFER_TO_OTHER, CURRENCY,
-                   MIN_BALANCE)
+                   MIN_BALANCE, CENTS, OPTIMISTIC_RETRIES,
+                   OPTIMISTIC_BACKOFF_SECONDS)
+
+# Round-robin over the stripes of striped accounts
+_stripe_sequence = count()
+
+
+class TransferConflict(Exception):
+    """
+    An optimistic transfer found its sender changed on every attempt
+    """
+
+
+class UserQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        updated = super().update(**kwargs)
+        # No post_save here, so drop the cached users of all processes
+        if updated:
+            from .authentication import bump_generation
+            transaction.on_commit(bump_generation)
+        return updated
+
+
+class UserManager(DjangoUserManager.from_queryset(UserQuerySet)):
+    pass
 
 
 class User(AbstractUser):
     uuid = models.UUIDField(default=uuid4, primary_key=True)
     username = models.CharField(max_length=100, unique=True)
     USERNAME_FIELD = 'username'
-    transactions = models.ManyToManyField('Transaction')
+
+    objects = UserManager()
 
     def get_accounts(self):
-        return self.account.all()
+        return self.account.with_striped_balance()
 
     def __str__(self):
         return self.username
 
 
+class AccountQuerySet(models.QuerySet):
+    def with_striped_balance(self):
+        return self.annotate(striped_balance=Coalesce(
+            Sum('stripes__balance'), Value(0),
+            output_field=models.DecimalField(max_digits=8, decimal_places=2)
+        ))
+
+
 class Account(models.Model):
     uuid = models.UUIDField(default=uuid4, primary_key=True)
     currency = models.ForeignKey('Currency', on_delete=models.CASCADE)
@@ -37,32 +81,183 @@ class Account(models.Model):
         related_name='account'
     )
 
+    # Striped accounts take deposits on this many AccountStripe rows
+    # instead of their own row; 0 means not striped
+    stripe_count = models.PositiveSmallIntegerField(default=0)
+
+    # Bumped by every change of the row's balance, see core.etags. Not
+    # indexed, so balance updates stay heap-only on PostgreSQL.
+    version = models.BigIntegerField(default=0, editable=False)
+
+    objects = AccountQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+
+        # Edits made outside deposit and withdraw, e.g. in the admin
+        self.version = F('version') + 1
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
+    # Balances are changed with a single conditional UPDATE each, the row
+    # lock is taken by the UPDATE itself and only the balance and version
+    # columns are written
     @classmethod
-    @transaction.atomic
-    def deposit(cls, uuid, amount):
-        account = cls.objects.select_for_update().get(uuid=uuid)
-        account.balance += amount
-        account.save()
+    def deposit(cls, uuid, amount, stripe_count=0):
+        amount = Decimal(amount).quantize(CENTS)
+
+        if stripe_count:
+            index = next(_stripe_sequence) % stripe_count
+            updated = AccountStripe.objects.filter(
+                account=uuid, index=index
+            ).update(balance=F('balance') + amount,
+                     version=F('version') + 1)
+            if updated:
+                return
+
+        updated = cls.objects.filter(uuid=uuid).update(
+            balance=F('balance') + amount, version=F('version') + 1)
+
+        if not updated:
+            raise ValidationError('Account does not exist')
 
     @classmethod
-    @transaction.atomic
     def withdraw(cls, uuid, amount):
-        account = cls.objects.select_for_update().get(uuid=uuid)
+        amount = Decimal(amount).quantize(CENTS)
+        account = cls.objects.filter(
+            uuid=uuid, balance__gte=amount + MIN_BALANCE)
+        updated = account.update(balance=F('balance') - amount,
+                                 version=F('version') + 1)
+
+        # Funds of a striped account may still sit in its stripes
+        if not updated and cls.consolidate(uuid):
+            updated = account.update(balance=F('balance') - amount,
+                                     version=F('version') + 1)
 
-        if account.balance < amount:
+        if not updated:
             raise ValidationError('Insufficient funds')
-        account.balance -= amount
-        account.save()
 
-        return account
+    @classmethod
+    def compare_and_swap(cls, uuid, version, amount):
+        """
+        Add ``amount`` to the balance if the row is still at ``version``.
+        Returns whether it was.
+        """
+        amount = Decimal(amount).quantize(CENTS)
+        return bool(cls.objects.filter(uuid=uuid, version=version).update(
+            balance=F('balance') + amount, version=version + 1))
+
+    @classmethod
+    @transaction.atomic
+    def consolidate(cls, uuid):
+        """
+        Move the balance of all stripes into the account row. Returns the
+        amount moved.
+        """
+        stripes = list(
+            AccountStripe.objects.select_for_update()
+            .filter(account=uuid).exclude(balance=0)
+        )
+        if not stripes:
+            return 0
+
+        total = sum(s.balance for s in stripes)
+        AccountStripe.objects.filter(pk__in=[s.pk for s in stripes]) \
+            .update(balance=0)
+        cls.objects.filter(uuid=uuid).update(balance=F('balance') + total,
+                                             version=F('version') + 1)
+        return total
+
+    @classmethod
+    @transaction.atomic
+    def set_stripes(cls, uuid, stripe_count):
+        """
+        Turn striping on (``stripe_count`` > 0), resize it or turn it off
+        """
+        cls.objects.select_for_update().get(uuid=uuid)
+        cls.consolidate(uuid)
+
+        AccountStripe.objects.filter(account=uuid,
+                                     index__gte=stripe_count).delete()
+        existing = set(AccountStripe.objects.filter(account=uuid)
+                       .values_list('index', flat=True))
+        AccountStripe.objects.bulk_create(
+            AccountStripe(account_id=uuid, index=i, balance=0)
+            for i in range(stripe_count) if i not in existing
+        )
+        # Dropped stripes take their versions along, so bump the account's
+        cls.objects.filter(uuid=uuid).update(stripe_count=stripe_count,
+                                             version=F('version') + 1)
+
+    @classmethod
+    def bulk_open(cls, accounts, batch_size=None):
+        """
+        Insert new accounts together with their opening ledger entries,
+        which bulk_create would otherwise skip along with post_save
+        """
+        accounts = cls.objects.bulk_create(accounts, batch_size=batch_size)
+        LedgerEntry.objects.bulk_create((
+            LedgerEntry(account=a, amount=a.balance) for a in accounts
+        ), batch_size=batch_size)
+        return accounts
+
+    @property
+    def total_balance(self):
+        if not self.stripe_count:
+            return self.balance
+
+        striped = getattr(self, 'striped_balance', None)
+        if striped is None:
+            striped = self.stripes.aggregate(
+                total=Sum('balance'))['total'] or 0
+        return self.balance + striped
 
     def get_username(self):
         return self.user.username
 
+    def get_balance_at(self, ts):
+        """
+        Balance right after everything booked up to ``ts``: the latest
+        snapshot before ``ts`` plus the ledger entries since
+        """
+        entries = self.ledger_entries.filter(created__lte=ts)
+        balance = Decimal('0.00')
+
+        snapshot = self.snapshots.filter(taken_at__lte=ts) \
+            .order_by('-taken_at').first()
+        if snapshot is not None:
+            entries = entries.filter(created__gt=snapshot.taken_at)
+            balance = snapshot.balance
+
+        total = entries.aggregate(total=Sum('amount'))['total']
+        return balance + (total or 0)
+
     def __str__(self):
         return f'{self.user} - {self.currency.currency} : {self.balance}'
 
 
+class AccountStripe(models.Model):
+    """
+    Sub-balance of a striped account. Spreading deposits over several rows
+    spreads their row locks, so a hot receiving account is not limited by
+    the throughput of a single row.
+    """
+
+    account = models.ForeignKey(
+        Account, related_name='stripes', on_delete=models.CASCADE
+    )
+    index = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=6, decimal_places=2, default=0)
+    version = models.BigIntegerField(default=0, editable=False)
+
+    def __str__(self):
+        return f'{self.account} #{self.index}: {self.balance}'
+
+    class Meta:
+        unique_together = ('account', 'index')
+
+
 class Currency(models.Model):
     CURRENCY_CHOICES = (
         (CURRENCY['USD'], 'US Dollar'),
@@ -148,20 +343,15 @@ class Transaction(models.Model):
         return self.receiver_account.user.username
 
     def get_transaction_type(self):
-        if self.sender_account.user != self.receiver_account.user:
+        if self.sender_account.user_id != self.receiver_account.user_id:
             t = FUNDS_TRANSFER_TO_OTHER
         else:
             t = FUNDS_TRANSFER_TO_SELF
-        return TransactionType.objects.get(transaction_type=t)
+        return reference.get_transaction_type(t)
 
     def get_conversion_rate(self):
-        if self.sender_currency != self.receiver_currency:
-            conversion_rate = CurrencyConversionRate.objects.get(
-                from_currency=self.sender_account.currency,
-                to_currency=self.receiver_currency).conversion_rate
-        else:
-            conversion_rate = 1
-        return Decimal(conversion_rate)
+        return reference.get_conversion_rate(self.sender_currency,
+                                             self.receiver_currency)
 
     def get_commission_rate(self):
         return Decimal(self.transaction_type.commission_rate)
@@ -174,22 +364,727 @@ class Transaction(models.Model):
     def get_received_amount(self):
         return self.sent_amount * self.get_conversion_rate() - self.commission
 
-    @transaction.atomic
-    def save(self, *args, **kwargs):
+    def calculate(self):
         self.transaction_type = self.get_transaction_type()
-        self.sender_currency = self.sender_account.currency.currency
-        self.receiver_currency = self.receiver_account.currency.currency
+        self.sender_currency = self.sender_account.currency_id
+        self.receiver_currency = self.receiver_account.currency_id
         self.commission_rate = self.transaction_type.commission_rate
         self.commission = self.get_commission()
         self.conversion_rate = self.get_conversion_rate()
-        self.received_amount = self.get_received_amount()
+        self.received_amount = self.get_received_amount().quantize(CENTS)
 
-        Account.withdraw(uuid=self.sender_account.uuid, amount=self.sent_amount)
-        Account.deposit(uuid=self.receiver_account.uuid, amount=self.received_amount)
+    def save(self, *args, **kwargs):
+        # Saving again would move the balances again
+        if not self._state.adding:
+            raise ValidationError('Transactions can not be changed')
 
+        # The feed entries need both users, load them before any row lock
+        # unless the accounts came with them
+        self.sender_account.user
+        self.receiver_account.user
+
+        if settings.TRANSFER_CONCURRENCY == 'optimistic':
+            return self.save_optimistic(*args, **kwargs)
+        return self.save_pessimistic(*args, **kwargs)
+
+    @transaction.atomic
+    def save_pessimistic(self, *args, **kwargs):
+        self.calculate()
+
+        # Always touch the two rows in uuid order, so that concurrent
+        # A -> B and B -> A transfers wait on each other instead of deadlocking
+        moves = sorted((
+            (self.sender_account.uuid, Account.withdraw, self.sent_amount),
+            (self.receiver_account.uuid, partial(
+                Account.deposit,
+                stripe_count=self.receiver_account.stripe_count
+            ), self.received_amount),
+        ), key=lambda move: move[0])
+        for uuid, move, amount in moves:
+            move(uuid=uuid, amount=amount)
+
+        self.record(*args, **kwargs)
+
+    def save_optimistic(self, *args, **kwargs):
+        """
+        Check the sender's balance without a lock and outside of a
+        transaction, then write the transfer's rows and move the balances
+        last, so account rows stay locked only until the commit right
+        after. The sender's balance moves with a compare-and-swap on the
+        version read: if another transfer changed it in between, the
+        attempt is rolled back and retried after a jittered backoff, up to
+        OPTIMISTIC_RETRIES times.
+        """
+        self.calculate()
+        for attempt in range(OPTIMISTIC_RETRIES + 1):
+            if attempt:
+                time.sleep(random.uniform(
+                    0, OPTIMISTIC_BACKOFF_SECONDS * 2 ** attempt))
+            version = self.check_balance()
+            try:
+                # A transaction of its own, or a savepoint in the caller's
+                with transaction.atomic():
+                    return self.swap_balances(version, *args, **kwargs)
+            except TransferConflict:
+                self.pk = None
+                self._state.adding = True
+        raise TransferConflict(
+            f'Account {self.sender_account.uuid} is changing too often')
+
+    def check_balance(self):
+        """
+        The version of the sender at which it can afford the transfer
+        """
+        sender = self.sender_account
+        versions = Account.objects.filter(uuid=sender.uuid) \
+            .values_list('balance', 'version')
+        balance, version = versions.get()
+        # Funds of a striped account may still sit in its stripes
+        if balance - self.sent_amount < MIN_BALANCE and \
+                sender.stripe_count and Account.consolidate(sender.uuid):
+            balance, version = versions.get()
+        if balance - self.sent_amount < MIN_BALANCE:
+            raise ValidationError('Insufficient funds')
+        return version
+
+    def swap_balances(self, version, *args, **kwargs):
+        self.record(*args, **kwargs)
+
+        # Deposits need no check, so only the sender's update can miss;
+        # still in uuid order against deadlocks
+        sender = self.sender_account.uuid
+        receiver = self.receiver_account.uuid
+        for uuid in sorted({sender, receiver}):
+            if uuid == sender and not Account.compare_and_swap(
+                    sender, version, -self.sent_amount):
+                raise TransferConflict(f'Account {sender} has changed')
+            if uuid == receiver:
+                Account.deposit(
+                    receiver, self.received_amount,
+                    stripe_count=self.receiver_account.stripe_count)
+
+    def record(self, *args, **kwargs):
+        """
+        Write the transfer with its ledger and feed entries and rollups
+        """
         super().save(*args, **kwargs)
+        LedgerEntry.objects.bulk_create(self.get_ledger_entries())
+        FeedEntry.objects.bulk_create(FeedEntry.for_transaction(self))
+        TransactionRollup.record([self])
+        users = {self.sender_account.user_id, self.receiver_account.user_id}
+        transaction.on_commit(partial(pin_to_primary, users))
+        transaction.on_commit(partial(
+            events.publish, [(user_id, self.pk) for user_id in users]))
+
+    def get_ledger_entries(self):
+        return [
+            LedgerEntry(account=self.sender_account, transaction=self,
+                        amount=-self.sent_amount),
+            LedgerEntry(account=self.receiver_account, transaction=self,
+                        amount=self.received_amount),
+        ]
+
+    @classmethod
+    @transaction.atomic
+    def transfer_batch(cls, transfers, user=None):
+        """
+        Apply many transfers in one database transaction.
+
+        Every involved account is locked exactly once, in sorted uuid order,
+        so concurrent batches always acquire their locks in the same order
+        and can not deadlock each other. Balances are then moved in memory
+        and written back with a single bulk update.
+
+        ``transfers`` is a list of dicts with ``sender_account``,
+        ``receiver_account`` (account uuids) and ``sent_amount``. If ``user``
+        is given, every sender account must belong to them. Returns one item
+        per transfer: either the created Transaction or a ValidationError.
+        """
+        uuids = set()
+        for t in transfers:
+            uuids.update((t['sender_account'], t['receiver_account']))
+
+        accounts = {
+            a.uuid: a for a in Account.objects
+            .select_for_update(of=('self',))
+            .select_related('user')
+            .filter(uuid__in=uuids)
+            .order_by('uuid')
+        }
+
+        # Striped senders spend from their row, so fold their stripes into it
+        senders = {t['sender_account'] for t in transfers}
+        for account in accounts.values():
+            if account.stripe_count and account.uuid in senders:
+                account.balance += Account.consolidate(account.uuid)
+
+        results = []
+        changed = {}
+        for t in transfers:
+            sender = accounts.get(t['sender_account'])
+            receiver = accounts.get(t['receiver_account'])
+
+            if sender is None or receiver is None:
+                results.append(ValidationError('Account does not exist'))
+                continue
+            if user is not None and sender.user_id != user.pk:
+                results.append(
+                    ValidationError('Can not send from this account'))
+                continue
+            if sender.balance - t['sent_amount'] < MIN_BALANCE:
+                results.append(ValidationError('Insufficient funds'))
+                continue
+
+            instance = cls(sender_account=sender, receiver_account=receiver,
+                           sent_amount=t['sent_amount'])
+            instance.calculate()
+
+            sender.balance = (sender.balance - instance.sent_amount) \
+                .quantize(CENTS)
+            receiver.balance = (receiver.balance + instance.received_amount) \
+                .quantize(CENTS)
+            changed[sender.uuid] = sender
+            changed[receiver.uuid] = receiver
+            results.append(instance)
+
+        created = [r for r in results if isinstance(r, cls)]
+        if not created:
+            return results
+
+        for account in changed.values():
+            account.version = F('version') + 1
+        Account.objects.bulk_update(changed.values(), ['balance', 'version'])
+
+        if connection.features.can_return_ids_from_bulk_insert:
+            cls.objects.bulk_create(created)
+        else:
+            for instance in created:
+                super(Transaction, instance).save()
+
+        FeedEntry.objects.bulk_create(
+            entry for instance in created
+            for entry in FeedEntry.for_transaction(instance)
+        )
+        LedgerEntry.objects.bulk_create(
+            entry for instance in created
+            for entry in instance.get_ledger_entries()
+        )
+        TransactionRollup.record(created)
+        notified = {
+            (user_id, instance.pk) for instance in created
+            for user_id in (instance.sender_account.user_id,
+                            instance.receiver_account.user_id)
+        }
+        transaction.on_commit(partial(
+            pin_to_primary, {user_id for user_id, _ in notified}))
+        transaction.on_commit(partial(events.publish, notified))
+
+        return results
 
     def __str__(self):
         return (f'{self.sender_account.user} -> '
                 f'{self.receiver_account.user}: '
                 f'{self.sent_amount} {self.sender_currency}')
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['sender_account', 'transaction_date', 'id'],
+                name='core_tx_sender_date_idx',
+            ),
+            models.Index(
+                fields=['receiver_account', 'transaction_date', 'id'],
+                name='core_tx_receiver_date_idx',
+            ),
+        ]
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of every balance movement. An account's balance is
+    the sum of its entries; accounts get an opening entry on creation.
+    """
+
+    account = models.ForeignKey(
+        Account, related_name='ledger_entries', on_delete=models.PROTECT
+    )
+    # No database constraint: the transaction table is partitioned and
+    # archive_transactions drops old transactions while entries stay
+    transaction = models.ForeignKey(
+        Transaction, related_name='ledger_entries', on_delete=models.PROTECT,
+        null=True, blank=True, db_constraint=False
+    )
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    created = models.DateTimeField(default=timezone.now)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError('Ledger entries can not be changed')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError('Ledger entries can not be deleted')
+
+    def __str__(self):
+        return f'{self.account} {self.amount:+} at {self.created}'
+
+    class Meta:
+        verbose_name_plural = 'Ledger entries'
+        indexes = [
+            models.Index(fields=['account', 'created'],
+                         name='core_ledger_account_idx'),
+        ]
+
+
+class FeedEntry(models.Model):
+    """
+    A transfer as seen by one of the users involved in it: a copy of the
+    transaction plus the other user's username, so a user's history is one
+    range of the (user, transaction_date, id) index with no joins
+    """
+
+    SENT = 'sent'
+    RECEIVED = 'received'
+    SELF = 'self'
+    DIRECTION_CHOICES = (
+        (SENT, 'Sent'),
+        (RECEIVED, 'Received'),
+        (SELF, 'Between own accounts'),
+    )
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+        related_name='feed', db_index=False
+    )
+    transaction = models.ForeignKey(
+        Transaction, on_delete=models.CASCADE, related_name='feed_entries',
+        db_constraint=False
+    )
+    direction = models.CharField(max_length=8, choices=DIRECTION_CHOICES)
+    counterparty_username = models.CharField(max_length=100)
+    transaction_date = models.DateTimeField()
+
+    # Only ever read through the entry, never searched on
+    sender_account = models.ForeignKey(
+        Account, related_name='+', on_delete=models.PROTECT, db_index=False
+    )
+    receiver_account = models.ForeignKey(
+        Account, related_name='+', on_delete=models.PROTECT, db_index=False
+    )
+    sent_amount = models.DecimalField(max_digits=6, decimal_places=2)
+    received_amount = models.DecimalField(max_digits=6, decimal_places=2)
+    commission = models.DecimalField(max_digits=6, decimal_places=2)
+    sender_currency = models.CharField(max_length=3)
+    receiver_currency = models.CharField(max_length=3)
+    commission_rate = models.FloatField()
+    conversion_rate = models.FloatField()
+
+    @classmethod
+    def for_transaction(cls, t):
+        """
+        One entry per user involved in ``t``; its accounts must have their
+        users loaded or loadable
+        """
+        values = {
+            'transaction': t,
+            'transaction_date': t.transaction_date,
+            'sender_account': t.sender_account,
+            'receiver_account': t.receiver_account,
+            'sent_amount': t.sent_amount,
+            'received_amount': t.received_amount,
+            'commission': t.commission,
+            'sender_currency': t.sender_currency,
+            'receiver_currency': t.receiver_currency,
+            'commission_rate': t.commission_rate,
+            'conversion_rate': t.conversion_rate,
+        }
+        sender = t.sender_account.user
+        receiver = t.receiver_account.user
+        if sender.pk == receiver.pk:
+            return [cls(user_id=sender.pk, direction=cls.SELF,
+                        counterparty_username=sender.username, **values)]
+        return [
+            cls(user_id=sender.pk, direction=cls.SENT,
+                counterparty_username=receiver.username, **values),
+            cls(user_id=receiver.pk, direction=cls.RECEIVED,
+                counterparty_username=sender.username, **values),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}: {self.transaction_id}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-transaction_date', '-id'],
+                         name='core_feed_user_date_idx'),
+        ]
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Balance of an account as of ``taken_at``, i.e. the sum of its ledger
+    entries created up to that moment
+    """
+
+    account = models.ForeignKey(
+        Account, related_name='snapshots', on_delete=models.CASCADE
+    )
+    balance = models.DecimalField(max_digits=8, decimal_places=2)
+    taken_at = models.DateTimeField()
+
+    @classmethod
+    @transaction.atomic
+    def take(cls, cutoff):
+        """
+        Snapshot every account with ledger activity since the previous run,
+        up to ``cutoff``. Each snapshot is the account's previous snapshot
+        plus the entries in between, so a run only reads the new entries.
+        """
+        last = cls.objects.aggregate(Max('taken_at'))['taken_at__max']
+        if last is not None and last >= cutoff:
+            return []
+
+        entries = LedgerEntry.objects.filter(created__lte=cutoff)
+        if last is not None:
+            entries = entries.filter(created__gt=last)
+
+        previous = cls.objects.filter(
+            account=OuterRef('account')).order_by('-taken_at')
+        deltas = (
+            entries.order_by().values('account')
+            .annotate(delta=Sum('amount'),
+                      previous=Subquery(previous.values('balance')[:1]))
+        )
+        return cls.objects.bulk_create(
+            cls(account_id=d['account'], taken_at=cutoff,
+                balance=(d['previous'] or 0) + d['delta'])
+            for d in deltas
+        )
+
+    def __str__(self):
+        return f'{self.account} at {self.taken_at}'
+
+    class Meta:
+        get_latest_by = 'taken_at'
+        indexes = [
+            models.Index(fields=['account', 'taken_at'],
+                         name='core_snapshot_account_idx'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response of a request made with an ``Idempotency-Key`` header, kept to
+    answer retries of that request
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+        related_name='idempotency_keys'
+    )
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f'{self.user} - {self.key}'
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+
+class ThrottleBucket(models.Model):
+    """
+    Token bucket shared by all workers, see core.throttling
+    """
+
+    key = models.CharField(max_length=100, primary_key=True)
+    tokens = models.FloatField()
+    # Unix time of the last refill
+    updated = models.FloatField()
+
+    @classmethod
+    def take(cls, key, capacity, rate, now):
+        """
+        Take a token with a single conditional UPDATE. Returns None on
+        success, else the seconds until a token is available.
+        """
+        refill = (Value(now, output_field=models.FloatField()) -
+                  F('updated')) * rate
+        bucket = cls.objects.filter(key=key)
+
+        def take_token():
+            return bucket.filter(tokens__gte=1 - refill).update(
+                tokens=Least(Value(capacity), F('tokens') + refill) - 1,
+                updated=now)
+
+        if take_token():
+            return None
+        try:
+            # Savepoint, so a concurrent insert doesn't break the
+            # surrounding transaction
+            with transaction.atomic():
+                cls.objects.create(key=key, tokens=capacity - 1, updated=now)
+            return None
+        except IntegrityError:
+            # Empty, or just created by a concurrent request
+            if take_token():
+                return None
+
+        tokens, updated = bucket.values_list('tokens', 'updated').get()
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        return max(1 - tokens, 0) / rate
+
+    def __str__(self):
+        return f'{self.key}: {self.tokens:.2f}'
+
+
+class TransferRequest(models.Model):
+    """
+    Transfer submitted asynchronously, waiting to be applied by the
+    process_transfers command
+    """
+
+    PENDING = 'PENDING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+        related_name='transfer_requests'
+    )
+    sender_account = models.ForeignKey(
+        Account, related_name='+', on_delete=models.PROTECT
+    )
+    receiver_account = models.ForeignKey(
+        Account, related_name='+', on_delete=models.PROTECT
+    )
+    sent_amount = models.DecimalField(
+        max_digits=6, decimal_places=2,
+        validators=[MinValueValidator(Decimal('0.01'))]
+    )
+    status = models.CharField(
+        max_length=7, choices=STATUS_CHOICES, default=PENDING
+    )
+    result = models.OneToOneField(
+        Transaction, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='request', db_constraint=False
+    )
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    processed = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    @transaction.atomic
+    def process_batch(cls, size):
+        """
+        Claim up to ``size`` pending requests and apply them as one transfer
+        batch. Rows claimed by another worker are skipped, not waited on.
+        Returns the processed requests.
+        """
+        pending = list(
+            cls.objects.select_for_update(skip_locked=True)
+            .filter(status=cls.PENDING).order_by('id')[:size]
+        )
+        if not pending:
+            return pending
+
+        results = Transaction.transfer_batch([
+            {
+                'sender_account': r.sender_account_id,
+                'receiver_account': r.receiver_account_id,
+                'sent_amount': r.sent_amount,
+            } for r in pending
+        ])
+
+        now = timezone.now()
+        for request, result in zip(pending, results):
+            request.processed = now
+            if isinstance(result, Transaction):
+                request.status = cls.DONE
+                request.result = result
+            else:
+                request.status = cls.FAILED
+                request.error = ' '.join(result.messages)
+        cls.objects.bulk_update(
+            pending, ['status', 'result', 'error', 'processed'])
+        return pending
+
+    def __str__(self):
+        return f'{self.user}: {self.sent_amount} {self.status}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'],
+                         name='core_transfer_request_idx'),
+        ]
+
+
+def _period_starts(ts):
+    day = timezone.localtime(ts).date() if timezone.is_aware(ts) \
+        else ts.date()
+    return ((TransactionRollup.DAY, day),
+            (TransactionRollup.MONTH, day.replace(day=1)))
+
+
+class TransactionRollup(models.Model):
+    """
+    Totals sent, received and paid in commission by a user in one currency
+    over a day or a month. Kept up to date by every transfer, in the same
+    database transaction; rebuild() recomputes them from scratch.
+    """
+
+    DAY = 'day'
+    MONTH = 'month'
+    PERIOD_CHOICES = (
+        (DAY, 'Day'),
+        (MONTH, 'Month'),
+    )
+    TOTALS = ('sent', 'received', 'commission', 'sent_count',
+              'received_count')
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+        related_name='rollups'
+    )
+    currency = models.CharField(max_length=3)
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    period_start = models.DateField()
+    sent = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    received = models.DecimalField(max_digits=14, decimal_places=2,
+                                   default=0)
+    commission = models.DecimalField(max_digits=14, decimal_places=2,
+                                     default=0)
+    sent_count = models.PositiveIntegerField(default=0)
+    received_count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get_deltas(cls, transactions):
+        deltas = {}
+
+        def add(key, **values):
+            totals = deltas.setdefault(key, dict.fromkeys(cls.TOTALS, 0))
+            for name, value in values.items():
+                totals[name] += value
+
+        for t in transactions:
+            for period, start in _period_starts(t.transaction_date):
+                add((t.sender_account.user_id, t.sender_currency, period,
+                     start),
+                    sent=t.sent_amount, commission=t.commission,
+                    sent_count=1)
+                add((t.receiver_account.user_id, t.receiver_currency, period,
+                     start),
+                    received=t.received_amount, received_count=1)
+        return deltas
+
+    @classmethod
+    @transaction.atomic
+    def record(cls, transactions):
+        """
+        Add ``transactions`` to the rollups of their senders and receivers
+        """
+        # Sorted, so concurrent transfers lock shared rows in the same order
+        for (user_id, currency, period, start), totals in \
+                sorted(cls.get_deltas(transactions).items()):
+            key = {'user_id': user_id, 'currency': currency,
+                   'period': period, 'period_start': start}
+            increments = {name: F(name) + value
+                          for name, value in totals.items()}
+            if cls.objects.filter(**key).update(**increments):
+                continue
+            try:
+                # Savepoint, so a concurrent insert of the same row only
+                # rolls back this statement
+                with transaction.atomic():
+                    cls.objects.create(**key, **totals)
+            except IntegrityError:
+                cls.objects.filter(**key).update(**increments)
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, batch_size=None):
+        """
+        Recompute every rollup from the transaction table and, for the
+        months moved out of it, from the transaction archive
+        """
+        from . import archive
+
+        cls.objects.all().delete()
+
+        sides = (
+            ('sender_account__user', 'sender_currency', {
+                'sent': Sum('sent_amount'),
+                'commission': Sum('commission'),
+                'sent_count': Count('id'),
+            }),
+            ('receiver_account__user', 'receiver_currency', {
+                'received': Sum('received_amount'),
+                'received_count': Count('id'),
+            }),
+        )
+        deltas = {}
+
+        def add(key, values):
+            totals = deltas.setdefault(key, dict.fromkeys(cls.TOTALS, 0))
+            for name, value in values.items():
+                totals[name] += value
+
+        for period, trunc in ((cls.DAY, TruncDay), (cls.MONTH, TruncMonth)):
+            for user, currency, totals in sides:
+                groups = (
+                    Transaction.objects.order_by()
+                    .annotate(start=trunc('transaction_date',
+                                          output_field=models.DateField()))
+                    .values(user, currency, 'start')
+                    .annotate(**totals)
+                )
+                for g in groups:
+                    add((g[user], g[currency], period, g['start']),
+                        {name: g[name] for name in totals})
+
+        # Rows of a month whose archiving didn't commit are in both
+        boundary = archive.get_boundary()
+        live = set() if boundary is None else set(
+            Transaction.objects.filter(transaction_date__lt=boundary)
+            .values_list('id', flat=True))
+        for _, paths in archive.get_files():
+            for path in paths:
+                for row in archive.read(path):
+                    if row['id'] in live:
+                        continue
+                    sent = {
+                        'sent': Decimal(row['sent_amount']),
+                        'commission': Decimal(row['commission']),
+                        'sent_count': 1,
+                    }
+                    received = {
+                        'received': Decimal(row['received_amount']),
+                        'received_count': 1,
+                    }
+                    date = datetime.fromisoformat(row['transaction_date'])
+                    for period, start in _period_starts(date):
+                        add((UUID(row['sender_user']), row['sender_currency'],
+                             period, start), sent)
+                        add((UUID(row['receiver_user']),
+                             row['receiver_currency'], period, start),
+                            received)
+
+        return cls.objects.bulk_create((
+            cls(user_id=user_id, currency=currency, period=period,
+                period_start=start, **totals)
+            for (user_id, currency, period, start), totals in deltas.items()
+        ), batch_size=batch_size)
+
+    def __str__(self):
+        return f'{self.user} {self.currency} {self.period} {self.period_start}'
+
+    class Meta:
+        unique_together = ('user', 'period', 'period_start', 'currency')
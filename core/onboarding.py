@@ -0,0 +1,178 @@
+"""
+Bulk user onboarding: users are read from CSV or JSON lines, their passwords
+are hashed in a process pool and users plus their accounts are inserted
+with bulk_create, one database transaction per chunk. Rows that can't be
+parsed or don't make a valid user are skipped and reported.
+"""
+import csv
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from .conf import CURRENCY, INITIAL_BALANCE
+from .models import User, Account
+
+
+USER_FIELDS = ('username', 'password', 'email', 'first_name', 'last_name')
+
+# Stands in for a line that could not be read as a row
+Unreadable = namedtuple('Unreadable', ('reason',))
+
+
+def read_csv(lines):
+    return csv.DictReader(lines)
+
+
+def read_jsonl(lines):
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield Unreadable('line is not valid JSON')
+
+
+def get_username(row):
+    username = row.get('username') if isinstance(row, dict) else None
+    return username.strip() if isinstance(username, str) else ''
+
+
+def validate(row):
+    """
+    Why ``row`` can't become a user, None if it can
+    """
+    if isinstance(row, Unreadable):
+        return row.reason
+    if not isinstance(row, dict):
+        return 'row is not an object'
+    for name in USER_FIELDS:
+        value = row.get(name)
+        if value is not None and not isinstance(value, str):
+            return f'{name} is not a string'
+    if not get_username(row) or not row.get('password'):
+        return 'username and password are required'
+    if len(get_username(row)) > User._meta.get_field('username').max_length:
+        return 'username is too long'
+    # The password is hashed, everything else is stored as given
+    for name in USER_FIELDS[2:]:
+        if len(row.get(name) or '') > \
+                User._meta.get_field(name).max_length:
+            return f'{name} is too long'
+    return None
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def create_accounts(users):
+    """
+    Open one account per currency with its initial balance for every user
+    """
+    return Account.bulk_open(
+        Account(user=user, currency_id=cur, balance=INITIAL_BALANCE[cur])
+        for user in users for cur in CURRENCY
+    )
+
+
+class Onboarding:
+    def __init__(self, chunk_size=1000, processes=None):
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.created = 0
+        self.skipped = []
+        self.seconds = 0
+
+    @property
+    def rows_per_second(self):
+        return round(self.created / self.seconds, 1) if self.seconds else 0
+
+    def report(self):
+        return {
+            'created': self.created,
+            'skipped': self.skipped,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': self.rows_per_second,
+        }
+
+    def run(self, rows):
+        """
+        Onboard ``rows``, hashing passwords in a pool of ``processes``, or
+        in this thread if that is 0
+        """
+        start = time.perf_counter()
+        if self.processes == 0:
+            self.insert_all(None, rows)
+        else:
+            with ProcessPoolExecutor(self.processes,
+                                     initializer=django.setup) as pool:
+                self.insert_all(pool, rows)
+        self.seconds = time.perf_counter() - start
+        return self
+
+    def insert_all(self, pool, rows):
+        for number, chunk in enumerate(chunked(rows, self.chunk_size)):
+            self.insert(pool, chunk, number * self.chunk_size)
+
+    def hash_passwords(self, pool, passwords):
+        if pool is None:
+            return [make_password(p) for p in passwords]
+        return pool.map(make_password, passwords,
+                        chunksize=max(1, len(passwords) // 32))
+
+    def insert(self, pool, chunk, offset):
+        valid = []
+        for i, row in enumerate(chunk, start=offset):
+            reason = validate(row)
+            if reason is None:
+                valid.append((i, get_username(row), row))
+            else:
+                self.skipped.append({'row': i, 'username': get_username(row),
+                                     'reason': reason})
+
+        usernames = [username for _, username, _ in valid]
+        taken = set(User.objects.filter(username__in=usernames)
+                    .values_list('username', flat=True))
+        seen = set()
+        rows = []
+        for i, username, row in valid:
+            if username in taken or username in seen:
+                self.skipped.append({'row': i, 'username': username,
+                                     'reason': 'username is taken'})
+            else:
+                seen.add(username)
+                rows.append((username, row))
+
+        passwords = self.hash_passwords(pool,
+                                        [r['password'] for _, r in rows])
+        users = [
+            User(username=username, password=password,
+                 **{f: row[f] for f in USER_FIELDS[2:] if row.get(f)})
+            for (username, row), password in zip(rows, passwords)
+        ]
+
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            create_accounts(users)
+        self.created += len(users)
+
+
+def onboard(lines, format, chunk_size=1000, processes=None):
+    return Onboarding(chunk_size, processes).run(READERS[format](lines))
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+
+
+class TransactionCursorPagination(CursorPagination):
+    # Keyset pagination: every page is a range scan on the
+    # (account, transaction_date, id) indexes, never an OFFSET
+    ordering = ('-transaction_date', '-id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class HistoryCursorPagination(TransactionCursorPagination):
+    """
+    Forward-only keyset pagination over feed entries read from both the
+    database and the transaction archive. The cursor holds the
+    transaction_date and transaction id of the last entry of the page.
+    """
+
+    def paginate_entries(self, fetch, request):
+        """
+        ``fetch(before, limit)`` returns up to ``limit`` entries older than
+        the (transaction_date, transaction_id) position ``before``, newest
+        first
+        """
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.request = request
+
+        before = None
+        cursor = self.decode_cursor(request)
+        if cursor is not None and cursor.position is not None:
+            try:
+                date, transaction_id = cursor.position.split('|')
+                before = (datetime.fromisoformat(date), int(transaction_id))
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+
+        entries = fetch(before, self.page_size + 1)
+        self.has_next = len(entries) > self.page_size
+        self.page = entries[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        return self.encode_cursor(Cursor(
+            offset=0, reverse=False,
+            position=f'{last.transaction_date.isoformat()}|'
+                     f'{last.transaction_id}'))
+
+    def get_previous_link(self):
+        return None
+
+
+class AccountCursorPagination(CursorPagination):
+    ordering = ('uuid',)
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class TransferRequestCursorPagination(CursorPagination):
+    ordering = ('-id',)
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class RollupCursorPagination(CursorPagination):
+    ordering = ('-period_start', 'id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
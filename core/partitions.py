@@ -0,0 +1,114 @@
+"""
+Monthly range partitions of the transaction table.
+
+On PostgreSQL 11+ migration 0010 turns core_transaction into a table
+partitioned by transaction_date, with one partition per month plus a
+default partition for rows outside all of them. Anywhere else (SQLite,
+older PostgreSQL) the table stays a plain table and the functions here
+degrade to range deletes, so archive_transactions works the same way.
+"""
+from datetime import datetime, timezone
+
+from django.db import connection, transaction
+
+from .models import Transaction
+
+
+TABLE = Transaction._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+
+def month_start(ts):
+    return datetime(ts.year, ts.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT relkind FROM pg_class '
+            'WHERE relname = %s AND pg_table_is_visible(oid)', [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def get_partitions():
+    """
+    Names of the attached partitions, the default one included
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'JOIN pg_class p ON p.oid = i.inhparent '
+            'WHERE p.relname = %s', [TABLE])
+        return {name for name, in cursor.fetchall()}
+
+
+@transaction.atomic
+def ensure_partitions(start, end):
+    """
+    Create the monthly partitions covering [start, end) that don't exist
+    yet. Rows of those months already in the default partition are moved
+    into the new partition before it is attached.
+    """
+    if not is_partitioned():
+        return []
+
+    existing = get_partitions()
+    created = []
+    month = month_start(start)
+    while month < end:
+        name = partition_name(month)
+        following = add_months(month, 1)
+        if name not in existing:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+                cursor.execute(
+                    f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} '
+                    f'WHERE transaction_date >= %s AND transaction_date < %s '
+                    f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+                    [month, following])
+                cursor.execute(
+                    f'ALTER TABLE {TABLE} ATTACH PARTITION {name} '
+                    f'FOR VALUES FROM (%s) TO (%s)', [month, following])
+            created.append(name)
+        month = following
+    return created
+
+
+@transaction.atomic
+def drop_month(month):
+    """
+    Remove every transaction of the month starting at ``month``: detach and
+    drop its partition if it has one, delete the rows otherwise. Returns
+    the number of rows removed.
+    """
+    following = add_months(month, 1)
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        if is_partitioned() and name in get_partitions():
+            cursor.execute(f'SELECT count(*) FROM {name}')
+            count = cursor.fetchone()[0]
+            cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+            cursor.execute(f'DROP TABLE {name}')
+            return count
+
+        # Raw delete: ledger entries keep pointing at archived transactions
+        cursor.execute(
+            f'DELETE FROM {TABLE} '
+            f'WHERE transaction_date >= %s AND transaction_date < %s',
+            [connection.ops.adapt_datetimefield_value(month),
+             connection.ops.adapt_datetimefield_value(following)])
+        return cursor.rowcount
@@ -0,0 +1,156 @@
+"""
+Process-local cache of the reference data a transfer needs: transaction
+types and currency conversion rates.
+
+Both tables are loaded in full on first use and kept in memory. Rates are
+held as a ConversionMatrix indexed by currency, with the pairs missing from
+the table triangulated through REFERENCE_CURRENCY. A version in the
+'versions' cache, which settings.CACHES shares between all processes, is
+replaced whenever one of them changes (see core.signals). Every process
+compares it with the version it loaded at most every REFERENCE_CHECK_SECONDS
+and reloads its copy once they differ.
+"""
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+from uuid import uuid4
+
+from django.core.cache import caches
+
+from .conf import REFERENCE_CURRENCY, REFERENCE_CHECK_SECONDS, CENTS
+
+
+CACHE = 'versions'
+VERSION_KEY = 'core:reference-data-version'
+
+Snapshot = namedtuple('Snapshot',
+                      ('version', 'transaction_types', 'conversion_matrix'))
+
+
+class ConversionMatrix:
+    """
+    Conversion rates between every pair of currencies as exact Decimals.
+
+    rates[i][j] converts from currencies[i] to currencies[j] and is None
+    when the pair has neither a direct rate nor two legs through the base
+    currency.
+    """
+
+    def __init__(self, currencies, direct_rates, base=REFERENCE_CURRENCY):
+        self.currencies = tuple(sorted(currencies))
+        self.index = {cur: i for i, cur in enumerate(self.currencies)}
+        size = len(self.currencies)
+        self.rates = [[None] * size for _ in range(size)]
+
+        for i in range(size):
+            self.rates[i][i] = Decimal(1)
+        for (from_currency, to_currency), rate in direct_rates.items():
+            # str() keeps the rate as entered instead of the float's binary
+            # expansion, e.g. 0.89 rather than 0.89000000000000001332...
+            self.rates[self.index[from_currency]][self.index[to_currency]] = \
+                Decimal(str(rate))
+
+        b = self.index.get(base)
+        if b is None:
+            return
+        for i in range(size):
+            for j in range(size):
+                if self.rates[i][j] is None and \
+                        self.rates[i][b] is not None and \
+                        self.rates[b][j] is not None:
+                    self.rates[i][j] = self.rates[i][b] * self.rates[b][j]
+
+    def rate(self, from_currency, to_currency):
+        """
+        Raises KeyError for unknown currencies or pairs without a rate
+        """
+        rate = self.rates[self.index[from_currency]][self.index[to_currency]]
+        if rate is None:
+            raise KeyError((from_currency, to_currency))
+        return rate
+
+    def convert(self, amounts, from_currency, to_currency):
+        """
+        Convert a list of Decimal amounts in one pass, rounded to cents
+        """
+        rate = self.rate(from_currency, to_currency)
+        return [(amount * rate).quantize(CENTS) for amount in amounts]
+
+
+_lock = threading.Lock()
+_snapshot = Snapshot(None, {}, ConversionMatrix((), {}))
+# When this process last compared its snapshot with the shared version
+_checked = None
+
+
+def get_version():
+    cache = caches[CACHE]
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    global _checked
+
+    # A new random version rather than an increment: no read-modify-write
+    # race between processes, and a restarted cache never repeats one
+    caches[CACHE].set(VERSION_KEY, uuid4().hex, None)
+    _checked = None
+
+
+def load(version):
+    from .models import TransactionType, Currency, CurrencyConversionRate
+
+    transaction_types = {
+        t.transaction_type: t for t in TransactionType.objects.all()
+    }
+    conversion_matrix = ConversionMatrix(
+        Currency.objects.values_list('currency', flat=True),
+        {
+            (r['from_currency'], r['to_currency']): r['conversion_rate']
+            for r in CurrencyConversionRate.objects.values(
+                'from_currency', 'to_currency', 'conversion_rate')
+        },
+    )
+    return Snapshot(version, transaction_types, conversion_matrix)
+
+
+def get_snapshot():
+    global _snapshot, _checked
+
+    now = time.monotonic()
+    if _checked is not None and now - _checked < REFERENCE_CHECK_SECONDS:
+        return _snapshot
+
+    version = get_version()
+    if _snapshot.version != version:
+        with _lock:
+            if _snapshot.version != version:
+                _snapshot = load(version)
+    _checked = now
+    return _snapshot
+
+
+def get_transaction_type(transaction_type):
+    from .models import TransactionType
+
+    try:
+        return get_snapshot().transaction_types[transaction_type]
+    except KeyError:
+        raise TransactionType.DoesNotExist(
+            f'Unknown transaction type {transaction_type}')
+
+
+def get_conversion_rate(from_currency, to_currency):
+    from .models import CurrencyConversionRate
+
+    try:
+        return get_snapshot().conversion_matrix.rate(from_currency,
+                                                     to_currency)
+    except KeyError:
+        raise CurrencyConversionRate.DoesNotExist(
+            f'No conversion rate from {from_currency} to {to_currency}')
@@ -0,0 +1,63 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+
+class Echo:
+    """
+    File-like object that hands back what is written to it, so csv.writer
+    can be used to produce single lines for a streaming response
+    """
+
+    def write(self, value):
+        return value
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only used for error responses, the export itself is streamed
+        writer = csv.writer(Echo())
+        rows = []
+        for key, value in (data or {}).items():
+            if isinstance(value, list):
+                value = ' '.join(str(v) for v in value)
+            rows.append(writer.writerow((key, value)))
+        return ''.join(rows)
+
+    def stream(self, fields, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow(row)
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, cls=DjangoJSONEncoder) + '\n'
+
+    def stream(self, fields, rows):
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row)),
+                             cls=DjangoJSONEncoder) + '\n'
+
+
+class TextRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only used for error responses, /core/metrics/ returns its text
+        # in an HttpResponse
+        return ''.join(f'{key}: {value}\n'
+                       for key, value in (data or {}).items())
@@ -0,0 +1,120 @@
+"""
+Read-replica routing.
+
+Only queries made while replica reads are enabled (see ReplicaReadMixin and
+replica_reads) go to one of settings.DATABASE_REPLICAS; everything else,
+including all writes and select_for_update, stays on the primary.
+
+Users whose balances just changed are pinned to the primary for
+settings.REPLICA_STICKY_SECONDS, so they read their own writes even while
+the replicas lag behind. Pins live in the 'pins' cache, which
+settings.CACHES shares between all processes: a transfer made through one
+pins its users in every other.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+PRIMARY = 'default'
+CACHE = 'pins'
+
+# The replica serving the current request, None for the primary
+_replica = ContextVar('replica', default=None)
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def pin_key(user_pk):
+    return f'core:primary-pin:{user_pk}'
+
+
+def pin_to_primary(user_pks):
+    """
+    Send reads of these users to the primary for the sticky window
+    """
+    seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 0)
+    if get_replicas() and seconds:
+        caches[CACHE].set_many({pin_key(pk): True for pk in user_pks},
+                               seconds)
+
+
+def is_pinned(user):
+    return user.is_authenticated and \
+        caches[CACHE].get(pin_key(user.pk)) is not None
+
+
+@contextmanager
+def use_replicas():
+    # One replica for the whole request, so all of its reads see the same
+    # point of the replication stream
+    token = _replica.set(random.choice(get_replicas()))
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def replica_reads(view):
+    """
+    Serve a read-only function view from a replica unless the user is
+    pinned to the primary
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not get_replicas() or is_pinned(request.user):
+            return view(request, *args, **kwargs)
+        with use_replicas():
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaReadMixin:
+    """
+    Serves the viewset's read-only actions from a replica unless the user
+    is pinned to the primary
+    """
+
+    replica_actions = ('list', 'retrieve')
+
+    def initial(self, request, *args, **kwargs):
+        # Authentication runs in super().initial, on the primary
+        super().initial(request, *args, **kwargs)
+        if self.action in self.replica_actions and get_replicas() and \
+                not is_pinned(request.user):
+            self._replica_token = _replica.set(random.choice(get_replicas()))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _replica.reset(token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # The database caches hold pins and versions written just now
+        if model._meta.app_label == 'django_cache':
+            return PRIMARY
+        replica = _replica.get()
+        if replica is not None and replica in get_replicas():
+            return replica
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in get_replicas()
@@ -1,21 +1,28 @@
-from .models import User, Transaction, TransactionType, Account
+from decimal import Decimal
+
+from .models import (User, Transaction, TransactionType, Account,
+                     TransferRequest, TransactionRollup, FeedEntry)
 
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from rest_framework_jwt.settings import api_settings
 
-from .conf import MIN_BALANCE
+from .metrics import TimedSerializerMixin
+from .conf import MIN_BALANCE, MAX_BATCH_TRANSFERS, MAX_QUOTES, CURRENCY
 
 
-class AccountSerializer(serializers.ModelSerializer):
+class AccountSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     client = serializers.CharField(source='get_username', read_only=True)
+    balance = serializers.DecimalField(source='total_balance', read_only=True,
+                                       max_digits=8, decimal_places=2)
 
     class Meta:
         model = Account
         fields = ('uuid', 'currency', 'balance', 'client')
 
 
-class TransactionTypeSerializer(serializers.ModelSerializer):
+class TransactionTypeSerializer(TimedSerializerMixin,
+                                serializers.ModelSerializer):
     transaction_type = serializers.CharField(
         max_length=5,
         validators=[UniqueValidator(queryset=TransactionType.objects.all())]
@@ -26,7 +33,7 @@ class TransactionTypeSerializer(serializers.ModelSerializer):
         fields = ('transaction_type', 'commission_rate')
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     transaction_date = serializers.DateTimeField(
         format='%Y-%m-%d %H:%M:%S', read_only=True)
     sender_currency = serializers.CharField(read_only=True)
@@ -39,13 +46,11 @@ class TransactionSerializer(serializers.ModelSerializer):
                                                max_digits=6, decimal_places=2)
 
     def validate(self, data):
-        user_uuid = User.objects.get(username=self.context['request'].user).uuid
-        account = Account.objects.get(uuid=data['sender_account'].uuid)
-
-        if user_uuid != account.user.uuid:
+        if data['sender_account'].user_id != self.context['request'].user.pk:
             raise serializers.ValidationError('Can not send from this account')
 
-        if data['sender_account'].balance - data['sent_amount'] < MIN_BALANCE:
+        if (data['sender_account'].total_balance - data['sent_amount']
+                < MIN_BALANCE):
             raise serializers.ValidationError('Amount exceeds account balance')
         return data
 
@@ -57,9 +62,125 @@ class TransactionSerializer(serializers.ModelSerializer):
             'commission_rate', 'commission', 'receiver_currency',
             'conversion_rate', 'received_amount', 'transaction_date',
         )
+        # Transaction.save writes feed entries with both usernames, which
+        # would otherwise be loaded while the account rows are locked
+        extra_kwargs = {
+            'sender_account': {
+                'queryset': Account.objects.select_related('user')},
+            'receiver_account': {
+                'queryset': Account.objects.select_related('user')},
+        }
+
+
+class FeedEntrySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    Renders a feed entry exactly like TransactionSerializer renders its
+    transaction, taking the user's own username from the request
+    """
+
+    id = serializers.IntegerField(source='transaction_id', read_only=True)
+    sender_account = serializers.UUIDField(source='sender_account_id',
+                                           read_only=True)
+    receiver_account = serializers.UUIDField(source='receiver_account_id',
+                                             read_only=True)
+    sender_username = serializers.SerializerMethodField()
+    receiver_username = serializers.SerializerMethodField()
+    transaction_date = serializers.DateTimeField(
+        format='%Y-%m-%d %H:%M:%S', read_only=True)
+
+    def get_sender_username(self, obj):
+        if obj.direction == FeedEntry.RECEIVED:
+            return obj.counterparty_username
+        return self.context['request'].user.username
+
+    def get_receiver_username(self, obj):
+        if obj.direction == FeedEntry.SENT:
+            return obj.counterparty_username
+        return self.context['request'].user.username
+
+    class Meta:
+        model = FeedEntry
+        fields = TransactionSerializer.Meta.fields
+
+
+class TransferRequestSerializer(TimedSerializerMixin,
+                                serializers.ModelSerializer):
+    url = serializers.HyperlinkedIdentityField(
+        view_name='transferrequest-detail')
+
+    class Meta:
+        model = TransferRequest
+        fields = (
+            'id', 'url', 'status', 'sender_account', 'receiver_account',
+            'sent_amount', 'result', 'error', 'created', 'processed',
+        )
+
+
+class TransactionFilterSerializer(serializers.Serializer):
+    date_from = serializers.DateTimeField(required=False)
+    date_to = serializers.DateTimeField(required=False)
+    currency = serializers.ChoiceField(choices=list(CURRENCY), required=False)
+    counterparty = serializers.CharField(max_length=100, required=False)
+
+
+class RollupSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = TransactionRollup
+        fields = ('currency', 'period', 'period_start', 'sent', 'received',
+                  'commission', 'sent_count', 'received_count')
+
+
+class RollupFilterSerializer(serializers.Serializer):
+    period = serializers.ChoiceField(choices=TransactionRollup.PERIOD_CHOICES,
+                                     default=TransactionRollup.DAY)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    currency = serializers.ChoiceField(choices=list(CURRENCY), required=False)
+
+
+class BalanceAtSerializer(serializers.Serializer):
+    account = serializers.UUIDField(read_only=True)
+    currency = serializers.CharField(read_only=True)
+    ts = serializers.DateTimeField()
+    balance = serializers.DecimalField(read_only=True,
+                                       max_digits=8, decimal_places=2)
+
+
+class TransferSerializer(serializers.Serializer):
+    sender_account = serializers.UUIDField()
+    receiver_account = serializers.UUIDField()
+    sent_amount = serializers.DecimalField(
+        max_digits=6, decimal_places=2, min_value=Decimal('0.01'))
+
+
+class BatchTransferSerializer(serializers.Serializer):
+    transfers = TransferSerializer(many=True, allow_empty=False)
+
+    def validate_transfers(self, value):
+        if len(value) > MAX_BATCH_TRANSFERS:
+            raise serializers.ValidationError(
+                f'At most {MAX_BATCH_TRANSFERS} transfers per batch')
+        return value
+
+
+class QuoteSerializer(serializers.Serializer):
+    amount = serializers.DecimalField(
+        max_digits=12, decimal_places=2, min_value=Decimal('0.01'))
+    from_currency = serializers.ChoiceField(choices=list(CURRENCY))
+    to_currency = serializers.ChoiceField(choices=list(CURRENCY))
+
+
+class BatchQuoteSerializer(serializers.Serializer):
+    quotes = QuoteSerializer(many=True, allow_empty=False)
+
+    def validate_quotes(self, value):
+        if len(value) > MAX_QUOTES:
+            raise serializers.ValidationError(
+                f'At most {MAX_QUOTES} quotes per request')
+        return value
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     accounts = AccountSerializer(
         source='get_accounts', many=True, read_only=True
     )
@@ -69,7 +190,8 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('uuid', 'username', 'accounts')
 
 
-class UserSerializerWithToken(serializers.ModelSerializer):
+class UserSerializerWithToken(TimedSerializerMixin,
+                              serializers.ModelSerializer):
     accounts = AccountSerializer(
         source='get_accounts', many=True, read_only=True
     )
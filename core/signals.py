@@ -0,0 +1,36 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import reference
+from .authentication import user_cache, bump_generation
+from .models import (TransactionType, Currency, CurrencyConversionRate,
+                     Account, LedgerEntry, User)
+
+
+@receiver(post_save, sender=TransactionType)
+@receiver(post_delete, sender=TransactionType)
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+@receiver(post_save, sender=CurrencyConversionRate)
+@receiver(post_delete, sender=CurrencyConversionRate)
+def invalidate_reference_data(sender, **kwargs):
+    # Only publish the new version once the change is visible to other workers
+    transaction.on_commit(reference.bump_version)
+
+
+@receiver(post_save, sender=Account)
+def open_ledger(sender, instance, created, raw, **kwargs):
+    # Opening balance, so that an account's ledger always sums to its
+    # balance. Fixtures bring their ledger entries along.
+    if created and not raw:
+        LedgerEntry.objects.create(account=instance, amount=instance.balance)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, created=False, **kwargs):
+    user_cache.invalidate(instance.username)
+    # A new user is in no process's cache yet
+    if not created:
+        transaction.on_commit(bump_generation)
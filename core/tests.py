@@ -1,3 +1,1686 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from unittest import mock
+from uuid import UUID, uuid4
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.management import call_command, CommandError
+from django.core.exceptions import ValidationError
+from django.db import connection, connections, router, transaction
+from django.db.models import Max, Sum
+from django.http import StreamingHttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import (TestCase, TransactionTestCase, skipUnlessDBFeature,
+                         override_settings)
+from rest_framework.test import APIClient
+
+from . import archive, metrics, reference, routers, throttling
+from .authentication import UserCache, user_cache, bump_generation
+from .conf import (INITIAL_BALANCE, ONBOARDING_REQUEST_MAX_ROWS, CENTS,
+                   CURRENCY)
+from .models import (User, Account, Currency, Transaction,
+                     CurrencyConversionRate, TransactionRollup,
+                     TransferConflict, LedgerEntry, BalanceSnapshot,
+                     FeedEntry, IdempotencyKey, TransferRequest)
+
+
+FIXTURES = [os.path.join(settings.BASE_DIR, 'data', 'fixtures',
+                         'core_data.json')]
+
+
+def create_user(username, balance=Decimal('100.00')):
+    user = User.objects.create(username=username)
+    for cur in Currency.objects.all():
+        Account.objects.create(user=user, currency=cur, balance=balance)
+    return user
+
+
+class QueryCountMixin:
+    """
+    Assertions that fail when an endpoint's query count depends on how many
+    rows it returns, i.e. when a serializer field triggers an N+1 query
+    """
+
+    page_sizes = (1, 10, 50)
+
+    def count_queries(self, client, url, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(queries)
+
+    def assertQueriesIndependentOfPageSize(self, client, url, **params):
+        counts = {
+            size: self.count_queries(client, url, page_size=size, **params)
+            for size in self.page_sizes
+        }
+        self.assertEqual(
+            len(set(counts.values())), 1,
+            f'Query count of {url} grows with page size: {counts}')
+
+
+class AccountBalanceTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.account = create_user('alice').account.get(currency='USD')
+
+    def test_withdraw(self):
+        Account.withdraw(uuid=self.account.uuid, amount=Decimal('40.00'))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal('60.00'))
+
+    def test_withdraw_insufficient_funds(self):
+        with self.assertRaises(ValidationError):
+            Account.withdraw(uuid=self.account.uuid, amount=Decimal('100.01'))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal('100.00'))
+
+    def test_deposit(self):
+        Account.deposit(uuid=self.account.uuid, amount=Decimal('0.50'))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal('100.50'))
+
+    def test_transfer_statements(self):
+        receiver = create_user('bob').account.get(currency='USD')
+        transfer = Transaction(sender_account=self.account,
+                               receiver_account=receiver,
+                               sent_amount=Decimal('10.00'))
+        transfer.calculate()
+
+        # One conditional UPDATE per account
+        with self.assertNumQueries(2):
+            Account.withdraw(uuid=self.account.uuid,
+                             amount=transfer.sent_amount)
+            Account.deposit(uuid=receiver.uuid,
+                            amount=transfer.received_amount)
+
+
+@override_settings(TRANSFER_CONCURRENCY='optimistic')
+class OptimisticTransferTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.sender = create_user('alice').account.get(currency='USD')
+        self.receiver = create_user('bob').account.get(currency='USD')
+
+    def transfer(self, amount='10.00'):
+        Transaction(sender_account=self.sender,
+                    receiver_account=self.receiver,
+                    sent_amount=Decimal(amount)).save()
+
+    def test_retries_when_sender_changed(self):
+        check_balance = Transaction.check_balance
+        checks = []
+
+        def changed_after_first_check(transfer):
+            version = check_balance(transfer)
+            if not checks:
+                # Another transfer gets in between
+                Account.deposit(self.sender.uuid, 1)
+            checks.append(version)
+            return version
+
+        with mock.patch.object(Transaction, 'check_balance',
+                               changed_after_first_check):
+            self.transfer()
+        self.assertEqual(len(checks), 2)
+
+        self.sender.refresh_from_db()
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.sender.balance, Decimal('91.00'))
+        self.assertEqual(self.receiver.balance, Decimal('109.70'))
+        # The second attempt only
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(LedgerEntry.objects.filter(
+            transaction__isnull=False).count(), 2)
+
+    def test_gives_up_after_retries(self):
+        with mock.patch.object(Account, 'compare_and_swap',
+                               return_value=False), \
+                mock.patch('core.models.OPTIMISTIC_BACKOFF_SECONDS', 0):
+            with self.assertRaises(TransferConflict):
+                self.transfer()
+
+            client = APIClient()
+            client.force_authenticate(self.sender.user)
+            response = client.post('/api/transactions/', {
+                'sender_account': str(self.sender.uuid),
+                'receiver_account': str(self.receiver.uuid),
+                'sent_amount': '1.00',
+            })
+            self.assertEqual(response.status_code, 409)
+
+        self.sender.refresh_from_db()
+        self.assertEqual(self.sender.balance, Decimal('100.00'))
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_insufficient_funds(self):
+        with self.assertRaises(ValidationError):
+            self.transfer('100.01')
+        self.assertFalse(Transaction.objects.exists())
+
+
+class LedgerTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.usd = self.alice.account.get(currency='USD')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def transfer(self, amount, at):
+        instance = Transaction(
+            sender_account=self.usd,
+            receiver_account=self.bob.account.get(currency='USD'),
+            sent_amount=Decimal(amount))
+        instance.save()
+        # Backdated, the way entries of earlier days would have been
+        LedgerEntry.objects.filter(transaction=instance).update(created=at)
+        return instance
+
+    def balance_at(self, ts, account=None):
+        account = account or self.usd
+        response = self.client.get(
+            f'/api/accounts/{account.uuid}/balance-at/', {'ts': ts})
+        return response.status_code, response.data.get('balance')
+
+    def test_ledger_sums_to_balance(self):
+        self.transfer('10.00', datetime.now(timezone.utc))
+        self.client.post('/api/transactions/batch/', {'transfers': [{
+            'sender_account': str(self.usd.uuid),
+            'receiver_account': str(self.alice.account.get(
+                currency='EUR').uuid),
+            'sent_amount': '5.00',
+        }]}, format='json')
+
+        for account in Account.objects.all():
+            total = account.ledger_entries.aggregate(
+                total=Sum('amount'))['total']
+            self.assertEqual(total, account.total_balance, account)
+
+    def test_transactions_can_not_change(self):
+        instance = self.transfer('10.00', datetime.now(timezone.utc))
+        path = f'/api/transactions/{instance.pk}/'
+        self.assertEqual(self.client.put(path, {}).status_code, 405)
+        self.assertEqual(self.client.patch(path, {}).status_code, 405)
+        self.assertEqual(self.client.delete(path).status_code, 405)
+        # Saving again, as the admin change form would
+        with self.assertRaises(ValidationError):
+            instance.save()
+
+        self.assertEqual(instance.ledger_entries.count(), 2)
+        self.assertEqual(FeedEntry.objects.filter(transaction=instance)
+                         .count(), 2)
+        self.assertEqual(
+            TransactionRollup.objects.get(
+                user=self.alice, period=TransactionRollup.MONTH,
+                currency='USD').sent_count, 1)
+        self.usd.refresh_from_db()
+        self.assertEqual(self.usd.balance, Decimal('90.00'))
+
+    def test_admin_is_read_only(self):
+        instance = self.transfer('10.00', datetime.now(timezone.utc))
+        staff = User.objects.create_superuser('staff', 'staff@example.com',
+                                              'password')
+        self.client.force_login(staff)
+        path = f'/admin/core/transaction/{instance.pk}/change/'
+
+        self.assertEqual(self.client.get(path).status_code, 200)
+        self.client.post(path, {'sent_amount': '10.00'})
+        self.client.post(f'/admin/core/transaction/{instance.pk}/delete/',
+                         {'post': 'yes'})
+
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(instance.ledger_entries.count(), 2)
+        self.usd.refresh_from_db()
+        self.assertEqual(self.usd.balance, Decimal('90.00'))
+
+    def test_fixture_accounts_open_once(self):
+        for account in Account.objects.filter(user__username='andrew'):
+            self.assertEqual(
+                list(account.ledger_entries.values_list('amount', flat=True)),
+                [account.balance])
+
+    def test_balance_at_around_snapshot(self):
+        day = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self.usd.ledger_entries.update(created=day)
+        self.transfer('10.00', day + timedelta(days=1))
+
+        snapshots = BalanceSnapshot.take(day + timedelta(days=2))
+        self.assertEqual(
+            {s.account_id: s.balance for s in snapshots}[self.usd.uuid],
+            Decimal('90.00'))
+        # Nothing new up to the same cutoff
+        self.assertEqual(BalanceSnapshot.take(day + timedelta(days=2)), [])
+        self.transfer('20.00', day + timedelta(days=3))
+
+        for ts, balance in ((day, '100.00'),
+                            (day + timedelta(days=1, hours=12), '90.00'),
+                            (day + timedelta(days=2), '90.00'),
+                            (day + timedelta(days=2, hours=12), '90.00'),
+                            (day + timedelta(days=4), '70.00')):
+            self.assertEqual(self.balance_at(ts.isoformat()), (200, balance))
+
+        self.assertEqual(self.balance_at('yesterday')[0], 400)
+        self.assertEqual(self.balance_at(
+            day.isoformat(), self.bob.account.get(currency='USD'))[0], 403)
+
+    def test_snapshot_balances(self):
+        hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        LedgerEntry.objects.update(created=hour_ago)
+        self.transfer('10.00', hour_ago)
+
+        out = io.StringIO()
+        call_command('snapshot_balances', lag=60, stdout=out)
+        self.assertIn(f'Took {Account.objects.count()} snapshots',
+                      out.getvalue())
+        self.assertEqual(
+            BalanceSnapshot.objects.get(account=self.usd).balance,
+            Decimal('90.00'))
+
+        call_command('snapshot_balances', lag=60, stdout=out)
+        self.assertIn('Took 0 snapshots', out.getvalue())
+
+
+class OnboardingTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.admin = User.objects.create(username='admin', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def post(self, body, content_type='application/x-ndjson'):
+        return self.client.generic('POST', '/api/users/bulk/', body,
+                                   content_type=content_type)
+
+    def assertOnboarded(self, username):
+        user = User.objects.get(username=username)
+        self.assertTrue(user.check_password('secret'))
+        for account in user.account.all():
+            self.assertEqual(account.balance,
+                             INITIAL_BALANCE[account.currency_id])
+            self.assertEqual(
+                list(account.ledger_entries.values_list('amount', flat=True)),
+                [account.balance])
+        self.assertEqual(user.account.count(), len(INITIAL_BALANCE))
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write('username,password,email\n'
+                    'carol,secret,carol@example.com\n'
+                    'dave,,\n'
+                    'carol,secret,\n'
+                    'erin,secret,\n')
+            f.flush()
+            out = io.StringIO()
+            call_command('onboard_users', f.name, processes=1, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(
+            [(s['row'], s['username'], s['reason'])
+             for s in report['skipped']],
+            [(1, 'dave', 'username and password are required'),
+             (2, 'carol', 'username is taken')])
+        self.assertOnboarded('carol')
+        self.assertOnboarded('erin')
+        self.assertEqual(User.objects.get(username='carol').email,
+                         'carol@example.com')
+
+    def test_endpoint_skips_bad_rows(self):
+        response = self.post(
+            '{"username": "carol", "password": "secret"}\n'
+            '{"username": "dave", "password": \n'
+            '["erin", "secret"]\n'
+            '{"username": "frank", "password": 12345}\n'
+            '{"username": "grace", "password": "secret", '
+            '"first_name": "%s"}\n' % ('g' * 200))
+
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(
+            [(s['row'], s['reason']) for s in response.data['skipped']],
+            [(1, 'line is not valid JSON'), (2, 'row is not an object'),
+             (3, 'password is not a string'), (4, 'first_name is too long')])
+        self.assertOnboarded('carol')
+
+    def test_endpoint_rejects_bodies(self):
+        self.assertEqual(self.post(b'\xff\xfe').status_code, 400)
+        self.assertEqual(self.post('username\n', 'text/plain').status_code,
+                         415)
+        rows = ''.join(f'{{"username": "u{i}", "password": "secret"}}\n'
+                       for i in range(ONBOARDING_REQUEST_MAX_ROWS + 1))
+        self.assertEqual(self.post(rows).status_code, 413)
+        self.assertFalse(User.objects.filter(username='u0').exists())
+
+        self.client.force_authenticate(create_user('alice'))
+        self.assertEqual(self.post('').status_code, 403)
+
+
+class BatchTransferTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def account(self, user, currency):
+        return str(user.account.get(currency=currency).uuid)
+
+    def post(self, *transfers):
+        return self.client.post('/api/transactions/batch/', {'transfers': [
+            {'sender_account': sender, 'receiver_account': receiver,
+             'sent_amount': amount}
+            for sender, receiver, amount in transfers
+        ]}, format='json')
+
+    def test_results_per_item(self):
+        alice_usd = self.account(self.alice, 'USD')
+        bob_usd = self.account(self.bob, 'USD')
+        response = self.post(
+            (alice_usd, bob_usd, '60.00'),
+            (bob_usd, alice_usd, '1.00'),
+            # Only 40.00 left by now
+            (alice_usd, bob_usd, '50.00'),
+            (alice_usd, self.account(self.alice, 'EUR'), '30.00'),
+            (alice_usd, str(uuid4()), '1.00'),
+        )
+
+        self.assertEqual(response.status_code, 200, response.content)
+        results = response.data['results']
+        self.assertEqual([r['status'] for r in results],
+                         ['ok', 'error', 'error', 'ok', 'error'])
+        self.assertEqual([r.get('errors') for r in results], [
+            None, ['Can not send from this account'],
+            ['Insufficient funds'], None, ['Account does not exist']])
+
+        sent = Transaction.objects.get(pk=results[0]['transaction']['id'])
+        self.assertEqual(Transaction.objects.count(), 2)
+        balances = dict(Account.objects.values_list('uuid', 'balance'))
+        self.assertEqual(balances[UUID(alice_usd)], Decimal('10.00'))
+        self.assertEqual(balances[UUID(bob_usd)],
+                         Decimal('100.00') + sent.received_amount)
+        for account in Account.objects.all():
+            total = account.ledger_entries.aggregate(total=Sum('amount'))
+            self.assertEqual(total['total'].quantize(CENTS), account.balance)
+        self.assertEqual(
+            sorted(FeedEntry.objects.values_list('user__username',
+                                                 'direction')),
+            [('alice', FeedEntry.SELF), ('alice', FeedEntry.SENT),
+             ('bob', FeedEntry.RECEIVED)])
+
+    def test_batch_size(self):
+        usd = self.account(self.alice, 'USD')
+        eur = self.account(self.alice, 'EUR')
+        self.assertEqual(self.post().status_code, 400)
+        with mock.patch('core.serializers.MAX_BATCH_TRANSFERS', 2):
+            response = self.post(*[(usd, eur, '1.00')] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.exists())
+
+
+class IdempotencyTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.transfer = {
+            'sender_account': str(self.alice.account.get(currency='USD').uuid),
+            'receiver_account': str(self.bob.account.get(currency='USD').uuid),
+            'sent_amount': '10.00',
+        }
+
+    def post(self, data, key='key-1'):
+        return self.client.post('/api/transactions/', data, format='json',
+                                HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        first = self.post(self.transfer)
+        second = self.post(self.transfer)
+
+        self.assertEqual(first.status_code, 201, first.content)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertNotIn('Idempotent-Replayed', first)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(self.alice.account.get(currency='USD').balance,
+                         Decimal('90.00'))
+
+    def test_key_reused_for_another_request(self):
+        self.post(self.transfer)
+        response = self.post(dict(self.transfer, sent_amount='20.00'))
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_key_too_long(self):
+        response = self.post(self.transfer, key='k' * 256)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_failed_request_is_not_stored(self):
+        response = self.post(dict(self.transfer, sent_amount='1000.00'))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        # The key is free for the corrected request
+        response = self.post(self.transfer)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_expire_keys(self):
+        self.post(self.transfer, key='old')
+        self.post(self.transfer, key='new')
+        IdempotencyKey.objects.filter(key='old').update(
+            created=datetime.now(timezone.utc) - timedelta(hours=25))
+
+        call_command('expire_idempotency_keys', '--chunk-size', '1',
+                     stdout=io.StringIO())
+
+        self.assertEqual(
+            list(IdempotencyKey.objects.values_list('key', flat=True)),
+            ['new'])
+
+
+class QueuedTransferTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def queue(self, amount):
+        return self.client.post('/api/transactions/', {
+            'sender_account': str(self.alice.account.get(currency='USD').uuid),
+            'receiver_account': str(self.bob.account.get(currency='USD').uuid),
+            'sent_amount': amount,
+        }, format='json', HTTP_PREFER='respond-async')
+
+    def test_queue_and_process(self):
+        response = self.queue('60.00')
+
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(response['Location'], response.data['url'])
+        self.assertEqual(response['Preference-Applied'], 'respond-async')
+        queued = TransferRequest.objects.get(pk=response.data['id'])
+        self.assertEqual((queued.user, queued.status, queued.sent_amount),
+                         (self.alice, TransferRequest.PENDING,
+                          Decimal('60.00')))
+        self.assertFalse(Transaction.objects.exists())
+
+        # Valid when queued, no longer once the first one is applied
+        self.assertEqual(self.queue('60.00').status_code, 202)
+        self.assertEqual(self.queue('1000.00').status_code, 400)
+
+        out = io.StringIO()
+        call_command('process_transfers', '--once', '--batch-size', '1',
+                     stdout=out)
+
+        self.assertIn('Processed 2 transfers: 1 done, 1 failed',
+                      out.getvalue())
+        done, failed = TransferRequest.objects.order_by('id')
+        self.assertEqual(done.status, TransferRequest.DONE)
+        self.assertEqual(done.result, Transaction.objects.get())
+        self.assertIsNotNone(done.processed)
+        self.assertEqual(failed.status, TransferRequest.FAILED)
+        self.assertIsNone(failed.result)
+        self.assertEqual(failed.error, 'Insufficient funds')
+        self.assertEqual(self.alice.account.get(currency='USD').balance,
+                         Decimal('40.00'))
+
+        detail = self.client.get(response['Location'])
+        self.assertEqual(detail.data['status'], TransferRequest.DONE)
+        self.assertEqual(detail.data['result'], done.result_id)
+
+    def test_process_batch_empty(self):
+        self.assertEqual(TransferRequest.process_batch(10), [])
+
+    def test_scoped_to_owner(self):
+        url = self.queue('10.00').data['url']
+
+        self.assertEqual(
+            len(self.client.get('/api/transfer-requests/').data['results']),
+            1)
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(
+            self.client.get('/api/transfer-requests/').data['results'], [])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class StripedAccountTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.sender = create_user('alice').account.get(currency='USD')
+        self.account = create_user('bob').account.get(currency='USD')
+        call_command('stripe_account', str(self.account.uuid), '3',
+                     stdout=io.StringIO())
+
+    def transfer(self, sender, receiver, amount):
+        # Fresh rows, so the sender's stripe_count is current
+        Transaction(sender_account=Account.objects.get(pk=sender.pk),
+                    receiver_account=Account.objects.get(pk=receiver.pk),
+                    sent_amount=Decimal(amount)).save()
+
+    def stripes(self):
+        return list(self.account.stripes.order_by('index')
+                    .values_list('balance', flat=True))
+
+    def reload(self):
+        return Account.objects.with_striped_balance().get(pk=self.account.pk)
+
+    def assert_ledger_matches(self):
+        account = self.reload()
+        total = account.ledger_entries.aggregate(total=Sum('amount'))['total']
+        self.assertEqual(total.quantize(CENTS), account.total_balance)
+
+    def test_deposits_round_robin(self):
+        for _ in range(3):
+            self.transfer(self.sender, self.account, '10.00')
+
+        account = self.reload()
+        self.assertEqual(self.stripes(), [Decimal('9.70')] * 3)
+        self.assertEqual(account.balance, Decimal('100.00'))
+        self.assertEqual(account.total_balance, Decimal('129.10'))
+        # Without the annotation total_balance sums the stripes itself
+        self.assertEqual(Account.objects.get(pk=self.account.pk)
+                         .total_balance, Decimal('129.10'))
+        self.assert_ledger_matches()
+
+        client = APIClient()
+        client.force_authenticate(self.account.user)
+        response = client.get(f'/api/accounts/{self.account.uuid}/')
+        self.assertEqual(Decimal(response.data['balance']), Decimal('129.10'))
+
+    def test_withdrawal_consolidates(self):
+        for _ in range(2):
+            self.transfer(self.sender, self.account, '10.00')
+
+        # More than the row holds, less than row and stripes together
+        self.transfer(self.account, self.sender, '110.00')
+
+        account = self.reload()
+        self.assertEqual(self.stripes(), [0, 0, 0])
+        self.assertEqual(account.balance, Decimal('9.40'))
+        self.assertEqual(account.total_balance, Decimal('9.40'))
+        self.assert_ledger_matches()
+
+        with self.assertRaises(ValidationError):
+            self.transfer(self.account, self.sender, '10.00')
+
+    def test_resize_and_turn_off(self):
+        self.transfer(self.sender, self.account, '10.00')
+        version = self.reload().version
+
+        Account.set_stripes(self.account.uuid, 2)
+        account = self.reload()
+        self.assertEqual((account.stripe_count, self.stripes()),
+                         (2, [0, 0]))
+        self.assertEqual(account.balance, Decimal('109.70'))
+        self.assertGreater(account.version, version)
+
+        call_command('stripe_account', str(self.account.uuid), '0',
+                     stdout=io.StringIO())
+        account = self.reload()
+        self.assertEqual((account.stripe_count, self.stripes()), (0, []))
+        self.assertEqual(account.total_balance, Decimal('109.70'))
+
+        # Deposits go to the row again
+        self.transfer(self.sender, self.account, '10.00')
+        self.assertEqual(self.reload().balance, Decimal('119.40'))
+        self.assert_ledger_matches()
+
+    def test_command_errors(self):
+        with self.assertRaises(CommandError):
+            call_command('stripe_account', str(self.account.uuid), '-1')
+        with self.assertRaises(CommandError):
+            call_command('stripe_account', str(uuid4()), '2')
+
+
+class ExportTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        carol = create_user('carol')
+        usd = self.alice.account.get(currency='USD')
+        for sender, receiver, date in (
+                (usd, self.bob.account.get(currency='EUR'),
+                 datetime(2019, 1, 10, 12, 0, 0, 123456, timezone.utc)),
+                (usd, carol.account.get(currency='USD'),
+                 datetime(2019, 2, 10, tzinfo=timezone.utc)),
+                (self.bob.account.get(currency='USD'), usd,
+                 datetime(2019, 3, 1, tzinfo=timezone.utc))):
+            Transaction(sender_account=sender, receiver_account=receiver,
+                        sent_amount=Decimal('1.00'),
+                        transaction_date=date).save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def export(self, accept, **params):
+        return self.client.get('/api/transactions/export/', params,
+                               HTTP_ACCEPT=accept)
+
+    def csv_rows(self, **params):
+        response = self.export('text/csv', **params)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode()
+        return list(csv.DictReader(io.StringIO(content)))
+
+    def ndjson_rows(self, **params):
+        response = self.export('application/x-ndjson', **params)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_formats(self):
+        response = self.export('text/csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="transactions.csv"')
+
+        rows = self.csv_rows()
+        self.assertEqual(list(rows[0]), [
+            'id', 'transaction_date', 'sender_account', 'sender_username',
+            'sent_amount', 'sender_currency', 'receiver_account',
+            'receiver_username', 'commission_rate', 'commission',
+            'receiver_currency', 'conversion_rate', 'received_amount'])
+        self.assertEqual([row['transaction_date'] for row in rows], [
+            '2019-01-10T12:00:00.123456Z', '2019-02-10T00:00:00.000000Z',
+            '2019-03-01T00:00:00.000000Z'])
+
+        # The same values, only typed in NDJSON
+        self.assertEqual(
+            [{key: str(value) for key, value in row.items()}
+             for row in self.ndjson_rows()],
+            [dict(row) for row in rows])
+
+    def test_filters(self):
+        def dates(**params):
+            return [row['transaction_date'][:10]
+                    for row in self.ndjson_rows(**params)]
+
+        self.assertEqual(dates(date_from='2019-02-01T00:00:00Z'),
+                         ['2019-02-10', '2019-03-01'])
+        self.assertEqual(dates(date_to='2019-02-10T00:00:00Z'),
+                         ['2019-01-10'])
+        self.assertEqual(dates(counterparty='bob'),
+                         ['2019-01-10', '2019-03-01'])
+        self.assertEqual(dates(currency='EUR'), [])
+        self.assertEqual(len(dates(currency='USD')), 3)
+
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(dates(), ['2019-01-10', '2019-03-01'])
+
+    def test_invalid_filter(self):
+        for params in ({'currency': 'XXX'}, {'date_from': 'yesterday'}):
+            for accept in ('text/csv', 'application/x-ndjson'):
+                response = self.export(accept, **params)
+                self.assertEqual(response.status_code, 400)
+                self.assertNotIsInstance(response, StreamingHttpResponse)
+
+
+class UserCacheTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        from rest_framework_jwt.settings import api_settings
+
+        self.alice = create_user('alice')
+        token = api_settings.JWT_ENCODE_HANDLER(
+            api_settings.JWT_PAYLOAD_HANDLER(self.alice))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {token}')
+        user_cache.clear()
+        user_cache.checked = None
+
+    def request(self):
+        """
+        Status of an authenticated request and its queries of the user table
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/core/current_user/')
+        return response.status_code, len([
+            q for q in queries if 'FROM "core_user"' in q['sql']])
+
+    def test_hit_makes_no_query(self):
+        self.assertEqual(self.request(), (200, 1))
+        self.assertEqual(self.request(), (200, 0))
+
+    def test_save_evicts(self):
+        self.request()
+        self.alice.first_name = 'Alice'
+        self.alice.save()
+        self.assertNotIn('alice', user_cache.entries)
+
+        self.request()
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.request()[0], 401)
+
+    def test_ttl(self):
+        users = UserCache(10, ttl=30, check=60)
+        with mock.patch('core.authentication.time.monotonic',
+                        return_value=100):
+            users.set(self.alice)
+            self.assertEqual(users.get('alice'), self.alice)
+        with mock.patch('core.authentication.time.monotonic',
+                        return_value=131):
+            self.assertIsNone(users.get('alice'))
+        self.assertNotIn('alice', users.entries)
+
+    def test_lru_bound(self):
+        users = UserCache(2, ttl=30, check=60)
+        bob = create_user('bob')
+        carol = create_user('carol')
+
+        users.set(self.alice)
+        users.set(bob)
+        # Now bob is the least recently used
+        users.get('alice')
+        users.set(carol)
+
+        self.assertEqual(list(users.entries), ['alice', 'carol'])
+        self.assertIsNone(users.get('bob'))
+
+    def test_generation(self):
+        other = UserCache(10, ttl=30, check=0)
+        other.set(self.alice)
+        self.assertEqual(other.get('alice'), self.alice)
+
+        bump_generation()
+        self.assertIsNone(other.get('alice'))
+
+
+class UserCacheInvalidationTest(TransactionTestCase):
+    """
+    Invalidation happens on commit, which TestCase never reaches
+    """
+
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        user_cache.clear()
+        user_cache.checked = None
+        # Stands in for the cache of another process
+        self.other = UserCache(10, ttl=30, check=0)
+        self.other.set(self.alice)
+
+    def test_queryset_update(self):
+        user_cache.set(self.alice)
+
+        User.objects.filter(username='alice').update(is_active=False)
+
+        self.assertIsNone(user_cache.get('alice'))
+        self.assertIsNone(self.other.get('alice'))
+
+    def test_save_in_another_process(self):
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertIsNone(self.other.get('alice'))
+
+    def test_new_user_keeps_the_generation(self):
+        create_user('bob')
+        self.assertEqual(self.other.get('alice'), self.alice)
+
+
+class MetricsTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.registry = metrics.Registry()
+        for target in ('core.metrics.registry', 'core.views.registry'):
+            patcher = mock.patch(target, self.registry)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.samples()), [
+            ('1', 2), ('5', 3), ('+Inf', 4), ('sum', 14.5), ('count', 4)])
+
+    def test_prometheus_output(self):
+        labels = (('endpoint', 'account-list'), ('method', 'GET'))
+        self.registry.observe('db_queries', (0, 1, 2), labels, 2)
+
+        lines = self.registry.render().splitlines()
+        start = lines.index('# TYPE payments_db_queries histogram') + 1
+        self.assertEqual(
+            lines[start:start + 6],
+            ['payments_db_queries_bucket{endpoint="account-list",method="GET"'
+             f',le="{le}"}} {count}'
+             for le, count in (('0', 0), ('1', 0), ('2', 1), ('+Inf', 1))] +
+            ['payments_db_queries_sum{endpoint="account-list",method="GET"} 2',
+             'payments_db_queries_count{endpoint="account-list",method="GET"}'
+             ' 1'])
+        for name, description, _ in metrics.METRICS:
+            self.assertIn(f'# HELP payments_{name} {description}', lines)
+
+    def test_middleware(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        client.get('/api/accounts/')
+        client.get('/api/accounts/')
+
+        histograms = self.registry.histograms
+        labels = (('endpoint', 'account-list'), ('method', 'GET'))
+        self.assertEqual(
+            histograms['request_duration_seconds', labels].count, 2)
+        self.assertGreater(histograms['db_queries', labels].sum, 0)
+        self.assertGreater(histograms['db_duration_seconds', labels].sum, 0)
+        self.assertGreater(
+            histograms['serialization_duration_seconds', labels].sum, 0)
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_request_log(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with self.assertLogs('core.slow_requests', 'WARNING') as logs:
+            client.get('/api/accounts/')
+        self.assertIn('Slow request GET /api/accounts/ -> 200', logs.output[0])
+        self.assertIn('core_account', logs.output[0])
+
+    def test_access(self):
+        client = APIClient()
+        # The test client calls from 127.0.0.1
+        response = client.get('/core/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('# TYPE payments_request_duration_seconds histogram',
+                      response.content.decode())
+
+        outside = {'REMOTE_ADDR': '203.0.113.7'}
+        self.assertEqual(client.get('/core/metrics/', **outside).status_code,
+                         401)
+        client.force_authenticate(self.alice)
+        self.assertEqual(client.get('/core/metrics/', **outside).status_code,
+                         403)
+        self.alice.is_staff = True
+        client.force_authenticate(self.alice)
+        self.assertEqual(client.get('/core/metrics/', **outside).status_code,
+                         200)
+
+        client.force_authenticate(None)
+        with override_settings(METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(client.get('/core/metrics/').status_code, 401)
+
+
+class GenerateDatasetTest(TestCase):
+    fixtures = FIXTURES
+
+    class Rollback(Exception):
+        pass
+
+    def generate(self, seed):
+        """
+        Rows generated with ``seed``, checked and then rolled back
+        """
+        out = io.StringIO()
+        try:
+            with transaction.atomic():
+                call_command('generate_dataset', '--users', '6',
+                             '--transactions', '300', '--chunk-size', '100',
+                             '--seed', str(seed), '--prefix', 'gen',
+                             '--no-copy', stdout=out, stderr=io.StringIO())
+                self.check_dataset()
+                rows = self.rows()
+                self.check_next_id()
+                raise self.Rollback(rows)
+        except self.Rollback as rollback:
+            report = json.loads(out.getvalue())
+            self.assertEqual(report['method'], 'bulk_create')
+            self.assertEqual(report['transactions'],
+                             len(rollback.args[0]['transactions']))
+            return rollback.args[0]
+
+    def rows(self):
+        generated = Transaction.objects.filter(
+            sender_account__user__username__startswith='gen')
+        return {
+            'users': list(User.objects.filter(username__startswith='gen')
+                          .order_by('username')
+                          .values_list('uuid', 'username')),
+            'accounts': list(Account.objects
+                             .filter(user__username__startswith='gen')
+                             .order_by('uuid').values()),
+            'transactions': list(generated.order_by('id').values()),
+            'ledger': list(LedgerEntry.objects
+                           .filter(transaction__in=generated)
+                           .order_by('id')
+                           .values_list('account', 'amount', 'created')),
+        }
+
+    def check_dataset(self):
+        accounts = Account.objects.filter(user__username__startswith='gen')
+        self.assertEqual(accounts.count(), 6 * len(CURRENCY))
+        for account in accounts:
+            total = account.ledger_entries.aggregate(total=Sum('amount'))
+            self.assertEqual(total['total'].quantize(CENTS), account.balance)
+
+        transactions = Transaction.objects.filter(
+            sender_account__user__username__startswith='gen')
+        self.assertGreater(transactions.count(), 0)
+        expected = defaultdict(lambda: dict.fromkeys(
+            TransactionRollup.TOTALS, 0))
+        for t in transactions.select_related('sender_account',
+                                             'receiver_account'):
+            sent = expected[t.sender_account.user_id, t.sender_currency]
+            sent['sent'] += t.sent_amount
+            sent['commission'] += t.commission
+            sent['sent_count'] += 1
+            received = expected[t.receiver_account.user_id,
+                                t.receiver_currency]
+            received['received'] += t.received_amount
+            received['received_count'] += 1
+
+        for period in (TransactionRollup.DAY, TransactionRollup.MONTH):
+            totals = TransactionRollup.objects.filter(
+                user__username__startswith='gen', period=period) \
+                .values('user', 'currency') \
+                .annotate(**{name: Sum(name)
+                             for name in TransactionRollup.TOTALS})
+            self.assertEqual(
+                {(r.pop('user'), r.pop('currency')): {
+                    name: Decimal(value).quantize(CENTS)
+                    for name, value in r.items()} for r in totals},
+                {key: {name: Decimal(value).quantize(CENTS)
+                       for name, value in row.items()}
+                 for key, row in expected.items()})
+
+    def check_next_id(self):
+        last = Transaction.objects.aggregate(Max('id'))['id__max']
+        accounts = Account.objects.filter(user__username='gen0')
+        transfer = Transaction(
+            sender_account=accounts.get(currency='USD'),
+            receiver_account=accounts.get(currency='EUR'),
+            sent_amount=Decimal('0.01'))
+        transfer.save()
+        self.assertGreater(transfer.pk, last)
+
+    def test_deterministic(self):
+        first = self.generate(seed=1)
+        self.assertEqual(self.generate(seed=1), first)
+        self.assertNotEqual(self.generate(seed=2)['transactions'],
+                            first['transactions'])
+
+
+class TransferQueriesTest(TestCase):
+    fixtures = FIXTURES
+
+    def test_no_user_queries_under_locks(self):
+        alice = create_user('alice')
+        bob = create_user('bob')
+        client = APIClient()
+        client.force_authenticate(alice)
+
+        for mode in ('pessimistic', 'optimistic'):
+            with self.subTest(mode=mode), \
+                    override_settings(TRANSFER_CONCURRENCY=mode), \
+                    CaptureQueriesContext(connection) as queries:
+                response = client.post('/api/transactions/', {
+                    'sender_account': str(
+                        alice.account.get(currency='USD').uuid),
+                    'receiver_account': str(
+                        bob.account.get(currency='USD').uuid),
+                    'sent_amount': '1.00',
+                }, format='json')
+            self.assertEqual(response.status_code, 201, response.content)
+
+            # The optimistic mode locks its rows last, but writes the
+            # transfer in the same transaction first
+            statements = [q['sql'] for q in queries]
+            first_write = next(i for i, sql in enumerate(statements)
+                               if sql.startswith(('UPDATE "core_account"',
+                                                  'INSERT INTO "core_trans')))
+            self.assertEqual(
+                [sql for sql in statements[first_write:]
+                 if 'FROM "core_user"' in sql], [])
+
+
+class BenchTransfersTest(TransactionTestCase):
+    fixtures = FIXTURES
+
+    def bench(self, *args):
+        out = io.StringIO()
+        call_command('bench_transfers', '--users', '3', '--workers', '1',
+                     '--prefix', 'bench', *args, stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_report(self):
+        report = self.bench('--transfers', '4')
+
+        self.assertEqual(set(report), {
+            'database', 'mode', 'users', 'transfers', 'workers', 'pool',
+            'contention', 'seed', 'seconds', 'succeeded', 'failed',
+            'throughput', 'latency_ms', 'deadlocks', 'conflicts', 'rejected',
+            'retries', 'queries_per_transfer'})
+        self.assertEqual(set(report['latency_ms']), {'p50', 'p95', 'p99'})
+        self.assertEqual((report['database'], report['mode']),
+                         ('sqlite', 'pessimistic'))
+        self.assertEqual(report['succeeded'] + report['failed'], 4)
+        self.assertGreater(report['queries_per_transfer'], 0)
+
+    def test_rejected_transfers(self):
+        # What a concurrent transfer spending the balance first looks like
+        with mock.patch.object(Transaction, 'save', side_effect=(
+                ValidationError('Insufficient funds'))):
+            report = self.bench('--transfers', '3')
+        self.assertEqual((report['succeeded'], report['failed'],
+                          report['rejected'], report['conflicts'],
+                          report['retries']), (0, 3, 3, 0, 0))
+
+    def test_several_runs(self):
+        reports = self.bench('--transfers', '2', '--contention', 'hot',
+                             '--mode', 'pessimistic', 'optimistic')
+        self.assertEqual([(r['contention'], r['mode']) for r in reports],
+                         [('hot', 'pessimistic'), ('hot', 'optimistic')])
+
+    def test_invalid_options(self):
+        for args in (('--transfers', '0'), ('--workers', '0')):
+            with self.assertRaises(CommandError):
+                self.bench(*args)
+
+
+class BenchDepositsTest(TransactionTestCase):
+    fixtures = FIXTURES
+
+    def test_runs_stay_on_the_ledger(self):
+        out = io.StringIO()
+        call_command('bench_deposits', '--stripes', '0,2', '--threads', '1',
+                     '--deposits', '4', '--hold-ms', '0', stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual([run['stripes'] for run in report['runs']], [0, 2])
+        accounts = Account.objects.filter(user__username='bench-deposits')
+        self.assertEqual(len(accounts), 2)
+        for account in accounts:
+            self.assertEqual(account.stripe_count, 0)
+            self.assertEqual(account.balance, Decimal('0.04'))
+            total = account.ledger_entries.aggregate(Sum('amount'))
+            self.assertEqual(total['amount__sum'], account.balance)
+
+
+class ConcurrentTransferTest(TransactionTestCase):
+    fixtures = FIXTURES
+
+    transfers_per_thread = 20
+    threads_per_direction = 4
+
+    def transfer(self, sender, receiver, errors):
+        try:
+            for _ in range(self.transfers_per_thread):
+                Transaction(sender_account=sender, receiver_account=receiver,
+                            sent_amount=Decimal('1.00')).save()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_opposing_transfers_do_not_deadlock(self):
+        alice = create_user('alice', Decimal('1000.00'))
+        bob = create_user('bob', Decimal('1000.00'))
+        a = alice.account.get(currency='USD')
+        b = bob.account.get(currency='USD')
+
+        errors = []
+        threads = [
+            threading.Thread(target=self.transfer, args=(s, r, errors))
+            for s, r in [(a, b), (b, a)] * self.threads_per_direction
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+        transfers = Transaction.objects.all()
+        expected = 2 * self.threads_per_direction * self.transfers_per_thread
+        self.assertEqual(transfers.count(), expected)
+
+        commission = sum(t.commission for t in transfers)
+        a.refresh_from_db()
+        b.refresh_from_db()
+        self.assertEqual(a.balance + b.balance,
+                         Decimal('2000.00') - commission)
+
+
+class ReferenceDataCacheTest(TransactionTestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.sender = create_user('alice').account.get(currency='USD')
+        self.receiver = create_user('bob').account.get(currency='EUR')
+
+    def test_transfer_does_not_query_reference_data(self):
+        reference.get_snapshot()
+        transfer = Transaction(sender_account=self.sender,
+                               receiver_account=self.receiver,
+                               sent_amount=Decimal('10.00'))
+
+        with self.assertNumQueries(0):
+            transfer.calculate()
+        self.assertEqual(transfer.conversion_rate, Decimal('0.89'))
+
+    def test_rate_change_invalidates_cache(self):
+        reference.get_snapshot()
+        rate = CurrencyConversionRate.objects.get(from_currency='USD',
+                                                  to_currency='EUR')
+        rate.conversion_rate = 0.5
+        rate.save()
+
+        self.assertEqual(reference.get_conversion_rate('USD', 'EUR'), 0.5)
+
+    def test_change_in_another_process(self):
+        reference.get_snapshot()
+        CurrencyConversionRate.objects.filter(
+            from_currency='USD', to_currency='EUR').update(conversion_rate=0.5)
+
+        # Another process saved the rate and bumped the version through its
+        # own cache instance, which only shares the cache table with ours
+        other = DatabaseCache(
+            settings.CACHES[reference.CACHE]['LOCATION'], {})
+        other.set(reference.VERSION_KEY, 'changed-elsewhere', None)
+
+        with mock.patch.object(reference, 'REFERENCE_CHECK_SECONDS', 0):
+            self.assertEqual(reference.get_conversion_rate('USD', 'EUR'),
+                             Decimal('0.5'))
+
+    def test_missing_pair_is_triangulated(self):
+        CurrencyConversionRate.objects.filter(from_currency='EUR',
+                                              to_currency='CNY').delete()
+
+        self.assertEqual(reference.get_conversion_rate('EUR', 'CNY'),
+                         Decimal('1.12') * Decimal('6.73'))
+
+    def test_quotes(self):
+        client = APIClient()
+        client.force_authenticate(self.sender.user)
+        response = client.post('/api/quotes/', {'quotes': [
+            {'amount': '10.00', 'from_currency': 'USD', 'to_currency': 'EUR'},
+            {'amount': '2.50', 'from_currency': 'EUR', 'to_currency': 'EUR'},
+            {'amount': '3.33', 'from_currency': 'USD', 'to_currency': 'EUR'},
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            [(q['conversion_rate'], q['converted_amount'])
+             for q in response.data['results']],
+            [('0.89', '8.90'), ('1', '2.50'), ('0.89', '2.96')])
+
+
+class TransactionRollupTest(TestCase):
+    fixtures = FIXTURES
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+
+    def transfer(self, sender, receiver, amount):
+        Transaction(sender_account=sender.account.get(currency='USD'),
+                    receiver_account=receiver.account.get(currency='USD'),
+                    sent_amount=Decimal(amount)).save()
+
+    def totals(self):
+        return sorted(TransactionRollup.objects.values_list(
+            'user__username', 'currency', 'period', 'sent', 'received',
+            'commission', 'sent_count', 'received_count'))
+
+    def test_rollups_match_rebuild(self):
+        self.transfer(self.alice, self.bob, '10.00')
+        self.transfer(self.alice, self.bob, '5.00')
+        self.transfer(self.bob, self.alice, '1.00')
+        Transaction.transfer_batch([{
+            'sender_account': self.alice.account.get(currency='USD').uuid,
+            'receiver_account': self.alice.account.get(currency='EUR').uuid,
+            'sent_amount': Decimal('2.00'),
+        }])
+
+        incremental = self.totals()
+        self.assertIn(('alice', 'USD', 'month', Decimal('17.00'),
+                       Decimal('0.97'), Decimal('0.45'), 3, 1), incremental)
+
+        TransactionRollup.rebuild()
+        self.assertEqual(self.totals(), incremental)
+
+    def test_report(self):
+        self.transfer(self.alice, self.bob, '10.00')
+        client = APIClient()
+        client.force_authenticate(self.bob)
+
+        response = client.get('/api/reports/', {'period': 'month'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            [(r['currency'], r['received'], r['received_count'])
+             for r in response.data['results']],
+            [('USD', '9.70', 1)])
+
+
+class TransactionHistoryTest(TestCase):
+    fixtures = FIXTURES
+
+    def test_feed_renders_like_transactions(self):
+        alice = create_user('alice')
+        bob = create_user('bob')
+        usd = alice.account.get(currency='USD')
+        for receiver in (bob.account.get(currency='EUR'),
+                         alice.account.get(currency='CNY')):
+            Transaction(sender_account=usd, receiver_account=receiver,
+                        sent_amount=Decimal('1.00')).save()
+
+        for user, count in ((alice, 2), (bob, 1)):
+            client = APIClient()
+            client.force_authenticate(user)
+            history = client.get('/api/transactions/').json()['results']
+            self.assertEqual(len(history), count)
+            for item in history:
+                detail = client.get(f'/api/transactions/{item["id"]}/')
+                self.assertEqual(item, detail.json())
+
+    def test_history_continues_from_archive(self):
+        alice = create_user('alice')
+        bob = create_user('bob')
+        usd = alice.account.get(currency='USD')
+        for date in (datetime(2019, 1, 10, tzinfo=timezone.utc),
+                     datetime(2019, 2, 10, tzinfo=timezone.utc),
+                     datetime(2019, 2, 20, tzinfo=timezone.utc), None):
+            Transaction(sender_account=usd, receiver_account=bob.account.get(
+                currency='EUR'), sent_amount=Decimal('1.00'),
+                transaction_date=date or datetime.now(timezone.utc)).save()
+
+        client = APIClient()
+        client.force_authenticate(alice)
+
+        def walk(url):
+            items = []
+            while url:
+                page = client.get(url).json()
+                items += page['results']
+                url = page['next']
+            return items
+
+        def export():
+            return client.get('/api/transactions/export/',
+                              HTTP_ACCEPT='application/x-ndjson')
+
+        def rollups():
+            return list(TransactionRollup.objects.order_by(
+                'user', 'currency', 'period', 'period_start').values())
+
+        before = walk('/api/transactions/?page_size=1')
+        exported = b''.join(export().streaming_content)
+        totals = rollups()
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(TRANSACTION_ARCHIVE_DIR=directory):
+            call_command('archive_transactions', months=1,
+                         stdout=io.StringIO())
+            self.assertEqual(Transaction.objects.count(), 1)
+            self.assertEqual(len(archive.get_files()), 2)
+
+            self.assertEqual(b''.join(export().streaming_content), exported)
+            call_command('rebuild_rollups', stdout=io.StringIO())
+            self.assertEqual(
+                [dict(r, id=None) for r in rollups()],
+                [dict(r, id=None) for r in totals])
+
+            self.assertEqual(walk('/api/transactions/?page_size=1'), before)
+            self.assertEqual(
+                walk('/api/transactions/?date_from=2019-02-01T00:00:00Z'
+                     '&date_to=2019-02-15T00:00:00Z'),
+                before[2:3])
+
+    def test_archive_files_without_the_user_are_skipped(self):
+        alice = create_user('alice')
+        bob = create_user('bob')
+        carol = create_user('carol')
+        for month in (1, 2, 3):
+            Transaction(sender_account=alice.account.get(currency='USD'),
+                        receiver_account=bob.account.get(currency='USD'),
+                        sent_amount=Decimal('1.00'),
+                        transaction_date=datetime(2019, month, 10,
+                                                  tzinfo=timezone.utc)).save()
+        Transaction(sender_account=carol.account.get(currency='USD'),
+                    receiver_account=bob.account.get(currency='USD'),
+                    sent_amount=Decimal('1.00')).save()
+
+        client = APIClient()
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(TRANSACTION_ARCHIVE_DIR=directory):
+            call_command('archive_transactions', months=1,
+                         stdout=io.StringIO())
+            files = archive.get_files()
+            self.assertEqual(len(files), 3)
+            self.assertEqual(archive.get_users(files[0][1][0]),
+                             {str(alice.pk), str(bob.pk)})
+
+            with mock.patch('core.archive.gzip.open',
+                            wraps=gzip.open) as opened:
+                client.force_authenticate(carol)
+                self.assertEqual(
+                    len(client.get('/api/transactions/').json()['results']),
+                    1)
+                self.assertFalse(opened.called)
+
+                client.force_authenticate(alice)
+                self.assertEqual(
+                    len(client.get('/api/transactions/').json()['results']),
+                    3)
+                self.assertEqual(opened.call_count, 3)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=60)
+class ReplicaRouterTest(TestCase):
+    def tearDown(self):
+        caches[routers.CACHE].clear()
+
+    def test_only_replica_reads_leave_the_primary(self):
+        self.assertEqual(Account.objects.all().db, 'default')
+        with routers.use_replicas():
+            self.assertEqual(Account.objects.all().db, 'replica')
+            self.assertEqual(Account.objects.select_for_update().db,
+                             'default')
+            self.assertEqual(router.db_for_write(Account), 'default')
+
+    def test_pinned_user(self):
+        user = User.objects.create(username='alice')
+        self.assertFalse(routers.is_pinned(user))
+        routers.pin_to_primary([user.pk])
+        self.assertTrue(routers.is_pinned(user))
+
+    def test_pins_outlast_many_writers(self):
+        for pk in range(400):
+            routers.pin_to_primary([pk])
+        self.assertTrue(caches[routers.CACHE].get(routers.pin_key(0)))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=60)
+class ReplicaReadTest(TransactionTestCase):
+    """
+    Against the real replica alias, a test mirror of default: the mirror
+    is a connection of its own, so the data must be committed
+    """
+
+    databases = {'default', 'replica'}
+    fixtures = FIXTURES
+
+    def tearDown(self):
+        caches[routers.CACHE].clear()
+
+    def account_queries(self, client, path):
+        """
+        Queries of the request reading accounts, per alias
+        """
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response, *(
+            len([q for q in queries if 'core_account' in q['sql']])
+            for queries in (primary, replica))
+
+    def test_transfer_pins_user_to_primary(self):
+        alice = create_user('alice')
+        bob = create_user('bob')
+        usd = alice.account.get(currency='USD')
+        client = APIClient()
+        client.force_authenticate(alice)
+
+        _, primary, replica = self.account_queries(client, '/api/accounts/')
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        response = client.post('/api/transactions/', {
+            'sender_account': str(usd.uuid),
+            'receiver_account': str(bob.account.get(currency='USD').uuid),
+            'sent_amount': '10.00',
+        })
+        self.assertEqual(response.status_code, 201, response.content)
+
+        # Both users of the transfer read from the primary now
+        response, primary, replica = self.account_queries(
+            client, f'/api/accounts/{usd.uuid}/')
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+        self.assertEqual(response.data['balance'], '90.00')
+        client.force_authenticate(bob)
+        _, primary, replica = self.account_queries(client,
+                                                   '/core/current_user/')
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+
+@override_settings(ALLOWED_HOSTS=['localhost'])
+class ASGIReadPathTest(TransactionTestCase):
+    fixtures = FIXTURES
+
+    def test_matches_wsgi(self):
+        from rest_framework_jwt.settings import api_settings
+        from .asgi import application
+        from .management.commands.bench_asgi import make_scope, receive
+
+        user = create_user('alice')
+        token = api_settings.JWT_ENCODE_HANDLER(
+            api_settings.JWT_PAYLOAD_HANDLER(user))
+        client = APIClient(HTTP_HOST='localhost')
+        client.credentials(HTTP_AUTHORIZATION=f'JWT {token}')
+
+        for path in ('/core/current_user/', '/api/accounts/',
+                     '/api/transactions/'):
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            asyncio.run(application(make_scope(path, '', token), receive,
+                                    send))
+            response = client.get(path, HTTP_ACCEPT='application/json')
+            self.assertEqual(sent[0]['status'], 200)
+            self.assertEqual(json.loads(sent[1]['body']), response.json())
+            self.assertEqual(dict(sent[0]['headers']).get(b'etag'),
+                             response.get('ETag', '').encode() or None)
+
+
+@override_settings(ALLOWED_HOSTS=['localhost'])
+class EventStreamTest(TransactionTestCase):
+    fixtures = FIXTURES
+
+    def test_transfer_is_pushed(self):
+        from rest_framework_jwt.settings import api_settings
+        from .asgi import application, executor
+        from .management.commands.bench_asgi import make_scope
+
+        alice = create_user('alice')
+        bob = create_user('bob')
+        token = api_settings.JWT_ENCODE_HANDLER(
+            api_settings.JWT_PAYLOAD_HANDLER(bob))
+
+        def transfer():
+            t = Transaction(sender_account=alice.account.get(currency='USD'),
+                            receiver_account=bob.account.get(currency='USD'),
+                            sent_amount=Decimal('10.00'))
+            t.save()
+            return t.pk
+
+        def parse(message):
+            event, data = message['body'].decode().split('\n')[:2]
+            return event[len('event: '):], json.loads(data[len('data: '):])
+
+        async def main():
+            messages = asyncio.Queue()
+            closed = asyncio.Event()
+            requests = [{'type': 'http.request', 'body': b''}]
+
+            async def receive():
+                if requests:
+                    return requests.pop()
+                await closed.wait()
+                return {'type': 'http.disconnect'}
+
+            # Like EventSource: no Authorization header
+            scope = make_scope('/api/events/', f'token={token}', '')
+            scope['headers'] = [header for header in scope['headers']
+                                if header[0] != b'authorization']
+            stream = asyncio.ensure_future(application(scope, receive,
+                                                       messages.put))
+            start = await messages.get()
+            self.assertEqual(start['status'], 200)
+            self.assertIn((b'content-type', b'text/event-stream'),
+                          start['headers'])
+            self.assertEqual(parse(await messages.get())[0], 'balances')
+
+            pk = await asyncio.get_running_loop().run_in_executor(
+                executor, transfer)
+            event, data = parse(await asyncio.wait_for(messages.get(), 5))
+            self.assertEqual((event, data['id']), ('transaction', pk))
+            event, data = parse(await asyncio.wait_for(messages.get(), 5))
+            self.assertEqual(event, 'balances')
+            self.assertIn('109.70', [a['balance'] for a in data])
+
+            closed.set()
+            await asyncio.wait_for(stream, 5)
+
+        asyncio.run(main())
+
+
+class ConditionalGetTest(TestCase):
+    fixtures = FIXTURES
+
+    def test_not_modified_until_balance_changes(self):
+        alice = create_user('alice')
+        usd = alice.account.get(currency='USD')
+        client = APIClient()
+        client.force_authenticate(alice)
+
+        for path in ('/core/current_user/', '/api/accounts/',
+                     f'/api/accounts/{usd.uuid}/'):
+            etag = client.get(path)['ETag']
+            # Only the version query
+            with self.assertNumQueries(1):
+                response = client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            Account.deposit(usd.uuid, 1)
+            response = client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+        # Deposits to a striped account land on its stripes
+        Account.set_stripes(usd.uuid, 2)
+        etag = client.get('/core/current_user/')['ETag']
+        Account.deposit(usd.uuid, 1, stripe_count=2)
+        response = client.get('/core/current_user/',
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class ThrottleTest(TestCase):
+    fixtures = FIXTURES
+
+    def transfer(self, client, sender, receiver):
+        return client.post('/api/transactions/', {
+            'sender_account': str(sender.uuid),
+            'receiver_account': str(receiver.uuid),
+            'sent_amount': '1.00',
+        })
+
+    @mock.patch.dict(throttling.THROTTLE_RATES,
+                     {'transfer-account': (2, 0.01)})
+    def test_account_bucket(self):
+        for store in ('core.throttling.LocalBucketStore',
+                      'core.throttling.DatabaseBucketStore'):
+            with self.subTest(store=store), \
+                    override_settings(THROTTLE_STORE=store):
+                alice = create_user(f'alice-{store}')
+                usd, eur = (alice.account.get(currency=c)
+                            for c in ('USD', 'EUR'))
+                client = APIClient()
+                client.force_authenticate(alice)
+
+                for status_code in (201, 201, 429):
+                    response = self.transfer(client, usd, eur)
+                    self.assertEqual(response.status_code, status_code)
+                self.assertEqual(response['Retry-After'], '100')
+                # Other accounts have their own bucket
+                self.assertEqual(self.transfer(client, eur, usd).status_code,
+                                 201)
+
+    def test_shed_while_lock_queue_is_full(self):
+        alice = create_user('alice')
+        usd, eur, cny = (alice.account.get(currency=c)
+                         for c in ('USD', 'EUR', 'CNY'))
+        client = APIClient()
+        client.force_authenticate(alice)
+
+        queue = throttling.LockQueue(limit=2, account_limit=1)
+        with mock.patch('core.views.lock_queue', queue), \
+                queue.enter([usd.uuid]):
+            self.assertEqual(self.transfer(client, usd, eur).status_code,
+                             429)
+            with queue.enter([cny.uuid]):
+                self.assertEqual(
+                    self.transfer(client, eur, cny).status_code, 503)
+            self.assertEqual(self.transfer(client, eur, cny).status_code,
+                             201)
+        self.assertEqual(queue.total, 0)
+        self.assertFalse(queue.accounts)
+
+
+class QueryCountTest(QueryCountMixin, TestCase):
+    fixtures = FIXTURES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('alice', Decimal('1000.00'))
+        sender = cls.user.account.get(currency='USD')
+        for i in range(max(cls.page_sizes)):
+            receiver = create_user(f'user{i}').account.get(currency='EUR')
+            Transaction(sender_account=sender, receiver_account=receiver,
+                        sent_amount=Decimal('1.00')).save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_transaction_list(self):
+        self.assertQueriesIndependentOfPageSize(self.client,
+                                                '/api/transactions/')
+
+    def test_account_list(self):
+        self.assertQueriesIndependentOfPageSize(self.client, '/api/accounts/')
+
+    def test_current_user(self):
+        # The ETag's version query and the accounts
+        self.assertLessEqual(
+            self.count_queries(self.client, '/core/current_user/'), 2)
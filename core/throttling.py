@@ -0,0 +1,207 @@
+"""
+Rate limits and load shedding on the endpoints that move money or create
+users.
+
+Transfers are throttled with token buckets per user and per sender
+account, signups per client address; rates are in conf.THROTTLE_RATES.
+Where the buckets live is settings.THROTTLE_STORE: LocalBucketStore keeps
+them in the process, DatabaseBucketStore shares them between all workers
+in the ThrottleBucket table.
+
+Requests that got past the throttles then wait on the account row locks
+of select_for_update. lock_queue counts them per process and turns new
+ones away early while too many are waiting: with 429 while one account
+has too many, with 503 while the process as a whole does.
+"""
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from uuid import UUID
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework import exceptions, status
+from rest_framework.throttling import BaseThrottle
+
+from .conf import (THROTTLE_RATES, THROTTLE_LOCAL_BUCKETS, LOCK_QUEUE_LIMIT,
+                   ACCOUNT_LOCK_QUEUE_LIMIT)
+from .models import ThrottleBucket
+
+
+class LocalBucketStore:
+    """
+    Buckets of this process only, so every worker allows the full rate
+    """
+
+    def __init__(self, max_size=THROTTLE_LOCAL_BUCKETS):
+        self.max_size = max_size
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """
+        Take a token from the bucket ``key``. Returns None on success, else
+        the seconds until a token is available.
+        """
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+
+            if key not in self.buckets and len(self.buckets) >= self.max_size:
+                self.prune(now)
+            tokens -= 1
+            # When the bucket is full again and can be forgotten
+            full = now + (capacity - tokens) / rate
+            self.buckets[key] = (tokens, now, full)
+            return None
+
+    def prune(self, now):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if bucket[2] > now}
+
+
+class DatabaseBucketStore:
+    """
+    Buckets shared by every process through the ThrottleBucket table
+    """
+
+    def take(self, key, capacity, rate, now):
+        return ThrottleBucket.take(key, capacity, rate, now)
+
+
+_stores = {}
+
+
+def get_store():
+    path = settings.THROTTLE_STORE
+    if path not in _stores:
+        _stores[path] = import_string(path)()
+    return _stores[path]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Allows a burst of ``capacity`` requests per key, refilled at ``rate``
+    requests per second, both from THROTTLE_RATES[scope]. Only applies to
+    the view ``actions``.
+    """
+
+    scope = None
+    actions = ('create',)
+
+    def get_key(self, request, view):
+        """
+        What the bucket is per, None to let the request through
+        """
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        if getattr(view, 'action', None) not in self.actions:
+            return True
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+
+        capacity, rate = THROTTLE_RATES[self.scope]
+        self.wait_seconds = get_store().take(
+            f'{self.scope}:{key}', capacity, rate, time.time())
+        return self.wait_seconds is None
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class TransferUserThrottle(TokenBucketThrottle):
+    scope = 'transfer-user'
+    actions = ('create', 'batch')
+
+    def get_key(self, request, view):
+        return request.user.pk
+
+
+class TransferAccountThrottle(TokenBucketThrottle):
+    scope = 'transfer-account'
+
+    def get_key(self, request, view):
+        try:
+            return UUID(str(request.data['sender_account']))
+        except (KeyError, TypeError, ValueError):
+            # Invalid, the serializer answers 400
+            return None
+
+
+class SignupThrottle(TokenBucketThrottle):
+    scope = 'signup'
+
+    def get_key(self, request, view):
+        return self.get_ident(request)
+
+
+class ServiceOverloaded(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many transfers in progress, try again shortly.'
+    default_code = 'service_overloaded'
+
+    def __init__(self, wait=None, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class AccountContended(exceptions.APIException):
+    """
+    Answer to an optimistic transfer that ran out of retries
+    """
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The account is changing too often, try again shortly.'
+    default_code = 'account_contended'
+
+    def __init__(self, wait=None, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class LockQueue:
+    """
+    Requests of this process holding or waiting for account row locks
+    """
+
+    def __init__(self, limit=LOCK_QUEUE_LIMIT,
+                 account_limit=ACCOUNT_LOCK_QUEUE_LIMIT):
+        self.limit = limit
+        self.account_limit = account_limit
+        self.total = 0
+        self.accounts = Counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def enter(self, uuids):
+        """
+        Count the request as queued on the locks of the accounts ``uuids``
+        while in the block, unless the queue is already too long
+        """
+        uuids = set(uuids)
+        with self.lock:
+            if self.total >= self.limit:
+                raise ServiceOverloaded(wait=1)
+            if any(self.accounts[uuid] >= self.account_limit
+                   for uuid in uuids):
+                raise exceptions.Throttled(
+                    wait=1, detail='Too many transfers in progress on this '
+                                   'account, try again shortly.')
+            self.total += 1
+            self.accounts.update(uuids)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.total -= 1
+                self.accounts.subtract(uuids)
+                for uuid in uuids:
+                    if self.accounts[uuid] <= 0:
+                        del self.accounts[uuid]
+
+
+lock_queue = LockQueue()
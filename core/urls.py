@@ -1,8 +1,9 @@
 from django.urls import path
 
-from .views import current_user
+from .views import current_user, metrics
 
 
 urlpatterns = [
     path('current_user/', current_user),
+    path('metrics/', metrics),
 ]
@@ -1,22 +1,58 @@
+import csv
+import io
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils import timezone
+from django.views.decorators.http import condition
 
-from rest_framework import permissions, viewsets, mixins
-from rest_framework.decorators import api_view
+from rest_framework import permissions, viewsets, mixins, status
+from rest_framework.decorators import (api_view, action, permission_classes,
+                                       renderer_classes)
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.response import Response
 
-from .models import TransactionType, Transaction, Account, User, Currency
+from . import archive, reference
+from .models import (TransactionType, Transaction, Account, User,
+                     TransferRequest, TransactionRollup, FeedEntry,
+                     TransferConflict)
 from .serializers import (UserSerializer, UserSerializerWithToken,
                           TransactionSerializer, TransactionTypeSerializer,
-                          AccountSerializer)
+                          AccountSerializer, BatchTransferSerializer,
+                          TransactionFilterSerializer, BalanceAtSerializer,
+                          TransferRequestSerializer, BatchQuoteSerializer,
+                          RollupSerializer, RollupFilterSerializer,
+                          FeedEntrySerializer)
+from .etags import (ConditionalGetMixin, current_user_etag, account_etag,
+                    account_page_etag)
+from .idempotency import IdempotentCreateMixin
+from .metrics import registry
+from .onboarding import Onboarding, READERS, create_accounts
+from .pagination import (TransactionCursorPagination, AccountCursorPagination,
+                         TransferRequestCursorPagination,
+                         RollupCursorPagination, HistoryCursorPagination)
+from .renderers import CSVRenderer, NDJSONRenderer, TextRenderer
+from .routers import ReplicaReadMixin, replica_reads, pin_to_primary
+from .throttling import (TransferUserThrottle, TransferAccountThrottle,
+                         SignupThrottle, AccountContended, lock_queue)
 
-from .conf import CURRENCY, INITIAL_BALANCE
+from .conf import (EXPORT_CHUNK_SIZE, ONBOARDING_CHUNK_SIZE,
+                   ONBOARDING_REQUEST_MAX_ROWS)
 
 
 @api_view(['GET'])
+@replica_reads
+@condition(etag_func=current_user_etag)
 def current_user(request):
     """
-    Determine the current user by their token and return their data
+    Determine the current user by their token and return their data.
+    Clients polling with If-None-Match get a 304 while their balances
+    are unchanged.
     """
 
     serializer = UserSerializer(request.user)
@@ -27,6 +63,7 @@ class UserViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
     queryset = User.objects.all()
     serializer_class = UserSerializerWithToken
     permission_classes = (permissions.AllowAny,)
+    throttle_classes = (SignupThrottle,)
 
     @transaction.atomic()
     def perform_create(self, serializer):
@@ -34,36 +71,468 @@ class UserViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
             instance = serializer.save()
 
             # Setup client accounts with initial amounts
-            for cur in CURRENCY:
-                cur_obj = Currency.objects.get(currency=cur)
-                Account.objects.create(currency=cur_obj,
-                                       balance=INITIAL_BALANCE[cur],
-                                       user=instance)
+            create_accounts([instance])
+            transaction.on_commit(partial(pin_to_primary, [instance.pk]))
+
+    @action(detail=False, methods=['post'],
+            permission_classes=(permissions.IsAdminUser,))
+    def bulk(self, request):
+        """
+        Onboard up to ONBOARDING_REQUEST_MAX_ROWS users at once from a CSV
+        (text/csv) or JSON lines (application/x-ndjson) body with username
+        and password columns
+        """
+
+        formats = {'text/csv': 'csv', 'application/x-ndjson': 'jsonl'}
+        format = formats.get(request.content_type.split(';')[0].strip())
+        if format is None:
+            return Response(
+                {'detail': 'Send text/csv or application/x-ndjson'},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+        try:
+            lines = io.StringIO(request.body.decode())
+        except UnicodeDecodeError:
+            return Response({'detail': 'The body is not valid UTF-8'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            rows = list(READERS[format](lines))
+        except csv.Error as e:
+            return Response({'detail': f'Invalid CSV: {e}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > ONBOARDING_REQUEST_MAX_ROWS:
+            return Response(
+                {'detail': f'At most {ONBOARDING_REQUEST_MAX_ROWS} users '
+                           f'per request, use the onboard_users command '
+                           f'for more'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
-class TransactionTypeViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin,
-                             viewsets.GenericViewSet):
+        # Few enough to hash in this thread instead of forking a pool
+        onboarding = Onboarding(ONBOARDING_CHUNK_SIZE, processes=0).run(rows)
+        return Response(onboarding.report(), status=status.HTTP_201_CREATED)
+
+
+class TransactionTypeViewSet(ReplicaReadMixin, mixins.RetrieveModelMixin,
+                             mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = TransactionType.objects.all()
     serializer_class = TransactionTypeSerializer
 
 
-class TransactionViewSet(viewsets.ModelViewSet):
-    queryset = Transaction.objects.all()
+def filter_transactions(queryset, user, params):
+    """
+    Restrict transactions to those touching the user's accounts and apply
+    the date range, currency and counterparty filters from query params
+    """
+
+    filters = TransactionFilterSerializer(data=params)
+    filters.is_valid(raise_exception=True)
+    data = filters.validated_data
+
+    own = Account.objects.filter(user=user)
+    if 'currency' in data:
+        own = own.filter(currency=data['currency'])
+    own = own.values('uuid')
+
+    if 'counterparty' in data:
+        other = Account.objects.filter(
+            user__username=data['counterparty']).values('uuid')
+        scope = (Q(sender_account__in=own, receiver_account__in=other) |
+                 Q(receiver_account__in=own, sender_account__in=other))
+    else:
+        scope = Q(sender_account__in=own) | Q(receiver_account__in=own)
+    queryset = queryset.filter(scope)
+
+    if 'date_from' in data:
+        queryset = queryset.filter(transaction_date__gte=data['date_from'])
+    if 'date_to' in data:
+        queryset = queryset.filter(transaction_date__lt=data['date_to'])
+    return queryset
+
+
+def filter_feed(queryset, user, data):
+    """
+    Same filters as filter_transactions, on the user's feed entries, from
+    validated TransactionFilterSerializer data
+    """
+
+    queryset = queryset.filter(user=user)
+    if 'currency' in data:
+        # Entries whose side of the transfer on the user's end is in it
+        queryset = queryset.filter(
+            Q(direction__in=(FeedEntry.SENT, FeedEntry.SELF),
+              sender_currency=data['currency']) |
+            Q(direction__in=(FeedEntry.RECEIVED, FeedEntry.SELF),
+              receiver_currency=data['currency'])
+        )
+    if 'counterparty' in data:
+        queryset = queryset.filter(
+            counterparty_username=data['counterparty'])
+    if 'date_from' in data:
+        queryset = queryset.filter(transaction_date__gte=data['date_from'])
+    if 'date_to' in data:
+        queryset = queryset.filter(transaction_date__lt=data['date_to'])
+    return queryset
+
+
+def history(request):
+    """
+    Paginate the user's history. Requests whose date range reaches into
+    the transaction archive continue from it after the feed runs out.
+    Returns the paginator and the page.
+    """
+
+    filters = TransactionFilterSerializer(data=request.query_params)
+    filters.is_valid(raise_exception=True)
+    data = filters.validated_data
+    queryset = filter_feed(FeedEntry.objects.all(), request.user, data)
+
+    boundary = archive.get_boundary()
+    if boundary is None or \
+            'date_from' in data and data['date_from'] >= boundary:
+        paginator = TransactionCursorPagination()
+        return paginator, paginator.paginate_queryset(queryset, request)
+
+    def fetch(before, limit):
+        recent = queryset
+        if before is not None:
+            recent = recent.filter(
+                Q(transaction_date__lt=before[0]) |
+                Q(transaction_date=before[0], transaction_id__lt=before[1]))
+        entries = list(recent.order_by('-transaction_date',
+                                       '-transaction_id')[:limit])
+        if len(entries) == limit:
+            return entries
+
+        # Rows of a month whose archiving didn't commit are in both
+        seen = {entry.transaction_id for entry in entries}
+        entries += [
+            entry for entry in archive.read_feed(request.user, data,
+                                                 before, limit)
+            if entry.transaction_id not in seen
+        ]
+        entries.sort(key=lambda e: (e.transaction_date, e.transaction_id),
+                     reverse=True)
+        return entries[:limit]
+
+    paginator = HistoryCursorPagination()
+    return paginator, paginator.paginate_entries(fetch, request)
+
+
+EXPORT_FIELDS = (
+    ('id', 'id'),
+    ('transaction_date', 'transaction_date'),
+    ('sender_account', 'sender_account'),
+    ('sender_username', 'sender_account__user__username'),
+    ('sent_amount', 'sent_amount'),
+    ('sender_currency', 'sender_currency'),
+    ('receiver_account', 'receiver_account'),
+    ('receiver_username', 'receiver_account__user__username'),
+    ('commission_rate', 'commission_rate'),
+    ('commission', 'commission'),
+    ('receiver_currency', 'receiver_currency'),
+    ('conversion_rate', 'conversion_rate'),
+    ('received_amount', 'received_amount'),
+)
+
+# The same in CSV and NDJSON, which would otherwise render datetimes
+# differently; always UTC with microseconds
+EXPORT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# Keys of archive.read_transactions rows with other names
+ARCHIVE_EXPORT_KEYS = {
+    'sender_account': 'sender_account_id',
+    'receiver_account': 'receiver_account_id',
+}
+
+
+def export_rows(request, queryset):
+    """
+    Values of EXPORT_FIELDS of the user's transactions, oldest first,
+    continuing from the archive for date ranges reaching into it
+    """
+
+    filters = TransactionFilterSerializer(data=request.query_params)
+    filters.is_valid(raise_exception=True)
+    data = filters.validated_data
+    rows = (
+        queryset.order_by('transaction_date', 'id')
+        .values_list(*(lookup for _, lookup in EXPORT_FIELDS))
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+
+    boundary = archive.get_boundary()
+    if boundary is not None and not (
+            'date_from' in data and data['date_from'] >= boundary):
+        rows = with_archived_rows(request.user, data, rows)
+    return (format_export_row(row) for row in rows)
+
+
+def format_export_row(row):
+    # transaction_date is the second of EXPORT_FIELDS
+    date = row[1].astimezone(timezone.utc).strftime(EXPORT_DATE_FORMAT)
+    return (row[0], date) + tuple(row[2:])
+
+
+def with_archived_rows(user, data, rows):
+    # Every archived transaction is older than those left in the table,
+    # except for rows of a month whose archiving didn't commit
+    archived = set()
+    for row in archive.read_transactions(user, data):
+        archived.add(row['id'])
+        yield tuple(row[ARCHIVE_EXPORT_KEYS.get(name, name)]
+                    for name, _ in EXPORT_FIELDS)
+    for row in rows:
+        if row[0] not in archived:
+            yield row
+
+
+class QueuedCreateMixin:
+    """
+    Requests sent with a ``Prefer: respond-async`` header are validated,
+    queued for the process_transfers command and answered with 202 and the
+    URL of the queued request. Everything else is created synchronously.
+    """
+
+    def create(self, request, *args, **kwargs):
+        if 'respond-async' not in request.META.get('HTTP_PREFER', ''):
+            return super().create(request, *args, **kwargs)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        queued = TransferRequest.objects.create(
+            user=request.user, **serializer.validated_data)
+
+        data = TransferRequestSerializer(
+            queued, context=self.get_serializer_context()).data
+        return Response(data, status=status.HTTP_202_ACCEPTED, headers={
+            'Location': data['url'],
+            'Preference-Applied': 'respond-async',
+        })
+
+
+class TransactionViewSet(ReplicaReadMixin, IdempotentCreateMixin,
+                         QueuedCreateMixin, mixins.CreateModelMixin,
+                         mixins.RetrieveModelMixin, mixins.ListModelMixin,
+                         viewsets.GenericViewSet):
+    """
+    Transfers are created and read, never changed or deleted: their ledger
+    entries are append-only
+    """
+
+    queryset = Transaction.objects.select_related(
+        'sender_account__user', 'receiver_account__user')
     serializer_class = TransactionSerializer
+    pagination_class = TransactionCursorPagination
+    throttle_classes = (TransferUserThrottle, TransferAccountThrottle)
+
+    def get_queryset(self):
+        return filter_transactions(super().get_queryset(), self.request.user,
+                                   self.request.query_params)
 
-    @transaction.atomic()
     def perform_create(self, serializer):
-        instance = serializer.save()
-        instance.sender_account.user.transactions.add(instance)
-        if instance.sender_account.user != instance.receiver_account.user:
-            instance.receiver_account.user.transactions.add(instance)
+        data = serializer.validated_data
+        with lock_queue.enter([data['sender_account'].uuid,
+                               data['receiver_account'].uuid]):
+            try:
+                super().perform_create(serializer)
+            except TransferConflict:
+                raise AccountContended(wait=1)
+
+    def list(self, request, *args, **kwargs):
+        """
+        The user's history, read from their feed in one index range scan
+        and from the archive for ranges reaching into it
+        """
+
+        paginator, page = history(request)
+        serializer = FeedEntrySerializer(
+            page, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'],
+            renderer_classes=(CSVRenderer, NDJSONRenderer))
+    def export(self, request):
+        """
+        Stream the user's full transaction history as CSV or NDJSON
+        """
+
+        rows = export_rows(request, self.get_queryset())
+        renderer = request.accepted_renderer
+        fields = [name for name, _ in EXPORT_FIELDS]
+
+        response = StreamingHttpResponse(
+            renderer.stream(fields, rows),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        response['Content-Disposition'] = (
+            f'attachment; filename="transactions.{renderer.format}"')
+        return response
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Apply a list of transfers in one database transaction and report
+        the outcome of every item
+        """
 
+        serializer = BatchTransferSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        transfers = serializer.validated_data['transfers']
+        uuids = {t[field] for t in transfers
+                 for field in ('sender_account', 'receiver_account')}
+        with lock_queue.enter(uuids):
+            results = Transaction.transfer_batch(transfers,
+                                                 user=request.user)
 
-class AccountViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin,
+        items = []
+        for index, result in enumerate(results):
+            if isinstance(result, Transaction):
+                items.append({
+                    'index': index,
+                    'status': 'ok',
+                    'transaction': TransactionSerializer(result).data,
+                })
+            else:
+                items.append({
+                    'index': index,
+                    'status': 'error',
+                    'errors': result.messages,
+                })
+        return Response({'results': items}, status=status.HTTP_200_OK)
+
+
+class TransferRequestViewSet(mixins.RetrieveModelMixin,
+                             mixins.ListModelMixin, viewsets.GenericViewSet):
+    queryset = TransferRequest.objects.all()
+    serializer_class = TransferRequestSerializer
+    pagination_class = TransferRequestCursorPagination
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user=self.request.user)
+
+
+class AccountViewSet(ReplicaReadMixin, ConditionalGetMixin,
+                     mixins.RetrieveModelMixin, mixins.ListModelMixin,
                      viewsets.GenericViewSet):
-    queryset = Account.objects.all()
+    queryset = Account.objects.select_related('user').with_striped_balance()
     serializer_class = AccountSerializer
+    replica_actions = ('list', 'retrieve', 'balance_at')
+    pagination_class = AccountCursorPagination
+
+    def get_etag(self, request, *args, **kwargs):
+        accounts = self.filter_queryset(Account.objects.all())
+        if self.action == 'retrieve':
+            return account_etag(request, accounts, kwargs['pk'])
+        return account_page_etag(request, accounts, self.pagination_class())
+
+    @action(detail=True, methods=['get'], url_path='balance-at')
+    def balance_at(self, request, pk=None):
+        """
+        Balance of one of the user's accounts at a point in time
+        """
+
+        account = self.get_object()
+        if account.user_id != request.user.pk:
+            raise PermissionDenied('Not your account')
+
+        serializer = BalanceAtSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        ts = serializer.validated_data['ts']
+
+        return Response(BalanceAtSerializer({
+            'account': account.uuid,
+            'currency': account.currency_id,
+            'ts': ts,
+            'balance': account.get_balance_at(ts),
+        }).data)
+
+
+class ReportViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+    """
+    The user's totals sent, received and paid in commission per currency
+    and day or month, filtered by period, date_from, date_to and currency
+    """
+
+    queryset = TransactionRollup.objects.all()
+    serializer_class = RollupSerializer
+    pagination_class = RollupCursorPagination
+
+    def get_queryset(self):
+        filters = RollupFilterSerializer(data=self.request.query_params)
+        filters.is_valid(raise_exception=True)
+        data = filters.validated_data
+
+        queryset = super().get_queryset().filter(user=self.request.user,
+                                                 period=data['period'])
+        if 'currency' in data:
+            queryset = queryset.filter(currency=data['currency'])
+        if 'date_from' in data:
+            queryset = queryset.filter(period_start__gte=data['date_from'])
+        if 'date_to' in data:
+            queryset = queryset.filter(period_start__lt=data['date_to'])
+        return queryset
+
+
+class QuoteViewSet(viewsets.ViewSet):
+    """
+    Price many (amount, from_currency, to_currency) conversions at once
+    with the cached conversion matrix
+    """
+
+    def create(self, request):
+        serializer = BatchQuoteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        quotes = serializer.validated_data['quotes']
+
+        # One rate lookup and one list pass per currency pair
+        pairs = defaultdict(list)
+        for index, quote in enumerate(quotes):
+            pairs[quote['from_currency'], quote['to_currency']].append(index)
+
+        matrix = reference.get_snapshot().conversion_matrix
+        results = [None] * len(quotes)
+        for (from_currency, to_currency), indexes in pairs.items():
+            try:
+                rate = matrix.rate(from_currency, to_currency)
+                converted = matrix.convert(
+                    [quotes[i]['amount'] for i in indexes],
+                    from_currency, to_currency)
+            except KeyError:
+                rate, converted = None, [None] * len(indexes)
+            # Decimals as strings, the way DecimalField renders them
+            rate = rate if rate is None else str(rate)
+            for i, amount in zip(indexes, converted):
+                results[i] = {
+                    'amount': str(quotes[i]['amount']),
+                    'from_currency': from_currency,
+                    'to_currency': to_currency,
+                    'conversion_rate': rate,
+                    'converted_amount': amount if amount is None
+                    else str(amount),
+                }
+        return Response({'results': results}, status=status.HTTP_200_OK)
 
 
 def index(request):
     return render(request, 'index.html')
+
+
+class IsStaffOrMetricsScraper(permissions.BasePermission):
+    """
+    Staff users and requests from settings.METRICS_ALLOWED_IPS
+    """
+
+    def has_permission(self, request, view):
+        return request.user.is_staff or \
+            request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+
+@api_view(['GET'])
+@permission_classes((IsStaffOrMetricsScraper,))
+@renderer_classes((TextRenderer,))
+def metrics(request):
+    """
+    Per-endpoint request metrics in Prometheus text format
+    """
+
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,17 @@
+"""
+ASGI config for paymentsbackend project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``. Serve it with an ASGI server, e.g.
+
+    uvicorn paymentsbackend.asgi:application
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'paymentsbackend.settings')
+django.setup()
+
+from core.asgi import application  # noqa: E402,F401
@@ -28,6 +28,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -58,6 +59,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'paymentsbackend.wsgi.application'
 
+# Threads running the ORM work of paymentsbackend.asgi; each keeps one
+# persistent database connection, see core.asgi
+ASGI_THREAD_POOL_SIZE = 32
+
 if 'TRAVIS' in os.environ:
     DATABASES = {
         'default': {
@@ -67,6 +72,7 @@ if 'TRAVIS' in os.environ:
             'PASSWORD': '',
             'HOST':     'localhost',
             'PORT':     '',
+            'CONN_MAX_AGE': 60,
         }
     }
 else:
@@ -76,10 +82,72 @@ else:
             'NAME': 'postgres',
             'USER': 'postgres',
             'HOST': 'db',
-            'PORT': 5432
+            'PORT': 5432,
+            'CONN_MAX_AGE': 60,
         }
     }
 
+# Every process (web, asgi, process_transfers) must see the same values in
+# these caches. The database tables are created by createcachetable.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'core_cache',
+    },
+    # The reference data version (core.reference) and the cached users'
+    # generation (core.authentication): a few keys, which a table of their
+    # own never culls
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'core_versions',
+    },
+    # Replica pins (core.routers), one key per user who wrote within
+    # REPLICA_STICKY_SECONDS
+    'pins': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ['MEMCACHED_LOCATION'],
+    } if 'MEMCACHED_LOCATION' in os.environ else {
+        # Without memcached: a table too large to cull pins before they
+        # expire, at the cost of a COUNT(*) on the primary per write
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'core_pins',
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 7},
+    },
+}
+
+# A read-only replica of default, e.g. a streaming replication standby.
+# Tests run it as a mirror of default.
+if 'DB_REPLICA_HOST' in os.environ:
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        HOST=os.environ['DB_REPLICA_HOST'],
+        TEST={'MIRROR': 'default'},
+    )
+
+# Read-only list/retrieve actions are served from these aliases, see
+# core.routers
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# Users stay on the primary for this long after their balance changes, so
+# they never read a balance older than their own transfer
+REPLICA_STICKY_SECONDS = 10
+
+# Where archive_transactions writes the transactions it moves out of the
+# database, see core.archive
+TRANSACTION_ARCHIVE_DIR = os.environ.get(
+    'TRANSACTION_ARCHIVE_DIR', os.path.join(BASE_DIR, 'data', 'archive'))
+
+# Where core.throttling keeps its token buckets: LocalBucketStore per
+# process, core.throttling.DatabaseBucketStore shared by all of them
+THROTTLE_STORE = 'core.throttling.LocalBucketStore'
+
+# How Transaction.save moves balances: 'pessimistic' updates the account
+# rows first and keeps them locked until the commit, 'optimistic' writes
+# them last with a compare-and-swap on their version and retries on
+# conflicts. Compare both with bench_transfers --mode.
+TRANSFER_CONCURRENCY = os.environ.get('TRANSFER_CONCURRENCY', 'pessimistic')
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -116,13 +184,10 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'core.authentication.CachedJSONWebTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     ),
-
-    # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
-    # 'PAGE_SIZE': 1000
 }
 
 # CORS_ORIGIN_WHITELIST = (
@@ -139,3 +204,13 @@ JWT_AUTH = {
 }
 
 AUTH_USER_MODEL = 'core.User'
+
+# Besides staff users, /core/metrics/ answers requests from these
+# addresses only, e.g. a Prometheus server scraping the workers directly
+# rather than through a proxy
+METRICS_ALLOWED_IPS = os.environ.get(
+    'METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Log requests slower than this many seconds together with their SQL
+# (logger 'core.slow_requests'), None turns the log off
+SLOW_REQUEST_SECONDS = None
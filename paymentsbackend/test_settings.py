@@ -0,0 +1,14 @@
+"""
+Settings for the test suite:
+
+    python manage.py test --settings=paymentsbackend.test_settings
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+
+# Always a replica, as a mirror of default, to test the routing with
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+
+# Tests only read from the replica where they ask for it
+DATABASE_REPLICAS = []
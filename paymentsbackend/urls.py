@@ -6,7 +6,8 @@ from rest_framework_jwt.views import obtain_jwt_token
 from rest_framework_swagger.views import get_swagger_view
 
 from core.views import (TransactionViewSet, TransactionTypeViewSet,
-                        AccountViewSet, UserViewSet, index)
+                        AccountViewSet, UserViewSet, TransferRequestViewSet,
+                        QuoteViewSet, ReportViewSet, index)
 
 
 schema_view = get_swagger_view(title='Payments API')
@@ -16,6 +17,9 @@ router.register(r'transactions', TransactionViewSet)
 router.register(r'transaction-types', TransactionTypeViewSet)
 router.register(r'accounts', AccountViewSet)
 router.register(r'users', UserViewSet)
+router.register(r'transfer-requests', TransferRequestViewSet)
+router.register(r'quotes', QuoteViewSet, basename='quote')
+router.register(r'reports', ReportViewSet)
 
 
 urlpatterns = [